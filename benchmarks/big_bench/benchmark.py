@@ -3,10 +3,16 @@ from grammarflow.constrain import Constrain
 from grammarflow.prompt.template import * 
 from grammarflow.tools.response import Response
 import json 
+import os
+import sys
 from grammarflow.grammars.gnbf import GNBF
 from grammars import *
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from runner import Runner
+
 n = 200
+workers = 4  # Each LocalLlama call runs its own llama.cpp process (and loads the model); keep within what fits in memory
 
 def check_response(response, example, only_structure=True):
   for key, value in example.items(): 
@@ -20,68 +26,12 @@ def check_response(response, example, only_structure=True):
       return False
   return True
 
-def save(logs, path):
-  with open(f'./results/{path}', 'w') as f: 
-    f.write(json.dumps(logs, indent=2))
-
-def StrategyQA(model_name, get_prompt, llm, verbose=False, **kwargs):
-  file_ = json.load(open('./data/strategy_qa.json'))
-
-  logs = {'n_badcalls': 0, 'n_calls': 0, 'n_goodcalls': 0, 'n_matchedcall': 0, 'responses': [], 'expected': []}
-
-  for ind, example in enumerate(file_['examples'][:n]): 
-    with Constrain('json') as manager: 
-      template = get_prompt(**kwargs)
-      prompt = manager.format(
-        placeholders={
-          "instructions": file_['description'],
-          "prompt": example['input']
-        },
-        grammars=[{
-          'description': 'Response', 
-          'model': StrategyQAModel
-        }],
-      )
-
-      if verbose: 
-        print(manager.prompt)
-        print('-------------------')
-      response = llm(prompt, grammar=manager.get_grammar(StrategyQAModel), stop_at=template.stop_at)
-      if response: 
-        if verbose:
-          print(response)
-          print('-------------------')
-        logs['responses'].append(response)
-        logs['n_calls'] += 1
-        response = manager.parse(response)
-        if verbose:
-          print(response)
-          print('-------------------')
-        if isinstance(response, Response):
-          logs['n_goodcalls'] += 1
-        else: 
-          logs['n_badcalls'] += 1
-          
-        del example['input']
-        logs['expected'].append({'StrategyQAModel': example})
-
-        if check_response(response, {'StrategyQAModel': example}): 
-          logs['n_matchedcall'] += 1
-      else:
-        continue
-
-    print(f'Step {ind}: [n_goodcalls: {logs["n_goodcalls"]}, n_badcalls: {logs["n_badcalls"]}, n_matchedcall: {logs["n_matchedcall"]}]')
-    save(logs, f'{model_name}_stategyqa.json')
-
-  return logs
+def run_task(model_name, task, data_path, format_, model, description, get_prompt, llm, verbose=False, drop=('input',), **kwargs):
+  file_ = json.load(open(data_path))
+  model_key = model.__name__
 
-def LogicGridPuzzle(model_name, get_prompt, llm, verbose=False, **kwargs):
-  file_ = json.load(open('./data/logic_grid_puzzle.json'))
-
-  logs = {'n_badcalls': 0, 'n_calls': 0, 'n_goodcalls': 0, 'n_matchedcall': 0, 'responses': [], 'expected': []} 
-
-  for ind, example in enumerate(file_['examples'][:n]): 
-    with Constrain('xml') as manager: 
+  def step(example):
+    with Constrain(format_) as manager: 
       template = get_prompt(**kwargs)
       prompt = manager.format(template, 
         placeholders={
@@ -89,150 +39,53 @@ def LogicGridPuzzle(model_name, get_prompt, llm, verbose=False, **kwargs):
           "prompt": example['input']
         },
         grammars=[{
-          'description': 'Response', 
-          'model': LogicGridPuzzleModel
+          'description': description, 
+          'model': model
         }],
       )
 
       if verbose: 
-        print(manager.prompt)
+        print(prompt)
         print('-------------------')
-      response = llm(prompt, grammar=manager.get_grammar(LogicGridPuzzleModel), stop_at=template.stop_at)
-      if response: 
-        if verbose:
-          print(response)
-          print('-------------------')
-        logs['responses'].append(response)
-        logs['n_calls'] += 1
-        response = manager.parse(response)
-        if verbose:
-          print(response)
-          print('-------------------')
-        if isinstance(response, Response):
-          logs['n_goodcalls'] += 1
-        else: 
-          logs['n_badcalls'] += 1
-          
-        del example['input']
-        logs['expected'].append({'LogicGridPuzzleModel': example})
-
-        # Response object always uses Model name at the topmost level. This is required for context-based multi-TOML parsing.
-        # I'm adding 'h' to the keys to match the model. Pydantic doesn't let me allot numbers as field names. 
-        if check_response(response, {'LogicGridPuzzleModel': example}): 
-          logs['n_matchedcall'] += 1
-      else: 
-        continue 
-
-    print(f'Step {ind}: [n_goodcalls: {logs["n_goodcalls"]}, n_badcalls: {logs["n_badcalls"]}, n_matchedcall: {logs["n_matchedcall"]}]')
-
-    save(logs, f'{model_name}_logicgridpuzzle.json')
-
-  return logs
-
-def PhysicsQuestions(model_name, get_prompt, llm, verbose=False, **kwargs):
-  file_ = json.load(open('./data/physics_questions.json'))
-
-  logs = {'n_badcalls': 0, 'n_calls': 0, 'n_goodcalls': 0, 'n_matchedcall': 0, 'responses': [], 'expected': []} 
+      response = llm(prompt, grammar=manager.get_grammar(model), stop_at=template.stop_at)
+      if not response: 
+        return None
 
-  for ind, example in enumerate(file_['examples'][:n]): 
-    with Constrain('json') as manager: 
-      template = get_prompt(**kwargs)
-      prompt = manager.format(template,  
-        placeholders={
-          "instructions": file_['description'],
-          "prompt": example['input']
-        },
-        grammars=[{
-          'description': ' ', 
-          'model': PhysicsQuestionsModel
-        }],
-      )
-
-      if verbose: 
+      if verbose:
+        print(response)
         print('-------------------')
-      response = llm(prompt, grammar=manager.get_grammar(PhysicsQuestionsModel), stop_at=template.stop_at)
-      if response: 
-        if verbose:
-          print(response)
-          print('-------------------')
-        logs['responses'].append(response)
-        logs['n_calls'] += 1
-        response = manager.parse(response)
-        if verbose:
-          print(response)
-          print('-------------------')
-        if isinstance(response, Response):
-          logs['n_goodcalls'] += 1
-        else: 
-          logs['n_badcalls'] += 1
-          
-        del example['input']
-        logs['expected'].append({'PhysicsQuestionsModel': example})
-
-        # Response object always uses Model name at the topmost level. This is required for context-based multi-TOML parsing.
-        # I'm adding 'h' to the keys to match the model. Pydantic doesn't let me allot numbers as field names. 
-        if check_response(response, {'PhysicsQuestionsModel': example}): 
-          logs['n_matchedcall'] += 1
+      record = {'n_calls': 1, 'response': response}
+      response = manager.parse(response)
+      if verbose:
+        print(response)
+        print('-------------------')
+      if isinstance(response, Response):
+        record['n_goodcalls'] = 1
       else: 
-        continue
+        record['n_badcalls'] = 1
 
-    print(f'Step {ind}: [n_goodcalls: {logs["n_goodcalls"]}, n_badcalls: {logs["n_badcalls"]}, n_matchedcall: {logs["n_matchedcall"]}]')
-    save(logs, f'{model_name}_physicsquestions.json')
-
-  return logs
-
-def ReasoningAboutColors(model_name, get_prompt, llm, verbose=False, **kwargs):
-  file_ = json.load(open('./data/reasoning_about_colors.json'))
+      expected = {key: value for key, value in example.items() if key not in drop}
+      record['expected'] = {model_key: expected}
 
-  logs = {'n_badcalls': 0, 'n_calls': 0, 'n_goodcalls': 0, 'n_matchedcall': 0, 'responses': [], 'expected': []} 
+      # Response object always uses Model name at the topmost level. This is required for context-based multi-TOML parsing.
+      # I'm adding 'h' to the keys to match the model. Pydantic doesn't let me allot numbers as field names. 
+      if check_response(response, {model_key: expected}): 
+        record['n_matchedcall'] = 1
+      return record
 
-  for ind, example in enumerate(file_['examples'][:n]): 
-    with Constrain('json') as manager: 
-      template = get_prompt(**kwargs)
-      prompt = manager.format(template,
-        placeholders={
-          "instructions": file_['description'],
-          "prompt": example['input']
-        },
-        grammars=[{
-          'description': ' ', 
-          'model': Colors
-        }],
-      )
+  return Runner(f'./results/{model_name}_{task}.jsonl', step, workers=workers).run(file_['examples'][:n])
 
-      if verbose: 
-        print('-------------------')
-      response = llm(prompt, grammar=manager.get_grammar(Colors), stop_at=template.stop_at)
-      if response: 
-        if verbose:
-          print(response)
-          print('-------------------')
-        logs['responses'].append(response)
-        logs['n_calls'] += 1
-        response = manager.parse(response)
-        if verbose:
-          print(response)
-          print('-------------------')
-        if isinstance(response, Response):
-          logs['n_goodcalls'] += 1
-        else: 
-          logs['n_badcalls'] += 1
-          
-        del example['input']
-        del example['comment']
-        logs['expected'].append({'Colors': example})
+def StrategyQA(model_name, get_prompt, llm, verbose=False, **kwargs):
+  return run_task(model_name, 'stategyqa', './data/strategy_qa.json', 'json', StrategyQAModel, 'Response', get_prompt, llm, verbose, **kwargs)
 
-        # Response object always uses Model name at the topmost level. This is required for context-based multi-TOML parsing.
-        # I'm adding 'h' to the keys to match the model. Pydantic doesn't let me allot numbers as field names. 
-        if check_response(response, {'Colors': example}): 
-          logs['n_matchedcall'] += 1
-      else: 
-        continue
+def LogicGridPuzzle(model_name, get_prompt, llm, verbose=False, **kwargs):
+  return run_task(model_name, 'logicgridpuzzle', './data/logic_grid_puzzle.json', 'xml', LogicGridPuzzleModel, 'Response', get_prompt, llm, verbose, **kwargs)
 
-    print(f'Step {ind}: [n_goodcalls: {logs["n_goodcalls"]}, n_badcalls: {logs["n_badcalls"]}, n_matchedcall: {logs["n_matchedcall"]}]')
-    save(logs, f'{model_name}_physicsquestions.json')
+def PhysicsQuestions(model_name, get_prompt, llm, verbose=False, **kwargs):
+  return run_task(model_name, 'physicsquestions', './data/physics_questions.json', 'json', PhysicsQuestionsModel, ' ', get_prompt, llm, verbose, **kwargs)
 
-  return logs
+def ReasoningAboutColors(model_name, get_prompt, llm, verbose=False, **kwargs):
+  return run_task(model_name, 'reasoningaboutcolors', './data/reasoning_about_colors.json', 'json', Colors, ' ', get_prompt, llm, verbose, drop=('input', 'comment'), **kwargs)
 
 if __name__ == '__main__':
   models = { 
@@ -0,0 +1,137 @@
+import json
+import mmap
+import os
+import tempfile
+import numpy as np
+
+
+def scan_json_array(buffer):
+  '''
+  (start, end) byte offsets of each element of the top-level JSON array in `buffer`.
+  The bytes are decoded as latin-1, which maps byte offsets 1:1 to character offsets; JSON's structural characters are ASCII,
+  so `raw_decode` finds the right element boundaries even though string contents come out garbled (they're thrown away).
+  '''
+  text = str(buffer, "latin-1")
+  decoder = json.JSONDecoder()
+  offsets = []
+
+  pos = text.index("[") + 1
+  while True:
+    while text[pos].isspace():
+      pos += 1
+    if text[pos] == "]":
+      break
+    _, end = decoder.raw_decode(text, pos)
+    offsets.append((pos, end))
+    pos = end
+    while text[pos].isspace():
+      pos += 1
+    if text[pos] == ",":
+      pos += 1
+    elif text[pos] != "]":
+      raise ValueError(f"Expected ',' or ']' at byte {pos}")
+  return offsets
+
+
+def scan_json_lines(buffer):
+  '''
+  (start, end) byte offsets of each non-blank line of a JSONL `buffer`.
+  '''
+  offsets = []
+  start = 0
+  while start < len(buffer):
+    end = buffer.find(b"\n", start)
+    if end < 0:
+      end = len(buffer)
+    if buffer[start:end].strip():
+      offsets.append((start, end))
+    start = end + 1
+  return offsets
+
+
+class IndexedDataset:
+  '''
+  Read-only view of a split file (a JSON array, or JSONL) that decodes one record per access.
+
+  The record offsets are found by one scan of the file and saved next to it as `<file>.idx.npy`, keyed by the file's size and mtime,
+  so later processes skip the scan. Both the data file and the index are memory mapped: workers share the OS page cache
+  instead of each holding the parsed split. `dataset[i]` is the tuple of `fields` of record i (None for a missing field).
+  '''
+
+  def __init__(self, path, fields, jsonl=None):
+    self.path = path
+    self.fields = tuple(fields)
+    self.jsonl = path.endswith(".jsonl") if jsonl is None else jsonl
+    self.index_path = path + ".idx.npy"
+    self._buffer = None
+    self.offsets = self.load_index()
+
+  def load_index(self):
+    stat = os.stat(self.path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    try:
+      index = np.load(self.index_path, mmap_mode="r")
+      if tuple(int(x) for x in index[0]) == key:
+        return index[1:]  # Row 0 is the key of the file the index was built from
+    except (OSError, ValueError, IndexError):
+      pass  # Missing, stale or half-written: rebuild
+
+    scan = scan_json_lines if self.jsonl else scan_json_array
+    index = np.array([key] + scan(self.buffer), dtype=np.int64).reshape(-1, 2)
+    self.save_index(index)
+    return index[1:]
+
+  def save_index(self, index):
+    # Several workers may build the index at once; each replaces it atomically with the same content
+    try:
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_path)), suffix=".tmp")
+    except OSError:
+      return  # Read-only data directory: keep the index in memory only
+    try:
+      with os.fdopen(fd, "wb") as f:
+        np.save(f, index)
+      os.replace(tmp_path, self.index_path)
+    except OSError:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+  @property
+  def buffer(self):
+    # Mapped on first use; a pickled copy (eg. sent to a spawned worker) maps the file again on its side
+    if self._buffer is None:
+      with open(self.path, "rb") as f:
+        self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return self._buffer
+
+  def record(self, idx):
+    '''
+    The full decoded record at `idx`.
+    '''
+    start, end = self.offsets[idx]
+    return json.loads(self.buffer[int(start):int(end)].decode("utf-8"))
+
+  def __getitem__(self, idx):
+    record = self.record(idx)
+    return tuple(record.get(field) for field in self.fields)
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __iter__(self):
+    for idx in range(len(self)):
+      yield self[idx]
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["_buffer"] = None
+    state["offsets"] = None
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.offsets = self.load_index()
+
+  def close(self):
+    if self._buffer is not None:
+      self._buffer.close()
+      self._buffer = None
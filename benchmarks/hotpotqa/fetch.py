@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def digest(data):
+  return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class CachedFetcher:
+  '''
+  GETs pages through pooled keep-alive sessions (one per thread) with timeouts, and caches them on disk.
+
+  The cache is content-addressed: `blobs/<sha256 of text>` holds each distinct text once, and `index/<sha256 of key>.json`
+  maps a URL (raw page) or a URL + cleaner version (cleaned page) to its blob. Entries older than `ttl` seconds are refetched.
+  When the blobs exceed `max_bytes`, the least recently used ones are evicted. `cache_dir=None` disables the disk cache.
+  '''
+
+  def __init__(self, cache_dir="./cache/wiki", ttl=7 * 24 * 3600, max_bytes=512 * 1024 * 1024, timeout=(5, 30), pool_size=16, headers=None):
+    self.cache_dir = cache_dir
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.timeout = timeout
+    self.pool_size = pool_size
+    self.headers = headers or {"User-Agent": "grammarflow-benchmarks/0.1"}
+
+    self.hits = 0
+    self.misses = 0
+    self.fetch_time = 0
+    self.num_fetches = 0
+    self.num_errors = 0
+
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._size = 0
+
+    if cache_dir:
+      os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+      os.makedirs(os.path.join(cache_dir, "index"), exist_ok=True)
+      self._size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(cache_dir, "blobs")))
+
+  @property
+  def session(self):
+    session = getattr(self._local, "session", None)
+    if session is None:
+      session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=2)
+      session.mount("http://", adapter)
+      session.mount("https://", adapter)
+      session.headers.update(self.headers)
+      self._local.session = session
+    return session
+
+  def get(self, url):
+    '''
+    Raw text of `url`. Raises `requests.RequestException` (error statuses included) if it can't be fetched; failures aren't cached.
+    '''
+    text = self._read(url)
+    if text is not None:
+      self.hits += 1
+      return text
+
+    self.misses += 1
+    old_time = time.time()
+    try:
+      response = self.session.get(url, timeout=self.timeout)
+      response.raise_for_status()
+    except requests.RequestException:
+      self.num_errors += 1
+      raise
+    text = response.text
+    self.fetch_time += time.time() - old_time
+    self.num_fetches += 1
+
+    self._write(url, text)
+    return text
+
+  def get_clean(self, url, clean, version="1"):
+    '''
+    `clean(raw text)` for `url`, where the result is JSON-serializable. Cached separately from the raw page, so a hit skips the parsing too.
+    Bump `version` when `clean` changes.
+    '''
+    key = f"{url}#clean-{version}"
+    cached = self._read(key)
+    if cached is not None:
+      self.hits += 1
+      return json.loads(cached)
+
+    value = clean(self.get(url))
+    self._write(key, json.dumps(value))
+    return value
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      "cache_hits": self.hits,
+      "cache_misses": self.misses,
+      "cache_hit_rate": self.hits / lookups if lookups else 0,
+      "cache_bytes": self._size,
+      "fetch_time": self.fetch_time,
+      "num_fetches": self.num_fetches,
+      "num_fetch_errors": self.num_errors,
+    }
+
+  def _index_path(self, key):
+    return os.path.join(self.cache_dir, "index", digest(key) + ".json")
+
+  def _blob_path(self, blob):
+    return os.path.join(self.cache_dir, "blobs", blob)
+
+  def _read(self, key):
+    if not self.cache_dir:
+      return None
+    index_path = self._index_path(key)
+    try:
+      with open(index_path, "r") as f:
+        entry = json.load(f)
+      if time.time() - entry["time"] > self.ttl:
+        return None
+      blob_path = self._blob_path(entry["blob"])
+      with open(blob_path, "r", encoding="utf-8") as f:
+        text = f.read()
+      os.utime(blob_path)  # Recently used; eviction goes by mtime
+      return text
+    except (OSError, ValueError, KeyError):
+      return None  # Missing, expired, evicted or half-written
+
+  def _write(self, key, text):
+    if not self.cache_dir:
+      return
+    blob = digest(text)
+    blob_path = self._blob_path(blob)
+    if not os.path.exists(blob_path):
+      self._atomic_write(blob_path, text)
+      with self._lock:
+        self._size += len(text.encode("utf-8"))
+    self._atomic_write(self._index_path(key), json.dumps({"key": key, "blob": blob, "time": time.time()}))
+
+    if self._size > self.max_bytes:
+      self.evict()
+
+  def _atomic_write(self, path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+      with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+      os.replace(tmp_path, path)
+    except OSError:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+  def evict(self):
+    '''
+    Removes least recently used blobs until the cache is under 90% of `max_bytes`. Index entries pointing at them become misses.
+    '''
+    with self._lock:
+      blobs = sorted(os.scandir(os.path.join(self.cache_dir, "blobs")), key=lambda entry: entry.stat().st_mtime)
+      size = sum(entry.stat().st_size for entry in blobs)
+      for entry in blobs:
+        if size <= self.max_bytes * 0.9:
+          break
+        try:
+          size -= entry.stat().st_size
+          os.remove(entry.path)
+        except OSError:
+          pass
+      self._size = size
@@ -1,9 +1,12 @@
 import ast
 import json
+import re
 import time
+from collections import OrderedDict, defaultdict
 import gym
 import requests
 from bs4 import BeautifulSoup
+from fetch import CachedFetcher
 
 # import wikipedia
 
@@ -17,14 +20,96 @@ class textSpace(gym.spaces.Space):
     return isinstance(x, str)
 
 
+_WORD = re.compile(r"\w+")
+
+
+def split_sentences(page):
+  # find all paragraphs
+  paragraphs = page.split("\n")
+  paragraphs = [p.strip() for p in paragraphs if p.strip()]
+
+  # find all sentence
+  sentences = []
+  for p in paragraphs:
+    sentences += p.split('. ')
+  return [s.strip() + '.' for s in sentences if s.strip()]
+
+
+class PageIndex:
+  """
+    Sentence table of one page, split once when the page loads, and an inverted word index built on its first lookup.
+    `lookup(keyword)` returns the sentences containing `keyword` (case-insensitive substring, as before),
+    checking only sentences that hold every word of the keyword. Results are memoized per keyword.
+  """
+
+  def __init__(self, page):
+    self.sentences = split_sentences(page)
+    self.lowered = None
+    self.postings = None  # word -> ids of the sentences containing it, ascending
+    self.results = {}
+
+  def build(self):
+    # Deferred to the first lookup: most pages are only searched, never looked up
+    self.lowered = [s.lower() for s in self.sentences]
+    self.postings = defaultdict(list)
+    for i, sentence in enumerate(self.lowered):
+      for word in set(_WORD.findall(sentence)):
+        self.postings[word].append(i)
+
+  def lookup(self, keyword):
+    keyword = keyword.lower()
+    result = self.results.get(keyword)
+    if result is None:
+      if self.postings is None:
+        self.build()
+      candidates = self.candidates(keyword)
+      if candidates is None:
+        candidates = range(len(self.lowered))
+      result = self.results[keyword] = [self.sentences[i] for i in candidates if keyword in self.lowered[i]]
+    return result
+
+  def candidates(self, keyword):
+    # Each word of the keyword must be a word of the sentence. The first and last may be cut off by the keyword's edges,
+    # so for those the match is a suffix / prefix / substring of a sentence word instead.
+    matches = list(_WORD.finditer(keyword))
+    if not matches:
+      return None  # Punctuation only: scan
+
+    candidates = None
+    for match in matches:
+      token = match.group()
+      left, right = match.start() > 0, match.end() < len(keyword)
+      if left and right:
+        ids = set(self.postings.get(token, ()))  # .get: don't grow the defaultdict
+      else:
+        if left:
+          words = [w for w in self.postings if w.startswith(token)]
+        elif right:
+          words = [w for w in self.postings if w.endswith(token)]
+        else:
+          words = [w for w in self.postings if token in w]
+        ids = set()
+        for word in words:
+          ids.update(self.postings[word])
+      candidates = ids if candidates is None else candidates & ids
+      if not candidates:
+        break
+    return sorted(candidates)
+
+
 class WikiEnv(gym.Env):
 
-  def __init__(self):
+  def __init__(self, fetcher=None, base_url="https://en.wikipedia.org"):
     """
       Initialize the environment.
+      `fetcher` can be shared between environments to share connections and the page cache.
     """
     super().__init__()
+    self.fetcher = fetcher if fetcher is not None else CachedFetcher()
+    self.base_url = base_url
     self.page = None  # current Wikipedia page
+    self.page_index = None  # sentences and word index of the current page
+    self.page_indexes = OrderedDict()  # page -> PageIndex, most recent last
     self.obs = None  # current observation
     self.lookup_keyword = None  # current lookup keyword
     self.lookup_list = None  # list of paragraphs containing current lookup keyword
@@ -47,6 +132,7 @@ class WikiEnv(gym.Env):
     self.obs = ("Interact with Wikipedia using search[], lookup[], and "
                 "finish[].\n")
     self.page = None
+    self.page_index = None
     self.lookup_keyword = None
     self.lookup_list = None
     self.lookup_cnt = None
@@ -57,34 +143,23 @@ class WikiEnv(gym.Env):
     return (observation, info) if return_info else observation
 
   def construct_lookup_list(self, keyword):
-    # find all paragraphs
     if self.page is None:
       return []
-    paragraphs = self.page.split("\n")
-    paragraphs = [p.strip() for p in paragraphs if p.strip()]
-
-    # find all sentence
-    sentences = []
-    for p in paragraphs:
-      sentences += p.split('. ')
-    sentences = [s.strip() + '.' for s in sentences if s.strip()]
+    return self.page_index.lookup(keyword)
 
-    parts = sentences
-    parts = [p for p in parts if keyword.lower() in p.lower()]
-    return parts
+  def index_page(self, page):
+    # Recently seen pages keep their index, since the same entities are searched across questions
+    index = self.page_indexes.pop(page, None)
+    if index is None:
+      index = PageIndex(page)
+    self.page_indexes[page] = index
+    while len(self.page_indexes) > 32:
+      self.page_indexes.popitem(last=False)
+    return index
 
   @staticmethod
   def get_page_obs(page):
-    # find all paragraphs
-    paragraphs = page.split("\n")
-    paragraphs = [p.strip() for p in paragraphs if p.strip()]
-
-    # find all sentence
-    sentences = []
-    for p in paragraphs:
-      sentences += p.split('. ')
-    sentences = [s.strip() + '.' for s in sentences if s.strip()]
-    return ' '.join(sentences[:5])
+    return ' '.join(split_sentences(page)[:5])
 
     # ps = page.split("\n")
     # ret = ps[0]
@@ -95,31 +170,44 @@ class WikiEnv(gym.Env):
     #     break
     # return ret
 
+  @staticmethod
+  def parse_search(response_text):
+    # Cleaned once per page and cached by the fetcher, so repeated searches skip BeautifulSoup too
+    soup = BeautifulSoup(response_text, features="html.parser")
+    result_divs = soup.find_all("div", {"class": "mw-search-result-heading"})
+    if result_divs:  # mismatch
+      return {"titles": [clean_str(div.get_text().strip()) for div in result_divs]}
+    page = [p.get_text().strip() for p in soup.find_all("p") + soup.find_all("ul")]
+    if any("may refer to:" in p for p in page):
+      return {"disambiguation": True}
+    text = ""
+    for p in page:
+      if len(p.split(" ")) > 2:
+        text += clean_str(p)
+        if not p.endswith("\n"):
+          text += "\n"
+    return {"page": text}
+
   def search_step(self, entity):
     entity_ = entity.replace(" ", "+")
-    search_url = f"https://en.wikipedia.org/w/index.php?search={entity_}"
+    search_url = f"{self.base_url}/w/index.php?search={entity_}"
     old_time = time.time()
-    response_text = requests.get(search_url).text
+    try:
+      result = self.fetcher.get_clean(search_url, self.parse_search)
+    except requests.RequestException:
+      result = {"titles": []}  # Wikipedia unreachable or erroring: the agent sees a failed search, not a crash
     self.search_time += time.time() - old_time
     self.num_searches += 1
-    soup = BeautifulSoup(response_text, features="html.parser")
-    result_divs = soup.find_all("div", {"class": "mw-search-result-heading"})
-    if result_divs:  # mismatch
-      self.result_titles = [clean_str(div.get_text().strip()) for div in result_divs]
+    if "titles" in result:
+      self.result_titles = result["titles"]
       self.obs = f"Could not find {entity}. Similar: {self.result_titles[:5]}."
+    elif result.get("disambiguation"):
+      self.search_step("[" + entity + "]")
     else:
-      page = [p.get_text().strip() for p in soup.find_all("p") + soup.find_all("ul")]
-      if any("may refer to:" in p for p in page):
-        self.search_step("[" + entity + "]")
-      else:
-        self.page = ""
-        for p in page:
-          if len(p.split(" ")) > 2:
-            self.page += clean_str(p)
-            if not p.endswith("\n"):
-              self.page += "\n"
-        self.obs = self.get_page_obs(self.page)
-        self.lookup_keyword = self.lookup_list = self.lookup_cnt = None
+      self.page = result["page"]
+      self.page_index = self.index_page(self.page)
+      self.obs = ' '.join(self.page_index.sentences[:5])
+      self.lookup_keyword = self.lookup_list = self.lookup_cnt = None
   
   def step(self, action):
     reward = 0
@@ -165,4 +253,5 @@ class WikiEnv(gym.Env):
         "call_speed": speed,
         "call_time": self.search_time,
         "num_calls": self.num_searches,
+        **self.fetcher.stats(),
     }
@@ -5,6 +5,7 @@ import numpy as np
 import re
 import string
 from collections import Counter
+from dataset import IndexedDataset
 
     
 DATA_DIR = "data"
@@ -104,8 +105,7 @@ class HotPotQAWrapper(gym.Wrapper):
   def __init__(self, env, split):
     super().__init__(env)
     data_file = f"{DATA_DIR}/{HOTPOTQA_SPLIT_FILE[split]}"
-    self.data = json.load(open(data_file))
-    self.data = [(d['question'], d['answer']) for d in self.data]
+    self.data = IndexedDataset(data_file, ('question', 'answer'))
     self.data_idx = 0
     self.split = split
 
@@ -164,17 +164,7 @@ class FeverWrapper(gym.Wrapper):
     super().__init__(env)
     
     data_path = f"./data/{FEVER_SPLIT_FILE[split]}"
-    with open(data_path, "r") as json_file:
-      json_list = list(json_file)
-
-    data = []
-    for json_str in json_list:
-      json_str = json.loads(json_str)
-      label = json_str["label"]
-      claim = json_str["claim"]
-      data.append((claim, label))
-
-    self.data = data
+    self.data = IndexedDataset(data_path, ('claim', 'label'))
     self.data_idx = 0
     self.split = split
 
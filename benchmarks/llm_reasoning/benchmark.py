@@ -5,8 +5,14 @@ from grammarflow.grammars.template import *
 from grammarflow.tools.response import Response
 import pandas as pd
 import json 
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from runner import Runner
 
 n = 200
+workers = 4  # Each LocalLlama call runs its own llama.cpp process (and loads the model); keep within what fits in memory
 
 def check_response(response, example, only_structure=True):
   for key, value in example.items(): 
@@ -20,95 +26,57 @@ def check_response(response, example, only_structure=True):
       return False
   return True
 
-def save(logs, path):
-  with open(f'./results/{path}', 'w') as f: 
-    f.write(json.dumps(logs, indent=2))
-
-def load(path):
-  try: 
-    with open(f'./results/{path}', 'r') as f: 
-      a = json.load(f)
-    return a
-  except: 
-    return None
-
 def RandomTrue(model_name, get_prompt, llm, verbose=False, **kwargs):
   file_ = json.load(open('./data/345_random_true.json'))
-
-  count = 1
-
-  logs = load(f'{model_name}.json')
-  if not logs: 
-    logs = {'n_badcalls': 0, 'n_calls': 0, 'n_goodcalls': 0, 'n_matchedcall': 0, 'answer': [], 'gt': []}
-  
-  already_complete = logs['n_calls']
-
-  for example_ in list(file_.keys()):  
-    for example__ in file_[example_]:
-
-      if count < already_complete:
-        count += 1
-        continue
-
-      row = file_[example_][example__]
-      
-      with Constrain('json') as manager: 
-        template = get_prompt(**kwargs)
-        prompt = manager.format(template, 
-          placeholders={
-            "instructions": "You are a professor of various practices. You like to think through the steps you take in solving your goal. You will be presented with a 'goal'. Solve it by iteratively making observations.",
-            "prompt": f"Facts: {row['question']}\n Goal: {row['query']}"
-          },
-          grammars=[{
-            'description': 'Response', 
-            'model': CoT
-          }],
-        )
-
-        if verbose: 
-          print(manager.prompt)
-          print('-------------------')
-        response = llm(prompt, grammar=manager.get_grammar(CoT), stop_at=template.stop_at)
-        if response: 
-          if verbose:
-            print(response)
-            print('-------------------')
-          logs['n_calls'] += 1
-          response = manager.parse(response)
-          if verbose:
-            print(response)
-            print('-------------------')
-          if isinstance(response, Response):
-            logs['n_goodcalls'] += 1
-          else: 
-            with open(f'./results/{model_name}_error.txt', 'a') as f: 
-              f.write(f'{row["question"]}\n{row["query"]}\n{response}\n\n')
-              f.write('-------------------\n')
-            logs['n_badcalls'] += 1
-            
-          del row['question'], row['query']
-          answer = None 
-
-          row['answer'] = eval(row['answer'])
-          if check_response(response, {'CoT': row}): 
-            logs['n_matchedcall'] += 1
-            answer = response.CoT.answer
-        else:
-          answer = None 
-          continue
-        
-      print(f'Step {count}: [result: {answer}, expected: {row['answer']}, n_goodcalls: {logs["n_goodcalls"]}, n_badcalls: {logs["n_badcalls"]}, n_matchedcall: {logs["n_matchedcall"]}]')
-      logs['answer'].append(answer)
-      logs['gt'].append(row['answer'])
-      
-      save(logs, f'{model_name}.json')
-
-      count += 1
-
-      if count > n: 
-        return logs 
-
-  return logs 
+  rows = [row for example_ in file_.values() for row in example_.values()][:n]
+
+  def step(row):
+    with Constrain('json') as manager: 
+      template = get_prompt(**kwargs)
+      prompt = manager.format(template, 
+        placeholders={
+          "instructions": "You are a professor of various practices. You like to think through the steps you take in solving your goal. You will be presented with a 'goal'. Solve it by iteratively making observations.",
+          "prompt": f"Facts: {row['question']}\n Goal: {row['query']}"
+        },
+        grammars=[{
+          'description': 'Response', 
+          'model': CoT
+        }],
+      )
+
+      if verbose: 
+        print(prompt)
+        print('-------------------')
+      response = llm(prompt, grammar=manager.get_grammar(CoT), stop_at=template.stop_at)
+      if not response: 
+        return None
+
+      if verbose:
+        print(response)
+        print('-------------------')
+      record = {'n_calls': 1}
+      parsed = manager.parse(response)
+      if verbose:
+        print(parsed)
+        print('-------------------')
+      if isinstance(parsed, Response):
+        record['n_goodcalls'] = 1
+      else: 
+        record['n_badcalls'] = 1
+        record['error'] = {'question': row['question'], 'query': row['query'], 'response': response}
+
+      expected = {key: value for key, value in row.items() if key not in ('question', 'query')}
+      expected['answer'] = eval(row['answer'])
+      answer = None 
+      if check_response(parsed, {'CoT': expected}): 
+        record['n_matchedcall'] = 1
+        answer = parsed.CoT.answer
+
+      record['answer'] = answer
+      record['gt'] = expected['answer']
+      return record
+
+  return Runner(f'./results/{model_name}.jsonl', step, workers=workers).run(rows)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+from grammarflow.constrain import Constrain
+from pydantic import BaseModel, Field
+import json
+import time
+
+n = 100_000
+
+
+class Score(BaseModel):
+  yes: int = Field(..., description="Options: 1 | 0")
+  no: int = Field(..., description="Options: 1 | 0")
+
+class StrategyQAModel(BaseModel):
+  target_scores: Score
+  target: str = Field(..., description="Reasoning for your above answer")
+
+class AgentStep(BaseModel):
+  thought: str
+  action: str
+  action_input: str
+
+MODELS = [StrategyQAModel, AgentStep]
+
+def make_outputs():
+  outputs = []
+  for i in range(n):
+    if i % 2:
+      obj = {'StrategyQAModel': {'target_scores': {'yes': i % 2, 'no': 1 - i % 2}, 'target': f'reason {i}'}}
+    else:
+      obj = {'AgentStep': {'thought': f'thought {i}', 'action': 'search', 'action_input': f'entity {i}'}}
+    outputs.append(f"```json\n{json.dumps(obj)}\n```")
+  return outputs
+
+def validate_by_trying(response):
+  # What callers did before: try every model on the untyped Response
+  data = response._data
+  for model in MODELS:
+    if model.__name__ in data:
+      try:
+        return model.parse_obj(data[model.__name__])
+      except ValueError:
+        continue
+  return None
+
+if __name__ == '__main__':
+  outputs = make_outputs()
+
+  with Constrain('json') as manager:
+    start = time.perf_counter()
+    manual = [validate_by_trying(manager.parse(output)) for output in outputs]
+    manual_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    typed = manager.parse_many(outputs, models=MODELS)
+    typed_time = time.perf_counter() - start
+
+  assert manual == typed
+  print(f"{n} outputs")
+  print(f"parse + manual validation: {manual_time:.2f}s ({n / manual_time:,.0f}/s)")
+  print(f"parse_many(models=...):    {typed_time:.2f}s ({n / typed_time:,.0f}/s)")
@@ -0,0 +1,33 @@
+from grammarflow.grammars.json import JSON
+import json
+import time
+
+n = 50
+
+
+def make_output(n_fields, lenient=False):
+  body = {f"field-{i}": (f"value number {i} " * 5 if i % 3 else [i, i * 1.5, True]) for i in range(n_fields)}
+  body["nested"] = {"inner-key": "text", "count": n_fields}
+  text = json.dumps({"Model": body})
+  if lenient:
+    text = text.replace("true", "True").replace(", \"nested\"", " \"nested\"")  # Python literal + missing comma
+  return f"Here is the output: {text}"
+
+def timeit(fn, text):
+  start = time.perf_counter()
+  for _ in range(n):
+    fn(text)
+  return (time.perf_counter() - start) / n * 1e3
+
+if __name__ == '__main__':
+  print(f"{'fields':>7} {'KB':>8} {'input':>8} {'lenient ms':>11} {'tiered ms':>10} {'speedup':>8}")
+  for n_fields in [10, 100, 1_000, 10_000]:
+    for lenient in [False, True]:
+      text = make_output(n_fields, lenient)
+      assert JSON.parse_json(text) == JSON.parse_lenient(text)
+      old = timeit(JSON.parse_lenient, text)
+      new = timeit(JSON.parse_json, text)
+      kind = "lenient" if lenient else "strict"
+      print(f"{n_fields:>7} {len(text) / 1024:>8.1f} {kind:>8} {old:>11.3f} {new:>10.3f} {old / new:>7.1f}x")
+
+  print(f"Tier usage: {JSON.stats}")
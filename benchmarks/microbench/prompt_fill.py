@@ -0,0 +1,38 @@
+from grammarflow.prompt.builder import Prompt
+import time
+
+n = 200
+
+
+def fill_replace(prompt, placeholders, **kwargs):
+  # Previous Prompt.fill: one str.replace over the whole prompt per placeholder
+  filled_prompt = prompt
+  for key, value in kwargs.items():
+    if key in placeholders:
+      filled_prompt = filled_prompt.replace(f"{{{key}}}", value)
+  return filled_prompt
+
+def make_prompt(n_placeholders, filler_size):
+  placeholders = [f"slot_{i}" for i in range(n_placeholders)]
+  filler = "grammar ::= rule | other-rule\n" * (filler_size // 30)
+  text = "".join(f"{filler}{{{name}}}\n" for name in placeholders)
+  values = {name: f"value for {name} " * 20 for name in placeholders}
+  return text, placeholders, values
+
+def timeit(fn):
+  start = time.perf_counter()
+  for _ in range(n):
+    fn()
+  return (time.perf_counter() - start) / n * 1e3
+
+if __name__ == '__main__':
+  print(f"{'placeholders':>12} {'prompt KB':>10} {'replace ms':>11} {'compiled ms':>12} {'speedup':>8}")
+  for n_placeholders, filler_size in [(2, 2_000), (4, 20_000), (8, 50_000), (16, 50_000), (32, 20_000)]:
+    text, placeholders, values = make_prompt(n_placeholders, filler_size)
+    prompt = Prompt(text, placeholders=placeholders)
+
+    assert prompt.fill(**values) == fill_replace(text, placeholders, **values)
+
+    old = timeit(lambda: fill_replace(text, placeholders, **values))
+    new = timeit(lambda: prompt.fill(**values))
+    print(f"{n_placeholders:>12} {len(text) / 1024:>10.1f} {old:>11.3f} {new:>12.3f} {old / new:>7.1f}x")
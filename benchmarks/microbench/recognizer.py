@@ -0,0 +1,46 @@
+from grammarflow.grammars.gnbf import GNBF
+from grammarflow.grammars.recognizer import GrammarRecognizer
+from pydantic import BaseModel, Field
+from typing import List
+import time
+
+n = 2_000
+
+
+class Score(BaseModel):
+  yes: int = Field(..., description="Options: 1 | 0")
+  no: int = Field(..., description="Options: 1 | 0")
+
+class StrategyQAModel(BaseModel):
+  target_scores: Score
+  target: str = Field(..., description="Reasoning for your above answer")
+  keywords: List[str]
+
+def make_output(i, length):
+  # Exactly what the grammar admits: generated grammars write '_' in names as '-', and `ws` is a single char
+  reason = ("because " * length)[:length]
+  return (' \n{"StrategyQAModel": { "target-scores": \n{ "yes": ' + str(i % 2) + ',\n"no": ' + str(1 - i % 2)
+          + '},\n"target": "' + reason + '",\n"keywords": [ "a", "b"] } }')
+
+if __name__ == '__main__':
+  grammar = GNBF(StrategyQAModel).generate_grammar('json')
+
+  start = time.perf_counter()
+  recognizer = GrammarRecognizer(grammar)
+  print(f"compile: {(time.perf_counter() - start) * 1e3:.2f} ms")
+
+  print(f"{'value length':>13} {'ns/char (cold)':>15} {'ns/char (warm)':>15}")
+  for length in [10, 100, 1000]:
+    outputs = [make_output(i, length) for i in range(n)]
+    chars = sum(len(output) for output in outputs)
+
+    cold = GrammarRecognizer(grammar)
+    start = time.perf_counter()
+    assert cold.match(outputs[0])
+    cold_ns = (time.perf_counter() - start) / len(outputs[0]) * 1e9
+
+    start = time.perf_counter()
+    assert all(recognizer.match(output) for output in outputs)
+    warm_ns = (time.perf_counter() - start) / chars * 1e9
+
+    print(f"{length:>13} {cold_ns:>15.0f} {warm_ns:>15.0f}")
@@ -0,0 +1,46 @@
+from grammarflow.tools.response import Response
+from grammarflow.tools.record import to_records
+from pydantic import BaseModel, Field
+import time
+import tracemalloc
+
+n = 20_000
+
+
+class Score(BaseModel):
+  yes: int = Field(..., description="Options: 1 | 0")
+  no: int = Field(..., description="Options: 1 | 0")
+
+class StrategyQAModel(BaseModel):
+  target_scores: Score
+  target: str = Field(..., description="Reasoning for your above answer")
+
+def make_parsed(i):
+  return {'StrategyQAModel': {'target_scores': {'yes': i % 2, 'no': 1 - i % 2}, 'target': f'reason {i}'}}
+
+def footprint(build):
+  tracemalloc.start()
+  kept = [build(make_parsed(i)) for i in range(n)]
+  # Parsed dicts are built inside the measurement for both, so the difference is the wrapper vs the record
+  current, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return current / n, kept
+
+def access_time(objects, read):
+  start = time.perf_counter()
+  total = 0
+  for obj in objects:
+    total += read(obj)
+  return (time.perf_counter() - start) / len(objects) * 1e9
+
+if __name__ == '__main__':
+  response_bytes, responses = footprint(Response)
+  record_bytes, records = footprint(lambda parsed: to_records(parsed, [StrategyQAModel]))
+
+  # check_response-style read of a nested field
+  response_ns = access_time(responses, lambda r: r.StrategyQAModel.target_scores.yes)
+  record_ns = access_time(records, lambda r: r.target_scores.yes)
+
+  print(f"{'':>10} {'bytes/object':>13} {'ns/nested read':>15}")
+  print(f"{'Response':>10} {response_bytes:>13.0f} {response_ns:>15.0f}")
+  print(f"{'Record':>10} {record_bytes:>13.0f} {record_ns:>15.0f}")
@@ -0,0 +1,279 @@
+'''
+Latency and allocation benchmark for grammarflow's own hot paths, over generated schemas.
+
+  python suite.py                       # run, print, save to results/<commit>.json
+  python suite.py --compare base.json   # also print the ratio against an earlier run
+  python suite.py --quick               # fewer repeats, for a smoke check
+
+Schemas are varied one axis at a time from a base model: field count, nesting depth, list-of-model fields and enum fields.
+A fake LLM returns a well-formed output for the requested model, so the whole format -> call -> parse session runs without a model.
+Each schema is checked first: its grammar must compile (no undefined rules) and its sample output must parse; failures are reported as errors.
+'''
+from grammarflow.constrain import Constrain
+from grammarflow.grammars.gnbf import GNBF
+from grammarflow.grammars.json import JSON
+from grammarflow.grammars.toml import TOML
+from grammarflow.grammars.xml import XML
+from grammarflow.prompt.builder import PromptBuilder
+from pydantic import BaseModel, Field, create_model
+from enum import Enum
+from typing import List
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+FORMATS = {'json': JSON, 'toml': TOML, 'xml': XML}
+BASE = {'fields': 8, 'depth': 1, 'lists': 0, 'enums': 0}
+AXES = {
+  'fields': [2, 8, 32, 128],
+  'depth': [0, 1, 3, 6],
+  'lists': [0, 1, 4],
+  'enums': [0, 1, 4],
+}
+
+repeats = 7
+target_ms = 20  # Each timed sample loops the stage for at least this long
+
+
+def make_model(fields, depth, lists, enums, prefix='Bench'):
+  '''
+  Builds a pydantic model with `fields` scalar fields, a chain of `depth` nested models, `lists` List[Item] fields and `enums` Enum fields.
+  '''
+  item = create_model(f'{prefix}Item', name=(str, Field(..., description='Item name')), score=(float, ...))
+  color = Enum(f'{prefix}Color', {'red': 'red', 'green': 'green', 'blue': 'blue'}, type=str)
+
+  scalar_types = [str, int, float, bool]
+  definitions = {}
+  for i in range(fields):
+    definitions[f'field_{i}'] = (scalar_types[i % len(scalar_types)], Field(..., description=f'Field number {i}'))
+  for i in range(lists):
+    definitions[f'items_{i}'] = (List[item], ...)
+  for i in range(enums):
+    # With a description, pydantic puts the Enum's $ref under allOf
+    definitions[f'color_{i}'] = (color, Field(..., description=f'Colour number {i}') if i % 2 == 0 else ...)
+
+  nested = None
+  for level in range(depth, 0, -1):
+    child = {'value': (int, ...), 'label': (str, ...)}
+    if nested is not None:
+      child['child'] = (nested, ...)
+    nested = create_model(f'{prefix}Level{level}', **child)
+  if nested is not None:
+    definitions['child'] = (nested, ...)
+
+  return create_model(f'{prefix}Model', **definitions)
+
+
+def sample_value(annotation):
+  if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+    return sample_data(annotation)
+  if isinstance(annotation, type) and issubclass(annotation, Enum):
+    return next(iter(annotation)).value
+  if getattr(annotation, '__origin__', None) in (list, List):
+    return [sample_value(annotation.__args__[0]) for _ in range(2)]
+  return {str: 'some text', int: 7, float: 0.5, bool: True}.get(annotation, 'x')
+
+
+def sample_data(model):
+  return {name: sample_value(field.outer_type_ if hasattr(field, 'outer_type_') else field.annotation)
+          for name, field in model.__fields__.items()}
+
+
+def to_toml_value(value):
+  if isinstance(value, dict):
+    return '{ ' + ', '.join(f'{k} = {to_toml_value(v)}' for k, v in value.items()) + ' }'
+  if isinstance(value, list):
+    return '[' + ', '.join(to_toml_value(v) for v in value) + ']'
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return json.dumps(value)
+
+
+def to_xml_value(value):
+  if isinstance(value, dict):
+    return ''.join(f'<{k}>{to_xml_value(v)}</{k}>' for k, v in value.items())
+  if isinstance(value, list):
+    return json.dumps(value) if not value or not isinstance(value[0], dict) else ''.join(f'<item>{to_xml_value(v)}</item>' for v in value)
+  return str(value)
+
+
+def serialize(model, format_):
+  data = sample_data(model)
+  name = model.__name__
+  if format_ == 'json':
+    body = json.dumps({name: data}, indent=2)
+  elif format_ == 'toml':
+    body = f'[{name}]\n' + '\n'.join(f'{k} = {to_toml_value(v)}' for k, v in data.items())
+  else:
+    body = f'<{name}>{to_xml_value(data)}</{name}>'
+  return f'```{format_}\n{body}\n```'
+
+
+class FakeLLM:
+  '''
+  Stands in for the model: returns a canned, well-formed output for `model` in `format_`, whatever the prompt.
+  '''
+
+  def __init__(self, model, format_):
+    self.output = serialize(model, format_)
+    self.calls = 0
+
+  def __call__(self, prompt, grammar=None, stop_at='', **kwargs):
+    self.calls += 1
+    return self.output
+
+
+def make_builder():
+  builder = PromptBuilder()
+  builder.add_section(text='You are a helpful assistant. {instructions}', placeholders=['instructions'])
+  builder.add_section(define_grammar=True)
+  builder.add_section(text='Question: {prompt}', placeholders=['prompt'])
+  return builder
+
+
+def stages(model, format_):
+  '''
+  (stage name, zero-argument callable) for every hot path, for one model and format.
+  '''
+  formatter = FORMATS[format_]
+  grammars = [{'description': 'Response', 'model': model}]
+  config = {'format': format_, 'return_sequence': 'single_response', 'grammars': grammars, 'examples': None, 'enable_on': None}
+  builder = make_builder()
+  output = serialize(model, format_)
+  llm = FakeLLM(model, format_)
+  placeholders = {'instructions': 'Answer in the format.', 'prompt': 'What is the answer?'}
+
+  def session():
+    with Constrain(format_) as manager:
+      prompt = manager.format(make_builder(), grammars, placeholders)
+      return manager.parse(llm(prompt, grammar=manager.get_grammar(model)))
+
+  return [
+    ('grammar', lambda: GNBF(model).generate_grammar(format_)),
+    ('make_format', lambda: formatter.make_format(grammars, 'single_response')),
+    ('build', lambda: builder.build(config)),
+    ('parse', lambda: formatter.parse(output)),
+    ('session', session),
+  ]
+
+
+def check(model, format_):
+  '''
+  Raises if the grammar for `model` references undefined rules, or if its sample output doesn't parse.
+  '''
+  GNBF.recognizer(GNBF(model).generate_grammar(format_, optimize=True))
+  parsed = FORMATS[format_].parse(serialize(model, format_))
+  assert model.__name__ in parsed, f'{model.__name__} missing from {parsed}'
+
+
+def measure(fn):
+  '''
+  Median microseconds per call over `repeats` samples, and peak / retained bytes of one call under tracemalloc.
+  '''
+  fn()  # Warm caches the real code path would also have warm
+  number = 1
+  while True:
+    start = time.perf_counter()
+    for _ in range(number):
+      fn()
+    elapsed = time.perf_counter() - start
+    if elapsed * 1e3 >= target_ms or number >= 1 << 20:
+      break
+    number *= 2
+
+  samples = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    for _ in range(number):
+      fn()
+    samples.append((time.perf_counter() - start) / number * 1e6)
+
+  tracemalloc.start()
+  before, _ = tracemalloc.get_traced_memory()
+  result = fn()
+  after, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del result
+
+  return {'us': statistics.median(samples), 'peak_kb': (peak - before) / 1024, 'retained_kb': (after - before) / 1024}
+
+
+def cases():
+  seen = set()
+  for axis, values in AXES.items():
+    for value in values:
+      params = dict(BASE, **{axis: value})
+      key = tuple(sorted(params.items()))
+      if key in seen:
+        continue
+      seen.add(key)
+      yield axis, params
+
+
+def run():
+  results = {}
+  for index, (axis, params) in enumerate(cases()):
+    model = make_model(**params, prefix=f'Bench{index}')
+    label = ','.join(f'{k}={v}' for k, v in params.items())
+    for format_ in FORMATS:
+      try:
+        check(model, format_)
+      except Exception as e:
+        results[f'{label}|{format_}|check'] = {'error': f'{type(e).__name__}: {e}'}
+      for stage, fn in stages(model, format_):
+        key = f'{label}|{format_}|{stage}'
+        try:
+          results[key] = measure(fn)
+        except Exception as e:  # A generator/parser bug for this shape is a result too
+          results[key] = {'error': f'{type(e).__name__}: {e}'}
+  return results
+
+
+def commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+
+
+def report(results, baseline=None):
+  print(f"{'case':<48} {'fmt':<5} {'stage':<12} {'us':>10} {'peak KB':>9} {'kept KB':>8}" + (f" {'vs base':>8}" if baseline else ''))
+  for key, value in results.items():
+    label, format_, stage = key.split('|')
+    if 'error' in value:
+      print(f"{label:<48} {format_:<5} {stage:<12} {value['error'][:60]}")
+      continue
+    line = f"{label:<48} {format_:<5} {stage:<12} {value['us']:>10.1f} {value['peak_kb']:>9.1f} {value['retained_kb']:>8.1f}"
+    if baseline:
+      base = baseline.get(key, {})
+      line += f" {value['us'] / base['us']:>7.2f}x" if 'us' in base else f" {'-':>8}"
+    print(line)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--save', default=None, help='Where to write results (default: results/<commit>.json)')
+  parser.add_argument('--compare', default=None, help='Earlier results file to compare against')
+  parser.add_argument('--quick', action='store_true')
+  args = parser.parse_args()
+
+  if args.quick:
+    repeats, target_ms = 3, 2
+
+  results = run()
+
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)['results']
+  report(results, baseline)
+
+  path = args.save or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f'{commit()}.json')
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as f:
+    json.dump({'commit': commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeats': repeats, 'results': results}, f, indent=2)
+  print(f'Saved to {path}')
@@ -0,0 +1,31 @@
+from grammarflow.grammars.toml import TOML
+import time
+
+n = 5
+
+
+def make_output(n_sections):
+  # Many concatenated [Model] sections, as returned for multi_response
+  sections = []
+  for i in range(n_sections):
+    sections.append(
+      f'[Step]\nthought = "step {i}: {"compare a = b, then think. " * 8}"\naction = "search"\nscore = {i * 0.5}\n'
+      f'done = {"true" if i % 2 else "false"}\nitems = [{i}, {i + 1}, "x"]\nmeta = {{id = {i}, tag = "t"}}\n'
+    )
+  return "".join(sections)
+
+def timeit(text):
+  start = time.perf_counter()
+  for _ in range(n):
+    result = TOML.parse(text)
+  return (time.perf_counter() - start) / n, result
+
+if __name__ == '__main__':
+  print(f"{'sections':>9} {'KB':>8} {'newlines':>9} {'ms':>9} {'MB/s':>7}")
+  for n_sections in [10, 100, 1_000, 10_000]:
+    for newlines in [True, False]:
+      # Constrain.parse strips newlines before parsing, so both layouts matter
+      text = make_output(n_sections) if newlines else make_output(n_sections).replace("\n", "")
+      elapsed, result = timeit(text)
+      assert len(result['Step']) == n_sections
+      print(f"{n_sections:>9} {len(text) / 1024:>8.1f} {str(newlines):>9} {elapsed * 1e3:>9.2f} {len(text) / elapsed / 1e6:>7.2f}")
@@ -0,0 +1,40 @@
+from grammarflow.grammars.xml import XML
+import time
+
+n = 5
+
+
+def make_output(n_objects):
+  # multi_response style: many model objects, each with nested and repeated tags
+  objects = []
+  for i in range(n_objects):
+    objects.append(
+      f"<Step>\n<thought> step {i}: if a < b then a <= b </thought>\n<action> search </action>\n"
+      f"<score><yes> {i % 2} </yes><no> {1 - i % 2} </no></score>\n"
+      f"<item> {i} </item><item> {i + 1} </item>\n</Step>"
+    )
+  return "\n".join(objects)
+
+def timeit(text):
+  start = time.perf_counter()
+  for _ in range(n):
+    result = XML.parse(text)
+  return (time.perf_counter() - start) / n * 1e3, result
+
+# Comparisons in leaf text must stay text, not open tags
+CHECKS = [
+  ('<Thought><thought>if a < b and c > d then</thought></Thought>', {'Thought': {'thought': 'if a < b and c > d then'}}),
+  ('<Thought><thought>if a<b and c > d then</thought><n>3</n></Thought>', {'Thought': {'thought': 'if a<b and c > d then', 'n': 3}}),
+]
+
+if __name__ == '__main__':
+  for text, expected in CHECKS:
+    assert XML.parse(text) == expected, (text, XML.parse(text))
+
+  print(f"{'objects':>8} {'elements':>9} {'KB':>8} {'ms':>9} {'us/element':>11}")
+  for n_objects in [100, 1_000, 5_000, 20_000]:
+    text = make_output(n_objects)
+    elapsed, result = timeit(text)
+    assert len(result['Step']) == n_objects
+    n_elements = n_objects * 8
+    print(f"{n_objects:>8} {n_elements:>9} {len(text) / 1024:>8.1f} {elapsed:>9.2f} {elapsed * 1e3 / n_elements:>11.3f}")
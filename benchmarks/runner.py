@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+
+COUNTERS = ('n_calls', 'n_goodcalls', 'n_badcalls', 'n_matchedcall')
+
+
+def load_records(path):
+  '''
+  Reads a results file written by `Runner`. A line cut short by a crash is skipped.
+  '''
+  records = []
+  if not os.path.exists(path):
+    return records
+  with open(path, 'r') as f:
+    for line in f:
+      try:
+        records.append(json.loads(line))
+      except json.JSONDecodeError:
+        continue
+  return records
+
+
+class Runner:
+  '''
+  Runs `step(example)` for every example on a pool of `workers` threads.
+  Each result is appended to `path` as one JSON line tagged with the example's index, and the file is flushed every `flush_every` results.
+  On restart, examples whose index is already in the file are skipped and the counters pick up where they were.
+
+  `step` returns a dict (the record) or None to skip the example. Its `COUNTERS` keys (0/1) are summed into the running totals.
+  '''
+
+  def __init__(self, path, step, workers=4, flush_every=10, verbose=True):
+    self.path = path
+    self.step = step
+    self.workers = workers
+    self.flush_every = flush_every
+    self.verbose = verbose
+
+    self.totals = dict.fromkeys(COUNTERS, 0)
+    self.done = set()
+    for record in load_records(path):
+      self.add(record)
+
+  def add(self, record):
+    self.done.add(record['index'])
+    for key in COUNTERS:
+      self.totals[key] += record.get(key, 0)
+
+  def run(self, examples):
+    pending = [(index, example) for index, example in enumerate(examples) if index not in self.done]
+    if self.verbose and self.done:
+      print(f'Resuming {self.path}: {len(self.done)} done, {len(pending)} left')
+
+    directory = os.path.dirname(self.path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+
+    with open(self.path, 'a+') as f, ThreadPoolExecutor(max_workers=self.workers) as pool:
+      if f.tell():
+        f.seek(f.tell() - 1)
+        if f.read(1) != '\n':
+          f.write('\n')  # Start after a line cut short by a crash
+      futures = {pool.submit(self.step, example): index for index, example in pending}
+      try:
+        self.collect(futures, f)
+      except BaseException:
+        for future in futures:
+          future.cancel()  # Don't wait for the whole queue before the error surfaces; resuming redoes them
+        raise
+
+    return dict(self.totals)
+
+  def collect(self, futures, f):
+    unflushed = 0
+    for future in as_completed(futures):
+      record = future.result()
+      if record is None:
+        continue
+
+      record['index'] = futures[future]
+      f.write(json.dumps(record) + '\n')
+      self.add(record)
+
+      unflushed += 1
+      if unflushed >= self.flush_every:
+        f.flush()
+        unflushed = 0
+
+      if self.verbose:
+        print(f'Step {len(self.done)}: [n_goodcalls: {self.totals["n_goodcalls"]}, n_badcalls: {self.totals["n_badcalls"]}, n_matchedcall: {self.totals["n_matchedcall"]}]')
@@ -1,5 +1,5 @@
-from .constrain import Constrain
-from .prompt.builder import Prompt, PromptBuilder
+from .constrain import Constrain, AsyncConstrain
+from .prompt.builder import Prompt, PromptBuilder, TokenBudget
 from .tools.response import Response
-from .tools.llm import LocalLlama, OpenAI
+from .tools.llm import LocalLlama, LlamaServer, OpenAI, AsyncLocalLlama, AsyncLlamaServer, AsyncOpenAI
 from .grammars.gnbf import GNBF
\ No newline at end of file
@@ -2,12 +2,21 @@ from .grammars.json import JSON
 from .grammars.toml import TOML
 from .grammars.xml import XML
 from .grammars.gnbf import GNBF
+from .grammars.stream import StreamParser, StreamEvent
+from .grammars.fences import iter_fences, join_lines
+from .grammars.recognizer import recognizer
 from .grammars.error import ParsingError, ConfigError  # pylint: disable=unused-import
-from .prompt.builder import Prompt, PromptBuilder
+from .prompt.builder import Prompt, PromptBuilder, TokenBudget
 from .tools.response import Response
-
-import re 
-from typing import Union, Dict, List 
+from .tools.cache import GrammarCache
+from .tools.record import to_records
+from .tools.validate import model_index
+from .tools.tokens import TokenCounter
+from .tools.history import History, DiskHistory, make_history
+
+import asyncio
+import itertools
+from typing import Union, Dict, List, Iterable, AsyncIterable, Callable 
 from pydantic import BaseModel 
 
 
@@ -16,14 +25,24 @@ class Constrain:
     Context Manager initialized using `with` statement. 
     ''' 
 
+    # Shared across instances, since a new manager is usually opened per request.
+    # Replace with `GrammarCache(cache_dir=...)` to keep grammars across restarts.
+    grammar_cache = GrammarCache()
+    # Shared for the same reason; replace with `TokenCounter("offline")` (or any tokenizer) to count without tiktoken.
+    token_counter = TokenCounter()
 
-    def __init__(self, format_: str ='json', return_sequence: str ='single_response'):
+    def __init__(self, format_: str ='json', return_sequence: str ='single_response', history: Union[None, bool, int, str, History, DiskHistory] = None):
         """ 
         Initializes the Constrain class.
 
         Args: 
             format_ (str): Serialization type. Default is 'json'.
             return_sequence (str): Return sequence. Default is 'single_response'.
+            history: What `history` keeps. Default (None) is every entry in memory; False keeps none, an int N the last N,
+                and a directory path spills entries to disk (see `tools.history`). Prompt texts are stored once per distinct text.
+                In memory, `history` is a dict (see `History`). A `DiskHistory` is a read-only Mapping whose entries are copies.
+                Entries are numbered on from the last one already in the history, so a reopened path is appended to.
+                A history opened from a path is closed on exit.
         Returns: 
             Constrain context manager object. 
         """ 
@@ -36,31 +55,103 @@ class Constrain:
         self.config["format"] = format_
         self.config["return_sequence"] = return_sequence
 
-        self.history = {} 
+        self.history = make_history(history)
+        self.owns_history = isinstance(history, str)  # Opened here, so closed here
         self.initial_prompt = None
         self.inflation = None
         self.stop_at = ""
-        self.idx = 1 
+        self.idx = max(self.history, default=0) + 1
 
     def get_grammar(self, model: BaseModel) -> str:
         '''
         Pydantic -> GNBF String
         ''' 
-        return GNBF(model).generate_grammar(self.config["format"])
+        format_ = self.config["format"]
+        return self.grammar_cache.get(model, format_, lambda: GNBF(model).generate_grammar(format_, optimize=True))
 
-    def format(self, prompt: Union[str, PromptBuilder, Prompt], grammars: Union[Dict, List], placeholders: Dict = None, examples: Dict = None, enable_on: Dict = None):
+    def format(self, prompt: Union[str, PromptBuilder, Prompt], grammars: Union[Dict, List], placeholders: Dict = None, examples: Dict = None, enable_on: Dict = None, budget: TokenBudget = None):
         ''' 
         Formats the prompt with the grammars provided.
+        With a `budget`, older history and examples are trimmed until the prompt fits (see `TokenBudget`); what was removed is kept
+        in the history entry under 'trimmed'.
         ''' 
 
+        raw_placeholders = placeholders or {}
+        if not placeholders:
+            placeholders = {}
+        else: 
+            placeholders = {key: str(value) for key, value in placeholders.items()}
+
+        if budget is not None:
+            for name in budget.history:  # Histories may be given as lists of entries
+                if isinstance(raw_placeholders.get(name), (list, tuple)):
+                    placeholders[name] = budget.separator.join(str(entry) for entry in raw_placeholders[name])
+
+        if isinstance(prompt, Prompt):
+            self.check_placeholders(prompt, placeholders)
+
+        prompt, initial_prompt = self.prepare(prompt, grammars, examples, enable_on, budget, raw_placeholders)
+
+        return self.record(Prompt(initial_prompt, prompt.placeholders), placeholders, prompt.fill(**placeholders), prompt.trimmed)
+
+    def format_many(self, prompt: Union[str, PromptBuilder, Prompt], grammars: Union[Dict, List], rows: Iterable[Dict], examples: Dict = None, enable_on: Dict = None, record_history: bool = False, lazy: bool = False):
+        '''
+        Formats the same template and grammars for many placeholder dicts.
+        The grammar and static sections are built once; each row only pays for filling its placeholders.
+        Returns a list of prompts, or a generator if `lazy` is set. History is only kept if `record_history` is set.
+        '''
+
+        check = isinstance(prompt, Prompt)
+        prompt, initial_prompt = self.prepare(prompt, grammars, examples, enable_on)
+        template = Prompt(initial_prompt, prompt.placeholders)
+
+        def fill_rows():
+            for placeholders in rows:
+                placeholders = {key: str(value) for key, value in placeholders.items()} if placeholders else {}
+                if check:
+                    self.check_placeholders(prompt, placeholders)
+                filled_prompt = prompt.fill(**placeholders)
+                if record_history:
+                    self.record(template, placeholders, filled_prompt)
+                yield filled_prompt
+
+        return fill_rows() if lazy else list(fill_rows())
+
+    def prepare(self, prompt: Union[str, PromptBuilder, Prompt], grammars: Union[Dict, List], examples: Dict = None, enable_on: Dict = None, budget: TokenBudget = None, placeholders: Dict = None):
+        '''
+        Validates the inputs and builds the template with the grammars. Returns the built `Prompt` and the unformatted template text.
+        '''
+
+        prompt = self.as_builder(prompt)
+        config = self.build_config(grammars, examples, enable_on)
+
+        if isinstance(prompt, Prompt):
+            if budget is not None:
+                raise ConfigError("A token budget needs a PromptBuilder or a string prompt, not a built Prompt.")
+            return prompt, prompt.prompt
+
+        return prompt.build(config, budget, placeholders), prompt.get_text()
+
+    @staticmethod
+    def as_builder(prompt: Union[str, PromptBuilder, Prompt]) -> Union[PromptBuilder, Prompt]:
+        '''
+        Wraps a plain string prompt in the default PromptBuilder (grammar, examples, then the text).
+        '''
+
         if isinstance(prompt, str):
             prompt_config = PromptBuilder()
             prompt_config.add_section(define_grammar=True)
             prompt_config.add_section(add_few_shot_examples=True)
             prompt_config.add_section(text=prompt)
-            prompt = prompt_config
+            return prompt_config
         elif not (isinstance(prompt, PromptBuilder) or isinstance(prompt, Prompt)):
             raise ConfigError("Prompt must be a string, a PromptBuilder or a Prompt object.")
+        return prompt
+
+    def build_config(self, grammars: Union[Dict, List], examples: Dict = None, enable_on: Dict = None) -> Dict:
+        '''
+        Validates the grammars and examples into the config `PromptBuilder.build` takes.
+        '''
 
         if not grammars:
             raise ConfigError("You need to provide grammars to format the prompt!")
@@ -76,105 +167,245 @@ class Constrain:
             elif not isinstance(examples, list): 
                 raise ConfigError("`examples` must be a dictionary or a list of dictionaries.")
 
-        if not placeholders:
-            placeholders = {}
-        else: 
-            placeholders = {key: str(value) for key, value in placeholders.items()}
-
         config = {} 
         config["format"] = self.config["format"]
         config["return_sequence"] = self.config["return_sequence"]
         config["grammars"] = grammars
         config["examples"] = examples
         config["enable_on"] = enable_on
+        config["token_counter"] = self.token_counter
 
-        self.history[self.idx] = {} 
-        
-        if isinstance(prompt, Prompt):
-            if prompt.placeholders and not placeholders:
-                raise ConfigError("Since your prompt uses placeholders in the template, you need to provide `placeholders` parameter too! Ensure they have these keys: {prompt.placeholders} in this format - {'placeholder': 'value'}"
-                )
-            self.history[self.idx]['initial_prompt'] = prompt.prompt
-        elif isinstance(prompt, PromptBuilder):
-            if placeholders:
-                self.history[self.idx]['initial_prompt'] = prompt.get_text() 
-            else: 
-                self.history[self.idx]['initial_prompt'] = prompt.get_text()
-            prompt = prompt.build(config)
-
-        for key, value in placeholders.items():
-            if key in prompt.placeholders:
-                self.history[self.idx]['initial_prompt'] = self.history[self.idx]['initial_prompt'].replace(f"{{{key}}}", value)
-
-        prompt = prompt.fill(**placeholders)
-        
-        self.history[self.idx]['filled_prompt'] = prompt
+        return config
+
+    @staticmethod
+    def check_placeholders(prompt: Prompt, placeholders: Dict):  # pylint: disable=missing-function-docstring
+        if prompt.placeholders and not placeholders:
+            raise ConfigError("Since your prompt uses placeholders in the template, you need to provide `placeholders` parameter too! Ensure they have these keys: {prompt.placeholders} in this format - {'placeholder': 'value'}"
+            )
+
+    def record(self, template: Prompt, placeholders: Dict, filled_prompt: str, trimmed: Dict = None) -> str:
+        '''
+        Stores the template (with placeholders filled in) and the final prompt under the next `idx`.
+        '''
+
+        if self.history.keeps:
+            entry = {'initial_prompt': template.fill(**placeholders), 'filled_prompt': filled_prompt}
+            if trimmed is not None:
+                entry['trimmed'] = trimmed
+            self.history.add(self.idx, entry)
 
         self.idx += 1
 
-        return prompt 
+        return filled_prompt
+
+    def parse(self, return_value: str, records: Union[BaseModel, List[BaseModel]] = None, models: Union[BaseModel, List[BaseModel]] = None, grammar: str = None):
+        '''
+        Parses the LLM output into a `Response`.
+        If `models` are given, each object is validated into an instance of the model named by its root key.
+        If `records` (models) are given, objects are instead returned as generated `__slots__` records of those models.
+        If a `grammar` is given, output with a fenced object (or unfenced text) that doesn't match it is rejected before parsing.
+        '''
 
-    def parse(self, return_value: str):
         if not return_value: 
             return None 
 
+        if grammar:
+            # The grammar describes one object, so each fenced block is matched (the text around fences is skipped, as in parsing)
+            grammar_recognizer = recognizer(grammar)
+            for _, span in iter_fences(return_value):
+                if return_value[span].strip() and not grammar_recognizer.match(return_value[span]):
+                    raise ParsingError("ERROR: Response does not match the grammar!")
+
         parsed_response = self.parse_helper(return_value)
+
+        if models:
+            return model_index(models if isinstance(models, list) else [models]).validate(parsed_response)
+
+        if records:
+            return to_records(parsed_response, records if isinstance(records, list) else [records])
+
         return Response(parsed_response)  # Custom class for getting values from response
 
-    def parse_helper(self, return_value: Union[str, List]): # pylint: disable=missing-function-docstring
+    def parse_many(self, return_values: Iterable[str], records: Union[BaseModel, List[BaseModel]] = None, models: Union[BaseModel, List[BaseModel]] = None, grammar: str = None, raise_errors: bool = True) -> List:
+        '''
+        Parses many outputs with the same options as `parse`. The model index is built once for the whole batch.
+        With `raise_errors=False`, outputs that fail to parse or validate come back as None.
+        '''
+
+        if models and not isinstance(models, list):
+            models = [models]
+        if records and not isinstance(records, list):
+            records = [records]
+
+        parsed = []
+        for return_value in return_values:
+            try:
+                parsed.append(self.parse(return_value, records=records, models=models, grammar=grammar))
+            except ParsingError:
+                if raise_errors:
+                    raise
+                parsed.append(None)
+        return parsed
+
+    def parse_stream(self, chunks: Iterable[str], callback: Callable = None):
+        '''
+        Parses output as it is generated. Yields a `field` StreamEvent as soon as each model field is complete,
+        and a final `response` StreamEvent holding the same Response that `parse` returns for the whole text.
+        `callback`, if given, is called with every event as well.
+        '''
+
+        parser = StreamParser(self.config["format"])
+
+        for chunk in chunks:
+            for event in parser.feed(chunk):
+                if callback: callback(event)
+                yield event
+
+        for event in self._finish_stream(parser):
+            if callback: callback(event)
+            yield event
+
+    async def aparse_stream(self, chunks: Union[AsyncIterable[str], Iterable[str]], callback: Callable = None):
+        '''
+        Async version of `parse_stream`; accepts an async iterator (eg. a streamed API response) or a plain one.
+        '''
+
+        parser = StreamParser(self.config["format"])
+
+        if hasattr(chunks, "__aiter__"):
+            async for chunk in chunks:
+                for event in parser.feed(chunk):
+                    if callback: callback(event)
+                    yield event
+        else:
+            for chunk in chunks:
+                for event in parser.feed(chunk):
+                    if callback: callback(event)
+                    yield event
+
+        for event in self._finish_stream(parser):
+            if callback: callback(event)
+            yield event
+
+    def _finish_stream(self, parser: StreamParser) -> List[StreamEvent]:
+        events = parser.close()
+        events.append(StreamEvent("response", value=self.parse(parser.text)))
+        return events
+
+    def parse_helper(self, return_value: Union[str, List]):
+        '''
+        Parses each ```-fenced object of the output (or the whole output if it has none).
+        One object is returned as parsed; several (fenced separately or together) as a list of `Response`.
+        '''
+
         if not self.config["format"]:
             raise ConfigError("Serialization type is not set!")
 
+        # Line breaks inside strings are kept for JSON only; the other formats' quotes aren't JSON strings
+        json_strings = self.config["format"] == "json"
         if isinstance(return_value, str):
-            if '```' in return_value:
-                return_value = re.sub(r"```.*?\n", "```", return_value, flags=re.DOTALL)
-            else: 
-                return_value = f"```{return_value}```"
-            returned_objects = [
-                split_string.replace("\n", "").strip()
-                for split_string in return_value.split("```")[1::2]
-                if split_string.replace("\n", "").strip()
-            ]  # Splitting between terminals and removing empty strings
+            # Fences are scanned lazily, and each block is only copied to drop its line breaks
+            objects = filter(None, (join_lines(return_value, span, json_strings) for _, span in iter_fences(return_value)))
         else:
-            returned_objects = return_value
-
-        # This is done to handle cases where multiple objects are returned seperately, together, and if terminals are not present.
-        if len(returned_objects) == 1:
-            return_value = returned_objects[0]
-            if self.config["format"] == "json":
-                return JSON.parse(return_value)
-            elif self.config["format"] == "toml":
-                return TOML.parse(return_value)
-            elif self.config["format"] == "xml":
-                return XML.parse(return_value)
-        elif not returned_objects:
-            return [self.parse([return_value.replace("```", "")])]
-        else:
-            to_return = []
-            for value in returned_objects:
-                to_return += [self.parse([value])]
-            return to_return
+            objects = iter(return_value)
+
+        first = next(objects, None)
+        if first is None:
+            return [Response(self.parse_object(join_lines(return_value.replace("```", ""), json_strings=json_strings)))]
+
+        second = next(objects, None)
+        if second is None:
+            return self.parse_object(first)
+
+        return [Response(self.parse_object(value)) for value in itertools.chain((first, second), objects)]
+
+    def parse_object(self, text: str):  # pylint: disable=missing-function-docstring
+        if self.config["format"] == "json":
+            return JSON.parse(text)
+        elif self.config["format"] == "toml":
+            return TOML.parse(text)
+        elif self.config["format"] == "xml":
+            return XML.parse(text)
 
     def inflation_rate(self, idx: int = -1):  # pylint: disable=missing-function-docstring
         if idx == -1: idx = self.idx - 1
 
-        import tiktoken  # pylint: disable=import-outside-toplevel
+        return self.token_counter.history({idx: self.history[idx]})[idx]
 
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    def inflation_rates(self) -> Dict[int, Dict]:
+        '''
+        `inflation_rate` for every history entry, counted in one batch.
+        '''
 
-        inflation = {
-            "before": len(encoding.encode(self.history[idx]['initial_prompt'])),
-            "after": len(encoding.encode(self.history[idx]['filled_prompt'])),
-        }
+        return self.token_counter.history(self.history)
 
-        inflation["factor"] = (
-            f"{((inflation['after'] - inflation['before']) / inflation['before']):.1f}x"
-        )
+    def token_breakdown(self, prompt: Union[str, PromptBuilder, Prompt], grammars: Union[Dict, List], placeholders: Dict = None, examples: Dict = None, enable_on: Dict = None) -> Dict:
+        '''
+        Tokens the prompt `format` would build spends on each section, and on text, the grammar block, examples and each placeholder.
+        See `TokenCounter.breakdown`. Nothing is recorded in history.
+        '''
 
-        return inflation
+        prompt = self.as_builder(prompt)
+        config = self.build_config(grammars, examples, enable_on)
+        sections = [(0, [("text", prompt.prompt)])] if isinstance(prompt, Prompt) else prompt.build_segments(config)
+        return self.token_counter.breakdown(sections, placeholders)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        if self.owns_history:
+            self.history.close()
+
+
+class AsyncConstrain(Constrain):
+    '''
+    Async context manager (`async with AsyncConstrain(...) as manager`) that can also await the LLM between formatting and parsing.
+    Works with the async backends (`AsyncOpenAI`, `AsyncLlamaServer`, `AsyncLocalLlama`), or any async callable taking the prompt.
+    '''
+
+    async def generate(self, llm: Callable, prompt: Union[str, PromptBuilder, Prompt], grammars: Union[Dict, List], placeholders: Dict = None, examples: Dict = None, enable_on: Dict = None, records: Union[BaseModel, List[BaseModel]] = None, models: Union[BaseModel, List[BaseModel]] = None, **llm_kwargs):
+        '''
+        Formats the prompt, awaits `llm(prompt, **llm_kwargs)` and parses the output (see `format` and `parse`).
+        '''
+
+        filled_prompt = self.format(prompt, grammars, placeholders, examples, enable_on)
+        return_value = await llm(filled_prompt, **llm_kwargs)
+        return self.parse(return_value, records=records, models=models, grammar=llm_kwargs.get("grammar"))
+
+    async def generate_many(self, llm: Callable, prompt: Union[str, PromptBuilder, Prompt], grammars: Union[Dict, List], rows: Iterable[Dict], examples: Dict = None, enable_on: Dict = None, records: Union[BaseModel, List[BaseModel]] = None, models: Union[BaseModel, List[BaseModel]] = None, raise_errors: bool = True, **llm_kwargs) -> List:
+        '''
+        `generate` for many placeholder dicts, with every LLM call in flight at once (the backend's concurrency limit applies).
+        Results are in the order of `rows`, and each prompt is recorded in `history` as `generate` does.
+        With `raise_errors=True`, the first failed call cancels the calls still running and is raised; with `raise_errors=False`,
+        failed calls and unparsable outputs come back as None.
+        '''
+
+        prompts = self.format_many(prompt, grammars, rows, examples, enable_on, record_history=True)
+        tasks = [asyncio.ensure_future(llm(filled_prompt, **llm_kwargs)) for filled_prompt in prompts]
+        try:
+            return_values = await asyncio.gather(*tasks, return_exceptions=not raise_errors)
+        finally:
+            # After a failure (or if this call is cancelled) the other calls would keep running, and spending, in the background
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        parsed = []
+        for return_value in return_values:
+            if isinstance(return_value, BaseException):
+                if isinstance(return_value, asyncio.CancelledError):
+                    raise return_value
+                parsed.append(None)
+                continue
+            parsed.extend(self.parse_many([return_value], records=records, models=models,
+                                          grammar=llm_kwargs.get("grammar"), raise_errors=raise_errors))
+        return parsed
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return self.__exit__(exc_type, exc_val, exc_tb)
@@ -2,3 +2,7 @@ from .gnbf import GNBF
 from .json import JSON
 from .toml import TOML
 from .xml import XML
+from .stream import StreamParser, StreamEvent
+from .fences import iter_fences, join_lines
+from .recognizer import GrammarRecognizer, GrammarMatcher, recognizer
+from .optimize import GrammarOptimizer, optimize_grammar, grammar_stats
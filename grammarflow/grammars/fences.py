@@ -0,0 +1,117 @@
+import re
+
+from typing import Iterator, List, Optional, Tuple
+
+# An opening fence, with its language tag if the rest of its line is just a tag ("```json {...}```" has none)
+_OPEN = re.compile(r'```(?:([\w+#.-]+)?[ \t]*\r?\n)?')
+_TAG_LINE = re.compile(r'[\w+#.-]*[ \t]*\r?')
+# Text whose double-quoted strings are all on one line (and closed), so every line break in it is outside a string
+_SINGLE_LINE_STRINGS = re.compile(r'(?:[^"]++|"[^"\\\n]*+(?:\\.[^"\\\n]*+)*+")*+')
+# A double-quoted string (kept, line breaks included; an unterminated one runs to the end) or a line break (removed)
+_BREAK = re.compile(r'("[^"\\]*(?:\\.[^"\\]*)*"?)|\n', re.S)
+
+
+def iter_fences(text: str) -> Iterator[Tuple[Optional[str], slice]]:
+    '''
+    Yields (language tag or None, span) for each ```-fenced block of `text`, in one lazy pass; `text[span]` is the content.
+    Text without fences is one block. An unclosed last fence runs to the end of the text. Text between blocks is skipped.
+    '''
+
+    if '```' not in text:
+        yield None, slice(0, len(text))
+        return
+
+    pos = text.find('```')
+    while pos != -1:
+        match = _OPEN.match(text, pos)
+        end = text.find('```', match.end())
+        if end == -1:
+            yield match.group(1), slice(match.end(), len(text))
+            return
+        yield match.group(1), slice(match.end(), end)
+        pos = text.find('```', end + 3)
+
+
+def join_lines(text: str, span: slice = None, json_strings: bool = True) -> str:
+    '''
+    `text[span]` stripped, with its line breaks removed except those inside double-quoted (JSON) strings.
+    With `json_strings` False, for formats where a '"' doesn't open such a string (eg. in XML text), every line break is removed.
+    The common case, no string spanning lines, is checked and done without Python-level loops.
+    '''
+
+    text = (text if span is None else text[span]).strip()
+    if '\n' not in text:
+        return text
+    if not json_strings:
+        return text.replace('\n', '')
+    if _SINGLE_LINE_STRINGS.fullmatch(text):
+        return text.replace('\n', '')
+    return _BREAK.sub(r'\1', text)
+
+
+class FenceScanner:
+    '''
+    `iter_fences` for text arriving in chunks. `feed` returns what each chunk adds, as events:
+    ("open", offset of the block's content in the whole text), ("text", content) and ("close", offset of the closing fence).
+    Text outside fences produces no events. A fence split across chunks is held back until it can be told apart from content.
+    '''
+
+    def __init__(self):
+        self.state = "outside"  # "outside", "tag" (after an opening fence) or "inside"
+        self.opened = False  # Whether any fence has opened
+        self._pending = ""  # Held-back tail: backticks that may start a fence, or an unfinished tag line
+        self._fed = 0
+
+    def feed(self, chunk: str) -> List[Tuple[str, object]]:  # pylint: disable=missing-function-docstring
+        self._fed += len(chunk)
+        text = self._pending + chunk
+        start = self._fed - len(text)  # Offset of text[0] in the whole text
+        self._pending = ""
+        events = []
+
+        i = 0
+        while i < len(text):
+            if self.state == "tag":
+                match = _TAG_LINE.match(text, i)
+                if match.end() == len(text):
+                    self._pending = text[i:]  # Can't tell a tag from content before the line ends
+                    break
+                if text[match.end()] == "\n":
+                    i = match.end() + 1
+                self.state = "inside"
+                events.append(("open", start + i))
+                continue
+
+            end = text.find("```", i)
+            if end == -1:
+                held = min(2, len(text) - len(text.rstrip("`")))
+                if self.state == "inside" and len(text) - held > i:
+                    events.append(("text", text[i:len(text) - held]))
+                self._pending = text[len(text) - held:] if held else ""
+                break
+
+            if self.state == "inside":
+                if end > i:
+                    events.append(("text", text[i:end]))
+                events.append(("close", start + end))
+                self.state = "outside"
+            else:
+                self.state = "tag"
+                self.opened = True
+            i = end + 3
+
+        return events
+
+    def close(self) -> List[Tuple[str, object]]:
+        '''
+        Events for the held-back tail at the end of the text: an unclosed block ends there.
+        '''
+
+        events = []
+        if self.state == "tag":
+            events.append(("open", self._fed - len(self._pending)))
+            self.state = "inside"
+        if self.state == "inside" and self._pending:
+            events.append(("text", self._pending))
+        self._pending = ""
+        return events
@@ -1,7 +1,29 @@
 import re
-from llama_cpp import LlamaGrammar
 from pydantic import BaseModel
 from typing import Dict
+from grammarflow.tools.pydantic import registry
+from grammarflow.grammars.error import ParsingError
+from grammarflow.grammars.recognizer import GrammarRecognizer, recognizer
+from grammarflow.grammars.optimize import optimize_grammar
+
+# A literal, a character class, or a name
+_RULE_NAME = re.compile(r'"(?:[^"\\]|\\.)*"|\[(?:[^\]\\]|\\.)*\]|[a-zA-Z0-9_-]+')
+
+
+def bounded(element: str, count: int) -> str:
+    '''
+    GNBF for 0 to `count` repetitions of `element`, as nested optionals (GNBF here has no counted repetition).
+    '''
+
+    rule = f"({element})?"
+    for _ in range(count - 1):
+        rule = f"({element} {rule})?"
+    return rule
+
+
+# Longest run of indentation whitespace may take; enough for deeply indented output, small enough that sampling can't run away
+MAX_INDENT = 20
+
 
 class GNBF:
     """
@@ -9,7 +31,8 @@ class GNBF:
     """
 
     TYPE_RULES = {
-        "boolean": r'("True" | "False")',
+        # JSON and TOML spell booleans in lowercase; the Python spelling the prompts used to show is still accepted (both parse)
+        "boolean": r'("true" | "false" | "True" | "False")',
         "number": r'("-"? ([0-9] | [1-9] [0-9]*)) ("." [0-9]+)? ([eE] [-+]? [0-9]+)?',
         "integer": r'("-"? ([0-9] | [1-9] [0-9]*))',
         "string": r''' "\"" (
@@ -24,16 +47,21 @@ class GNBF:
         "array": [
             r"""
             "[" ws (
-                {value}
-                ("," ws {value})*
-            )? "]" ws""",
+                {value} ws
+                ("," ws {value} ws)*
+            )? "]"
+            """,
             ["string", "number", "bool", "none"],
         ],
     }
 
     def __init__(self, model: BaseModel):
-        self.json_obj = model.schema()
-        self.rules = {"ws": r"[ \t\n]", "nl": r"[\n]"}
+        self.json_obj = registry.get(model).schema
+        # Output laid out like the prompt's format (indented, fenced) matches, but whitespace is bounded: a model sampling under an
+        # unbounded `[ \t\n]*` can emit it until max_tokens (the reason llama.cpp's json.gbnf bounds it too).
+        # ws is at most one line break then indentation; nl is a line break (or two, for a blank line) between indentation.
+        indent = bounded(r"[ \t]", MAX_INDENT)
+        self.rules = {"ws": rf"[\n]? {indent}", "nl": rf"{indent} [\n] [\n]? {indent}"}
         self.used_data_types = set()
         self.grammar_entries = []
 
@@ -57,6 +85,23 @@ class GNBF:
         else:
             return new_literal
 
+    def is_model(self, rule: str) -> bool:
+        '''
+        Whether `rule` is a nested model's definition (an Enum's is a value).
+        '''
+
+        return "properties" in self.json_obj.get("definitions", {}).get(rule.strip(), {})
+
+    def enum_literal(self, value, format_: str) -> str:
+        '''
+        Terminal for one Enum value: strings are quoted in JSON and TOML output, as the "string" rule expects.
+        '''
+
+        literal = self.format_literal(str(value), 'xml')
+        if isinstance(value, str) and format_ in ('json', 'toml'):
+            return r'"\"' + literal + r'\""'
+        return f'"{literal}"'
+
     def convert_type(self, json_type: str):
         if json_type not in self.used_data_types:
             self.used_data_types.add(json_type)
@@ -75,6 +120,14 @@ class GNBF:
             return schema["items"]["$ref"].split("/")[-1]
         elif "$ref" in schema:
             return schema["$ref"].split("/")[-1]
+        elif len(schema.get("allOf", [])) == 1:
+            # A model or Enum field with a description: {"description": ..., "allOf": [{"$ref": ...}]}
+            return self.handle_schema(schema["allOf"][0], format_, name)
+
+        if "enum" in schema:
+            # Checked before "type", since Enum definitions have one too
+            enum_values = [self.enum_literal(v, format_) for v in schema["enum"]]
+            return self.add_rule(name, " | ".join(enum_values))
 
         schema_type = schema.get('pattern')
 
@@ -106,13 +159,13 @@ class GNBF:
                 elif format_ == 'xml': 
                     prop_definitions.append(f'"<{prop_name}>" ws {prop_type} ws "</{prop_name}>"')
                 elif format_ == 'toml':
-                    if prop_type.strip()[0].islower(): prop_definitions.append(f'"{prop_name}" ws "=" ws {prop_type}')
+                    if not self.is_model(prop_type): prop_definitions.append(f'"{prop_name}" ws "=" ws {prop_type}')
                     else: prop_definitions.append(f'{prop_type}')
 
             if format_ == 'json':
-                properties_rule = r' "," nl '.join(prop_definitions)
-                if name == 'root': rule = f'nl "{{" {self.format_literal(self.json_obj['title'], 'json')}:" ws "{{" ws {properties_rule} "}}" ws "}}"'
-                else: rule = f'nl "{{" ws {properties_rule} "}}"'
+                properties_rule = r' ws "," ws '.join(prop_definitions)
+                if name == 'root': rule = f'"{{" ws {self.format_literal(self.json_obj['title'], 'json')}:" ws "{{" ws {properties_rule} ws "}}" ws "}}"'
+                else: rule = f'"{{" ws {properties_rule} ws "}}"'
             elif format_ == 'xml':
                 properties_rule = r' ws '.join(prop_definitions)
                 if name == 'root': rule = f'"<{self.format_literal(self.json_obj['title'], 'xml')}>" ws {properties_rule} ws "</{self.json_obj['title']}>"'
@@ -124,7 +177,7 @@ class GNBF:
 
             if name == "root":
                 self.grammar_entries.insert(0, f"{self.json_obj['title']} ::= {rule}")
-                self.grammar_entries.insert(0, f"{name} ::= ws {self.json_obj['title']}")
+                self.grammar_entries.insert(0, f"{name} ::= ws {self.json_obj['title']} ws")
             else:
                 self.add_rule(name, rule)
 
@@ -151,21 +204,45 @@ class GNBF:
 
             return self.add_rule(schema_type, rule)
 
-        elif "enum" in schema:
-            enum_values = [self.format_literal(v) for v in schema["enum"]]
-            return self.add_rule(name, " | ".join(enum_values))
-
         elif "const" in schema:
             return self.format_literal(schema["const"])
 
         return name
 
-    def generate_grammar(self, format_: str ='json') -> str:
+    def generate_grammar(self, format_: str ='json', optimize: bool = False) -> str:
+        '''
+        GNBF grammar for the model in `format_`. With `optimize`, it is minimized by `GrammarOptimizer` (same language, fewer rules).
+        '''
         self.handle_schema(self.json_obj, format_)
         self.grammar_entries += [f"{name} ::= {rule}" for name,
                                  rule in self.rules.items()]
-        return "\n".join(self.grammar_entries).replace("_", "-")
+        grammar = _RULE_NAME.sub(self.rename, "\n".join(self.grammar_entries))
+        if optimize:
+            try:
+                return optimize_grammar(grammar)
+            except ParsingError:
+                pass  # Eg. a field `pattern` that isn't GNBF; returned as generated, like before
+        return grammar
+
+    @staticmethod
+    def rename(match: re.Match) -> str:
+        '''
+        GBNF rule names can't have '_': it becomes '-' in names, but literals and character classes (eg. JSON keys) are kept as written.
+        Renaming inside literals made the grammar require "target-scores" for a field the prompt shows (and the parsers and models
+        expect) as "target_scores", so no output written from the prompt could match.
+        '''
+
+        token = match.group()
+        return token if token[0] in '"[' else token.replace("_", "-")
 
     @staticmethod
     def verify_grammar(grammar: str) -> str:
+        from llama_cpp import LlamaGrammar  # Imported here so API-only hosts don't need llama_cpp
         return LlamaGrammar.from_string(grammar)
+
+    @staticmethod
+    def recognizer(grammar: str) -> GrammarRecognizer:
+        '''
+        Pure-Python recognizer for `grammar`, to check completions (or prefixes of them) without llama_cpp.
+        '''
+        return recognizer(grammar)
@@ -1,6 +1,9 @@
 from grammarflow.tools.pydantic import ModelParser
 from grammarflow.grammars.error import ParsingError
 
+import json
+import threading
+
 from typing import List, Dict
 from pydantic import BaseModel
 
@@ -10,6 +13,12 @@ class JSON:
     Handles JSON format generation from pydantic and parsing of XML strings.
     """
 
+    # How often each parsing tier was used; see `parse_json`.
+    stats = {"strict": 0, "lenient": 0, "failed": 0}
+    _stats_lock = threading.Lock()
+    # Not strict, so line breaks kept inside string values (see `fences.join_lines`) are accepted as they are
+    _decoder = json.JSONDecoder(object_pairs_hook=lambda pairs: JSON.normalize_pairs(pairs), strict=False)
+
     @staticmethod
     def format(model: BaseModel):
         """
@@ -155,8 +164,56 @@ class JSON:
 
     @staticmethod
     def parse_json(json_string) -> Dict:
+        """
+        Tiered JSON parsing.
+        Tries the stdlib decoder on the text from the first '{' (trailing text is ignored), and only falls back to the lenient parser if that fails.
+        Both tiers return the same shape: '-' in keys becomes '_' and empty strings become None.
+        """
+
+        start = json_string.find("{")
+        if start != -1:
+            try:
+                value, _ = JSON._decoder.raw_decode(json_string, start)
+                JSON.count("strict")
+                return value
+            except ValueError:
+                pass
+
+        try:
+            value = JSON.parse_lenient(json_string)
+        except ParsingError:
+            JSON.count("failed")
+            raise
+
+        JSON.count("lenient")
+        return value
+
+    @staticmethod
+    def count(tier: str):  # pylint: disable=missing-function-docstring
+        with JSON._stats_lock:
+            JSON.stats[tier] += 1
+
+    @staticmethod
+    def normalize_pairs(pairs) -> Dict:
+        """
+        `object_pairs_hook` for the strict tier, so its output matches the lenient one without a second walk.
+        """
+
+        return {key.replace("-", "_"): JSON.normalize_value(value) for key, value in pairs}
+
+    @staticmethod
+    def normalize_value(value):  # pylint: disable=missing-function-docstring
+        if value == "":
+            return None
+        elif isinstance(value, list):
+            return [JSON.normalize_value(item) for item in value]
+        return value
+
+    @staticmethod
+    def parse_lenient(json_string) -> Dict:
         """
         JSON character-level parsing.
+        Accepts Python-style literals (True/None), missing commas and a leading preamble.
         """
 
         def parse_value(json_string, i):
@@ -189,7 +246,11 @@ class JSON:
             start = i
             while json_string[i] in "0123456789.-eE":
                 i += 1
-            return eval(json_string[start:i]), i
+            number = json_string[start:i]
+            try:
+                return int(number), i
+            except ValueError:
+                return float(number), i
 
         def parse_array(json_string, i):
             array = []
@@ -0,0 +1,358 @@
+from grammarflow.grammars.error import ParsingError
+from grammarflow.grammars.recognizer import GrammarRecognizer
+from grammarflow.tools.cache import LRUCache
+
+import re
+
+from typing import Dict, Tuple
+
+_NAME = re.compile(r'[a-zA-Z0-9_-]+')
+_RULE_START = re.compile(r'\s*([a-zA-Z0-9_-]+)\s*::=')
+_SPACE = re.compile(r'(?:\s|#[^\n]*)*')
+
+# An item is (kind, value, operator): ("lit", raw text), ("cls", raw text), ("any", "."), ("ref", name) or ("group", alternatives).
+# Alternatives are tuples of sequences, and sequences tuples of items, so equal right-hand sides are equal (and hash equal) tuples.
+_ATOMIC = ("lit", "cls", "any", "ref")
+
+
+class GrammarOptimizer:
+    '''
+    Rewrites a GNBF grammar into a smaller one with the same language:
+    unreachable rules are removed, rules with identical right-hand sides are merged, groups that occur more than once become one
+    shared rule, rules that are a single symbol or used once in sequence are inlined, and the text is re-emitted one rule per line
+    with single spaces. llama.cpp turns every rule, group and repetition into grammar rules and every symbol into a stack position,
+    so fewer of both makes each sampled token cheaper to check.
+
+    `grammar` is the optimized text and `report` the rule and state counts (see `grammar_stats`) before and after.
+    '''
+
+    def __init__(self, grammar: str, root: str = 'root', max_passes: int = 10):
+        self.root = root
+        self.rules = _Parser(grammar).rules
+        if root not in self.rules:
+            raise ParsingError(f"ERROR: Grammar has no '{root}' rule!")
+
+        for _ in range(max_passes):
+            before = self.rules
+            self.rules = {name: self.flatten(alts) for name, alts in self.rules.items()}
+            self.remove_unreachable()
+            self.merge_rules()
+            self.share_groups()
+            self.inline_aliases()
+            self.inline_single_use()
+            self.remove_unreachable()
+            if self.rules == before:
+                break
+
+        self.grammar = "\n".join(f"{name} ::= {self.emit(alts)}" for name, alts in self.rules.items())
+        before, after = grammar_stats(grammar), grammar_stats(self.grammar)
+        self.report = {key: (before[key], after[key]) for key in before}
+
+    def flatten(self, alts: Tuple) -> Tuple:
+        '''
+        Removes groups that don't need to be rules: an operator-free group with one alternative is spliced into its sequence,
+        a group around a single operator-free item is replaced by the item, and a right-hand side that is one bare group is unwrapped.
+        '''
+
+        sequences = []
+        for sequence in alts:
+            items = []
+            for kind, value, op in sequence:
+                if kind == "group":
+                    value = self.flatten(value)
+                    if not op and len(value) == 1:
+                        items.extend(value[0])
+                        continue
+                    if len(value) == 1 and len(value[0]) == 1 and not value[0][0][2]:
+                        items.append(value[0][0][:2] + (op,))
+                        continue
+                items.append((kind, value, op))
+            sequences.append(tuple(items))
+
+        if len(sequences) == 1 and len(sequences[0]) == 1 and sequences[0][0][0] == "group" and not sequences[0][0][2]:
+            return sequences[0][0][1]
+        return tuple(sequences)
+
+    def remove_unreachable(self):  # pylint: disable=missing-function-docstring
+        reachable = []
+        seen = {self.root}
+        pending = [self.root]
+        while pending:
+            name = pending.pop(0)
+            reachable.append(name)
+            for ref in _references(self.rules[name]):
+                if ref not in seen and ref in self.rules:  # An undefined reference is left for the consumer to report
+                    seen.add(ref)
+                    pending.append(ref)
+        self.rules = {name: self.rules[name] for name in reachable}
+
+    def merge_rules(self):
+        '''
+        Hash-conses whole rules: every rule whose right-hand side equals an earlier one's is replaced by it. Repeated until stable,
+        since merging children can make their parents equal.
+        '''
+
+        while True:
+            canonical = {}
+            renames = {}
+            for name, alts in self.rules.items():
+                if alts in canonical and name != self.root:
+                    renames[name] = canonical[alts]
+                else:
+                    canonical.setdefault(alts, name)
+            if not renames:
+                return
+            self.rules = {name: _rename(alts, renames) for name, alts in self.rules.items() if name not in renames}
+
+    def share_groups(self):
+        '''
+        Replaces a group by a reference to the rule with the same right-hand side, creating one for groups that occur more than once.
+        '''
+
+        by_alts = {alts: name for name, alts in reversed(list(self.rules.items()))}
+        counts = {}
+        for alts in self.rules.values():
+            for group in _groups(alts):
+                counts[group] = counts.get(group, 0) + 1
+
+        shared = {}
+        for group, count in counts.items():
+            if group in by_alts:
+                shared[group] = by_alts[group]
+            elif count > 1:
+                shared[group] = self.new_name()
+                self.rules[shared[group]] = group
+        if not shared:
+            return
+
+        self.rules = {name: _share(alts, shared) for name, alts in self.rules.items()}
+
+    def inline_aliases(self):
+        '''
+        Replaces references to rules that are a single operator-free symbol (eg. `ws ::= [ \\t\\n]`) by that symbol.
+        '''
+
+        aliases = {}
+        for name, alts in self.rules.items():
+            if name != self.root and len(alts) == 1 and len(alts[0]) == 1:
+                kind, value, op = alts[0][0]
+                if kind in _ATOMIC and not op and value != name:
+                    aliases[name] = (kind, value)
+
+        for name in list(aliases):  # Follow chains of aliases, stopping at cycles
+            target, seen = aliases[name], {name}
+            while target[0] == "ref" and target[1] in aliases and target[1] not in seen:
+                seen.add(target[1])
+                target = aliases[target[1]]
+            aliases[name] = target
+
+        if aliases:
+            self.rules = {name: _substitute(alts, aliases) for name, alts in self.rules.items()}
+
+    def inline_single_use(self):
+        '''
+        Splices in rules with one alternative that are referenced once, without an operator, from another rule.
+        '''
+
+        uses = {}
+        for name, alts in self.rules.items():
+            for ref, op in _references(alts, with_op=True):
+                uses.setdefault(ref, []).append((name, op))
+
+        inline = {}
+        for name, alts in self.rules.items():
+            sites = uses.get(name, [])
+            if name != self.root and len(alts) == 1 and len(sites) == 1 and not sites[0][1] and sites[0][0] != name:
+                inline[name] = alts[0]
+
+        for name in list(inline):  # Resolve inlines within inlined bodies first, so each is spliced once
+            inline[name] = _splice(inline[name], inline, set([name]))
+        if inline:
+            self.rules = {name: tuple(_splice(sequence, inline, set()) for sequence in alts)
+                          for name, alts in self.rules.items() if name not in inline}
+
+    def new_name(self) -> str:  # pylint: disable=missing-function-docstring
+        i = 1
+        while f"shared-{i}" in self.rules:
+            i += 1
+        return f"shared-{i}"
+
+    @staticmethod
+    def emit(alts: Tuple) -> str:  # pylint: disable=missing-function-docstring
+        return " | ".join(" ".join(GrammarOptimizer.emit_item(item) for item in sequence) for sequence in alts)
+
+    @staticmethod
+    def emit_item(item: Tuple) -> str:  # pylint: disable=missing-function-docstring
+        kind, value, op = item
+        if kind == "group":
+            return f"({GrammarOptimizer.emit(value)}){op}"
+        return f"{value}{op}"
+
+
+def grammar_stats(grammar: str) -> Dict[str, int]:
+    """
+    Size of a grammar: its named rules, the rules llama.cpp compiles it to (every group and repetition adds one),
+    and the states of those rules (a position in each alternative, counting its end).
+    """
+
+    compiled = GrammarRecognizer.compile(grammar)
+    return {
+        "rules": len(_Parser(grammar).rules),
+        "compiled_rules": len(compiled),
+        "states": sum(len(alt) + 1 for alts in compiled.values() for alt in alts),
+    }
+
+
+_optimized = LRUCache(maxsize=64)
+
+
+def optimize_grammar(grammar: str, root: str = 'root') -> str:
+    """
+    Cached `GrammarOptimizer(grammar, root).grammar`.
+    """
+
+    key = (grammar, root)
+    optimized = _optimized.get(key)
+    if optimized is None:
+        optimized = GrammarOptimizer(grammar, root).grammar
+        _optimized.put(key, optimized)
+    return optimized
+
+
+def _references(alts: Tuple, with_op: bool = False):
+    for sequence in alts:
+        for kind, value, op in sequence:
+            if kind == "ref":
+                yield (value, op) if with_op else value
+            elif kind == "group":
+                yield from _references(value, with_op)
+
+
+def _groups(alts: Tuple):
+    for sequence in alts:
+        for kind, value, _ in sequence:
+            if kind == "group":
+                yield value
+                yield from _groups(value)
+
+
+def _rename(alts: Tuple, renames: Dict[str, str]) -> Tuple:
+    return tuple(
+        tuple((kind, renames.get(value, value) if kind == "ref" else _rename(value, renames) if kind == "group" else value, op)
+              for kind, value, op in sequence)
+        for sequence in alts)
+
+
+def _share(alts: Tuple, shared: Dict[Tuple, str]) -> Tuple:
+    return tuple(
+        tuple(("ref", shared[value], op) if kind == "group" and value in shared
+              else (kind, _share(value, shared) if kind == "group" else value, op)
+              for kind, value, op in sequence)
+        for sequence in alts)
+
+
+def _substitute(alts: Tuple, aliases: Dict[str, Tuple]) -> Tuple:
+    return tuple(
+        tuple(aliases[value] + (op,) if kind == "ref" and value in aliases
+              else (kind, _substitute(value, aliases) if kind == "group" else value, op)
+              for kind, value, op in sequence)
+        for sequence in alts)
+
+
+def _splice(sequence: Tuple, inline: Dict[str, Tuple], active: set) -> Tuple:
+    items = []
+    for kind, value, op in sequence:
+        if kind == "ref" and not op and value in inline and value not in active:
+            items.extend(_splice(inline[value], inline, active | {value}))
+        elif kind == "group":
+            items.append((kind, tuple(_splice(inner, inline, active) for inner in value), op))
+        else:
+            items.append((kind, value, op))
+    return tuple(items)
+
+
+class _Parser:
+    '''
+    Parses GNBF text into {rule: alternatives} of items, keeping literals and character classes as written.
+    Rule boundaries are found like `GrammarRecognizer` does: a rule runs until the next `name ::=`.
+    '''
+
+    def __init__(self, grammar: str):
+        self.text = grammar
+        self.pos = 0
+        self.rules = {}
+
+        self.skip()
+        while self.pos < len(self.text):
+            match = _RULE_START.match(self.text, self.pos)
+            if not match:
+                self.fail("expected `name ::=`")
+            self.pos = match.end()
+            self.rules[match.group(1)] = self.alternatives()
+            self.skip()
+
+    def fail(self, message: str):
+        line = self.text.count('\n', 0, self.pos) + 1
+        raise ParsingError(f"ERROR: Invalid grammar at line {line}: {message}!")
+
+    def skip(self):
+        self.pos = _SPACE.match(self.text, self.pos).end()
+
+    def alternatives(self) -> Tuple:
+        alts = [self.sequence()]
+        while self.pos < len(self.text) and self.text[self.pos] == '|':
+            self.pos += 1
+            alts.append(self.sequence())
+        return tuple(alts)
+
+    def sequence(self) -> Tuple:
+        items = []
+        while True:
+            self.skip()
+            if self.pos >= len(self.text) or _RULE_START.match(self.text, self.pos) or self.text[self.pos] in '|)':
+                return tuple(items)
+
+            c = self.text[self.pos]
+            if c == '"':
+                item = ("lit", self.delimited('"'))
+            elif c == '[':
+                item = ("cls", self.delimited(']'))
+            elif c == '.':
+                self.pos += 1
+                item = ("any", ".")
+            elif c == '(':
+                self.pos += 1
+                alts = self.alternatives()
+                if self.pos >= len(self.text) or self.text[self.pos] != ')':
+                    self.fail("expected ')'")
+                self.pos += 1
+                item = ("group", alts)
+            else:
+                match = _NAME.match(self.text, self.pos)
+                if not match:
+                    self.fail(f"unexpected {c!r}")
+                self.pos = match.end()
+                item = ("ref", match.group())
+
+            op = ""
+            if self.pos < len(self.text) and self.text[self.pos] in '*+?':
+                op = self.text[self.pos]
+                self.pos += 1
+            items.append(item + (op,))
+
+    def delimited(self, end: str) -> str:
+        start = self.pos
+        self.pos += 1
+        while True:
+            if self.pos >= len(self.text):
+                self.fail("unterminated string" if end == '"' else "unterminated character class")
+            c = self.text[self.pos]
+            if c == '\\':
+                self.pos += 2
+            elif c == end:
+                self.pos += 1
+                return self.text[start:self.pos]
+            elif c == '\n' and end == '"':
+                self.fail("unterminated string")
+            else:
+                self.pos += 1
@@ -0,0 +1,465 @@
+from grammarflow.grammars.error import ParsingError
+from grammarflow.tools.cache import LRUCache
+from grammarflow.grammars.fences import FenceScanner
+
+import re
+
+from typing import Dict, List, Tuple
+
+_NAME = re.compile(r'[a-zA-Z0-9_-]+')
+_RULE_START = re.compile(r'\s*([a-zA-Z0-9_-]+)\s*::=')
+_SPACE = re.compile(r'(?:\s|#[^\n]*)*')
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', '\\': '\\', '"': '"', '[': '[', ']': ']', '-': '-', '/': '/', '^': '^'}
+_MAX_CODEPOINT = '\U0010ffff'
+
+
+class GrammarRecognizer:
+    '''
+    Pure-Python recognizer for the GNBF grammars produced by `GNBF.generate_grammar` (llama.cpp's GBNF dialect).
+    Rules are compiled to flat alternatives; recognition advances a set of parse stacks one character at a time, like llama.cpp's sampler does.
+    Each distinct set of stacks is interned as a state and its transitions are memoized, so after warm-up the per-character cost is one dict lookup.
+    '''
+
+    def __init__(self, grammar: str, root: str = 'root', max_states: int = 50000):
+        self.rules = GrammarRecognizer.compile(grammar)
+        self.root = root
+        self.max_states = max_states
+
+        if root not in self.rules:
+            raise ParsingError(f"ERROR: Grammar has no '{root}' rule!")
+        self._check()
+
+        self._states = {}
+        self._expansions = {}
+        self.start = self._state(self._expand_all([(alt, 0, None) for alt in self.rules[root]]))
+
+    @staticmethod
+    def compile(grammar: str) -> Dict[str, List[Tuple]]:
+        '''
+        Parses GNBF text into {rule: [alternative, ...]}. An alternative is a tuple of elements: a rule name (str) or a character class ((ranges), negated).
+        Groups and the `*`, `+`, `?` operators are rewritten into generated rules.
+        '''
+
+        return _Compiler(grammar).rules
+
+    def match(self, text: str) -> bool:
+        '''
+        True if the whole of `text` is in the grammar's language.
+        '''
+
+        state = self._run(self.start, text)
+        return state is not None and state.accepting
+
+    def match_prefix(self, text: str) -> bool:
+        '''
+        True if `text` can still be completed into a string of the language.
+        '''
+
+        return self._run(self.start, text) is not None
+
+    def matcher(self) -> "GrammarMatcher":  # pylint: disable=missing-function-docstring
+        return GrammarMatcher(self)
+
+    def fenced_matcher(self, max_preamble: int = 300) -> "FencedMatcher":  # pylint: disable=missing-function-docstring
+        return FencedMatcher(self, max_preamble)
+
+    def _run(self, state, text: str):
+        for char in text:
+            following = state.edges.get(char, _MISSING)
+            if following is _MISSING:
+                following = self._advance(state, char)
+            if following is None:
+                return None
+            state = following
+        return state
+
+    def _advance(self, state, char: str):
+        stacks = []
+        for stack in state.stacks:
+            alt, i, parent = stack
+            ranges, negated = alt[i]
+            if any(low <= char <= high for low, high in ranges) != negated:
+                stacks.append((alt, i + 1, parent))
+
+        following = self._state(self._expand_all(stacks)) if stacks else None
+        state.edges[char] = following
+        return following
+
+    def _state(self, expanded):
+        stacks, accepting = expanded
+        if not stacks and not accepting:
+            return None
+        state = self._states.get((stacks, accepting))
+        if state is None:
+            if len(self._states) >= self.max_states:
+                self._restart()
+            state = self._states.setdefault((stacks, accepting), _State(stacks, accepting))
+        return state
+
+    def _restart(self):
+        '''
+        Drops the automaton built so far. The start state is rebuilt without edges, so old states stay alive only while a matcher is still on them.
+        '''
+
+        self._states.clear()
+        self._expansions.clear()
+        start = self.start
+        self.start = self._states[(start.stacks, start.accepting)] = _State(start.stacks, start.accepting)
+
+    def _expand_all(self, stacks):
+        terminals = set()
+        accepting = False
+        for stack in stacks:
+            expanded, accepts = self._expand(stack)
+            terminals |= expanded
+            accepting = accepting or accepts
+        return frozenset(terminals), accepting
+
+    def _expand(self, stack):
+        '''
+        Expands a stack until every resulting stack has a character class on top. Memoized per stack.
+        '''
+
+        cached = self._expansions.get(stack)
+        if cached is not None:
+            return cached
+
+        terminals = set()
+        accepting = False
+        pending = [stack]
+        seen = set()
+        while pending:
+            current = pending.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+
+            alt, i, parent = current
+            if i == len(alt):
+                if parent is None:
+                    accepting = True
+                else:
+                    pending.append(parent)
+                continue
+
+            element = alt[i]
+            if isinstance(element, str):
+                # Tail calls don't push a frame, so repetition rules keep stacks shallow
+                continuation = (alt, i + 1, parent) if i + 1 < len(alt) else parent
+                for sub_alt in self.rules[element]:
+                    pending.append((sub_alt, 0, continuation))
+            else:
+                terminals.add(current)
+
+        result = self._expansions[stack] = (frozenset(terminals), accepting)
+        return result
+
+    def _check(self):
+        '''
+        Rejects undefined references and left recursion (which the stack expansion can't terminate on).
+        '''
+
+        for name, alts in self.rules.items():
+            for alt in alts:
+                for element in alt:
+                    if isinstance(element, str) and element not in self.rules:
+                        raise ParsingError(f"ERROR: Rule '{name}' references undefined rule '{element}'!")
+
+        nullable = set()
+        changed = True
+        while changed:
+            changed = False
+            for name, alts in self.rules.items():
+                if name not in nullable and any(all(isinstance(e, str) and e in nullable for e in alt) for alt in alts):
+                    nullable.add(name)
+                    changed = True
+
+        left = {name: set() for name in self.rules}
+        for name, alts in self.rules.items():
+            for alt in alts:
+                for element in alt:
+                    if not isinstance(element, str):
+                        break
+                    left[name].add(element)
+                    if element not in nullable:
+                        break
+
+        for name in self.rules:
+            pending, seen = list(left[name]), set()
+            while pending:
+                current = pending.pop()
+                if current == name:
+                    raise ParsingError(f"ERROR: Rule '{name}' is left-recursive!")
+                if current not in seen:
+                    seen.add(current)
+                    pending.extend(left[current])
+
+
+class GrammarMatcher:
+    '''
+    Incremental check of a string arriving in chunks (eg. a streamed completion).
+    '''
+
+    def __init__(self, recognizer: GrammarRecognizer):
+        self.recognizer = recognizer
+        self.state = recognizer.start
+        self.consumed = 0
+        self.failed_at = None  # Offset of the first character that can't be matched
+
+    def feed(self, chunk: str) -> bool:
+        '''
+        Consumes `chunk`. Returns False (and stays False) once the text can no longer be completed.
+        '''
+
+        if self.state is None:
+            return False
+
+        state = self.recognizer._run(self.state, chunk)  # pylint: disable=protected-access
+        if state is None:
+            # Only on failure: replay the chunk to find the offending character
+            for offset in range(len(chunk)):
+                if self.recognizer._run(self.state, chunk[:offset + 1]) is None:  # pylint: disable=protected-access
+                    self.failed_at = self.consumed + offset
+                    break
+        self.state = state
+        self.consumed += len(chunk)
+        return state is not None
+
+    @property
+    def alive(self) -> bool:  # pylint: disable=missing-function-docstring
+        return self.state is not None
+
+    @property
+    def complete(self) -> bool:  # pylint: disable=missing-function-docstring
+        return self.state is not None and self.state.accepting
+
+
+class FencedMatcher:
+    '''
+    Incremental check of a streamed completion, the way `Constrain.parse(grammar=)` checks a finished one: every non-empty ```-fenced
+    block must match the grammar, or the whole text if it has no fences. Text around fences is ignored, but before the first fence
+    (a preamble) at most `max_preamble` characters may fail to match, so prose that never reaches an object is still cut short.
+    '''
+
+    def __init__(self, recognizer: GrammarRecognizer, max_preamble: int = 300):
+        self.recognizer = recognizer
+        self.max_preamble = max_preamble
+        self.fences = FenceScanner()
+        self.unfenced = GrammarMatcher(recognizer)  # The whole text, in case it has no fences
+        self.block = None  # Matcher of the current fenced block
+        self.block_start = 0
+        self.block_empty = True
+        self.consumed = 0
+        self.failed_at = None  # Offset of the first character that can't be matched
+
+    def feed(self, chunk: str) -> bool:
+        '''
+        Consumes `chunk`. Returns False (and stays False) once the text can no longer be completed into a match.
+        '''
+
+        if self.failed_at is not None:
+            return False
+
+        self.consumed += len(chunk)
+        if not self.fences.opened:
+            self.unfenced.feed(chunk)
+        self._handle(self.fences.feed(chunk))
+
+        if self.failed_at is None and not self.fences.opened and not self.unfenced.alive and self.consumed > self.max_preamble:
+            self.failed_at = self.unfenced.failed_at
+        return self.failed_at is None
+
+    def close(self) -> bool:
+        '''
+        Ends the text (an unclosed last block ends with it). Returns whether the whole text matched.
+        '''
+
+        if self.failed_at is None:
+            self._handle(self.fences.close())
+        if self.failed_at is not None:
+            return False
+        if not self.fences.opened:
+            return self.unfenced.complete
+        return self.fences.state != "inside" or self.block_empty or self.block.complete
+
+    def _handle(self, events: List):
+        for kind, value in events:
+            if kind == "open":
+                self.block, self.block_start, self.block_empty = GrammarMatcher(self.recognizer), value, True
+            elif kind == "text":
+                self.block_empty = self.block_empty and not value.strip()
+                if not self.block.feed(value):
+                    self.failed_at = self.block_start + self.block.failed_at
+            elif not self.block_empty and not self.block.complete:
+                self.failed_at = value  # Closed before the object was complete
+            if self.failed_at is not None:
+                return
+
+
+_recognizers = LRUCache(maxsize=64)
+
+
+def recognizer(grammar: str, root: str = 'root') -> GrammarRecognizer:
+    """
+    Cached GrammarRecognizer for a grammar, so its compiled rules and learned transitions are reused across responses.
+    """
+
+    key = (grammar, root)
+    compiled = _recognizers.get(key)
+    if compiled is None:
+        compiled = GrammarRecognizer(grammar, root)
+        _recognizers.put(key, compiled)
+    return compiled
+
+
+class _State:
+    __slots__ = ("stacks", "accepting", "edges")
+
+    def __init__(self, stacks, accepting):
+        self.stacks = stacks
+        self.accepting = accepting
+        self.edges = {}
+
+
+_MISSING = object()
+
+
+class _Compiler:
+    '''
+    Recursive-descent parser for GNBF text.
+    '''
+
+    def __init__(self, grammar: str):
+        self.text = grammar
+        self.pos = 0
+        self.rules = {}
+        self.generated = 0
+
+        self.skip()
+        while self.pos < len(self.text):
+            match = _RULE_START.match(self.text, self.pos)
+            if not match:
+                self.fail("expected `name ::=`")
+            self.pos = match.end()
+            # Generated grammars emit names with '_' replaced by '-'; references are normalized the same way
+            name = match.group(1).replace('_', '-')
+            self.rules[name] = self.alternatives()
+            self.skip()
+
+    def fail(self, message: str):
+        line = self.text.count('\n', 0, self.pos) + 1
+        raise ParsingError(f"ERROR: Invalid grammar at line {line}: {message}!")
+
+    def skip(self):
+        self.pos = _SPACE.match(self.text, self.pos).end()
+
+    def at_rule_end(self) -> bool:
+        return self.pos >= len(self.text) or _RULE_START.match(self.text, self.pos) is not None
+
+    def new_rule(self, alts: List[Tuple]) -> str:
+        self.generated += 1
+        name = f"__{self.generated}"
+        self.rules[name] = alts
+        return name
+
+    def alternatives(self) -> List[Tuple]:
+        alts = [self.sequence()]
+        while self.pos < len(self.text) and self.text[self.pos] == '|':
+            self.pos += 1
+            alts.append(self.sequence())
+        return alts
+
+    def sequence(self) -> Tuple:
+        elements = []
+        while True:
+            self.skip()
+            if self.at_rule_end() or self.text[self.pos] in '|)':
+                return tuple(elements)
+
+            c = self.text[self.pos]
+            if c == '"':
+                atom = [(((char, char),), False) for char in self.literal()]
+            elif c == '[':
+                atom = [self.char_class()]
+            elif c == '.':
+                self.pos += 1
+                atom = [((('\0', _MAX_CODEPOINT),), False)]
+            elif c == '(':
+                self.pos += 1
+                alts = self.alternatives()
+                if self.pos >= len(self.text) or self.text[self.pos] != ')':
+                    self.fail("expected ')'")
+                self.pos += 1
+                atom = [self.new_rule(alts)]
+            else:
+                match = _NAME.match(self.text, self.pos)
+                if not match:
+                    self.fail(f"unexpected {c!r}")
+                self.pos = match.end()
+                atom = [match.group().replace('_', '-')]
+
+            operator = self.text[self.pos] if self.pos < len(self.text) else ''
+            if operator and operator in '*+?':
+                self.pos += 1
+                body = tuple(atom)
+                if operator == '?':
+                    atom = [self.new_rule([body, ()])]
+                else:
+                    repeat = self.new_rule([])
+                    self.rules[repeat] = [body + (repeat,), ()]
+                    atom = list(body) + [repeat] if operator == '+' else [repeat]
+
+            elements.extend(atom)
+
+    def literal(self) -> str:
+        self.pos += 1
+        chars = []
+        while True:
+            if self.pos >= len(self.text):
+                self.fail("unterminated string")
+            c = self.text[self.pos]
+            if c == '"':
+                self.pos += 1
+                return "".join(chars)
+            chars.append(self.char())
+
+    def char_class(self) -> Tuple:
+        self.pos += 1
+        negated = self.text.startswith('^', self.pos)
+        if negated:
+            self.pos += 1
+
+        ranges = []
+        while True:
+            if self.pos >= len(self.text):
+                self.fail("unterminated character class")
+            if self.text[self.pos] == ']':
+                self.pos += 1
+                return tuple(ranges), negated
+            low = self.char()
+            high = low
+            if self.text.startswith('-', self.pos) and not self.text.startswith('-]', self.pos):
+                self.pos += 1
+                high = self.char()
+            ranges.append((low, high))
+
+    def char(self) -> str:
+        c = self.text[self.pos]
+        if c != '\\':
+            self.pos += 1
+            return c
+
+        escape = self.text[self.pos + 1:self.pos + 2]
+        if escape in _ESCAPES:
+            self.pos += 2
+            return _ESCAPES[escape]
+        digits = {'x': 2, 'u': 4, 'U': 8}.get(escape)
+        if digits:
+            code = self.text[self.pos + 2:self.pos + 2 + digits]
+            try:
+                value = chr(int(code, 16))
+            except ValueError:
+                self.fail(f"bad escape '\\{escape}{code}'")
+            self.pos += 2 + digits
+            return value
+        self.fail(f"unknown escape '\\{escape}'")
@@ -0,0 +1,293 @@
+from grammarflow.grammars.json import JSON
+from grammarflow.grammars.toml import TOML
+from grammarflow.grammars.xml import XML
+from grammarflow.grammars.error import ParsingError, ConfigError
+
+import re
+
+from typing import Any, List
+
+_JSON_STRUCTURAL = re.compile(r'[{}\[\]":,]')
+_JSON_IN_STRING = re.compile(r'["\\]')
+_TOML_SPECIAL = re.compile(r'[\n"\\\[\]{}]')
+_XML_NAME_START = re.compile(r'[A-Za-z_/]')
+
+
+class StreamEvent:
+    '''
+    Emitted by StreamParser.
+    kind == 'field': `model`.`field` finished and holds `value`.
+    kind == 'response': the stream ended and `value` is the full parsed result (same as Constrain.parse).
+    '''
+
+    __slots__ = ("kind", "model", "field", "value")
+
+    def __init__(self, kind: str, model: str = None, field: str = None, value: Any = None):
+        self.kind = kind
+        self.model = model
+        self.field = field
+        self.value = value
+
+    def __repr__(self):
+        if self.kind == "field":
+            return f"StreamEvent(field={self.model}.{self.field}, value={self.value!r})"
+        return f"StreamEvent(response={self.value!r})"
+
+
+class StreamParser:
+    '''
+    Incremental parser for LLM output arriving in chunks.
+    Scans each chunk once, keeping partial state between calls, and reports every top-level field of a model as soon as its value is complete.
+    Field values are decoded with the regular JSON/TOML/XML parsers, so they match what the full parse returns.
+    '''
+
+    def __init__(self, format_: str = 'json'):
+        if format_ not in ['json', 'toml', 'xml']:
+            raise ConfigError("Serialization type must be one of 'json', 'toml', 'xml'.")
+
+        self.format = format_
+        self._chunks = []
+        self._buffer = ""  # Unconsumed tail of the stream; offsets below are relative to it
+        self._pos = 0
+
+        # Shared scanner state
+        self._in_string = False
+        self._escape = False
+        self._model = None
+
+        # JSON
+        self._depth = 0
+        self._string_start = 0
+        self._last_string = None
+        self._field = None
+        self._value_start = 0
+
+        # TOML
+        self._line_start = 0
+        self._brackets = 0
+
+        # XML
+        self._stack = []
+        self._field_start = 0
+
+    @property
+    def text(self) -> str:  # pylint: disable=missing-function-docstring
+        return "".join(self._chunks)
+
+    def feed(self, chunk: str) -> List[StreamEvent]:
+        '''
+        Adds a chunk of output and returns the fields completed by it.
+        '''
+
+        if not chunk:
+            return []
+
+        self._chunks.append(chunk)
+        self._buffer += chunk
+        events = []
+
+        if self.format == 'json':
+            self._scan_json(events)
+        elif self.format == 'toml':
+            self._scan_toml(events)
+        elif self.format == 'xml':
+            self._scan_xml(events)
+
+        self._compact()
+        return events
+
+    def close(self) -> List[StreamEvent]:
+        '''
+        Flushes fields that are only terminated by the end of the stream (eg. the last TOML line).
+        '''
+
+        events = []
+        if self.format == 'toml' and not self._in_string and self._brackets <= 0:
+            self._toml_line(self._buffer[self._line_start:], events)
+            self._line_start = len(self._buffer)
+        return events
+
+    def _compact(self):
+        '''
+        Drops the scanned prefix that no pending field needs. Only done once it is the larger half, so total copying stays linear.
+        '''
+
+        keep = self._pos
+        if self.format == 'json':
+            if self._in_string:
+                keep = min(keep, self._string_start)
+            if self._field is not None:
+                keep = min(keep, self._value_start)
+        elif self.format == 'toml':
+            keep = min(keep, self._line_start)
+        elif self.format == 'xml' and len(self._stack) >= 2:
+            keep = min(keep, self._field_start)
+
+        if keep and keep * 2 >= len(self._buffer):
+            self._buffer = self._buffer[keep:]
+            self._pos -= keep
+            self._string_start -= keep
+            self._value_start -= keep
+            self._line_start -= keep
+            self._field_start -= keep
+
+    def _emit(self, events: List, field: str, value: Any):
+        events.append(StreamEvent("field", self._model, field, value))
+
+    def _scan_json(self, events: List):
+        buffer, i = self._buffer, self._pos
+
+        while True:
+            if self._escape:
+                if i >= len(buffer):
+                    break  # The escaped char is in the next chunk
+                i += 1
+                self._escape = False
+
+            pattern = _JSON_IN_STRING if self._in_string else _JSON_STRUCTURAL
+            match = pattern.search(buffer, i)
+            if not match:
+                break
+            i = match.end()
+            c = match.group()
+
+            if self._in_string:
+                if c == '\\':
+                    self._escape = True
+                else:
+                    self._in_string = False
+                    self._last_string = buffer[self._string_start:i - 1]
+                continue
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif self._depth == 0 and c != '{':
+                continue  # Preamble, terminals, or anything between objects
+            elif c in '{[':
+                self._depth += 1
+                if self._depth == 1:
+                    self._model = None
+            elif c in '}]':
+                if self._depth == 2 and self._field is not None:
+                    self._json_field(buffer[self._value_start:i - 1], events)
+                self._depth -= 1
+            elif c == ':':
+                if self._depth == 1 and self._last_string is not None:
+                    self._model = self._last_string.replace('-', '_')
+                elif self._depth == 2 and self._last_string is not None:
+                    self._field = self._last_string.replace('-', '_')
+                    self._value_start = i
+                self._last_string = None
+            elif c == ',' and self._depth == 2 and self._field is not None:
+                self._json_field(buffer[self._value_start:i - 1], events)
+
+        self._pos = i
+
+    def _json_field(self, raw: str, events: List):
+        field, self._field = self._field, None
+        try:
+            value = JSON.parse('{"_": ' + raw.strip() + '}')["_"]
+        except (ParsingError, KeyError, TypeError):
+            return  # Left for the full parse to report
+        self._emit(events, field, value)
+
+    def _scan_toml(self, events: List):
+        buffer, i = self._buffer, self._pos
+
+        while True:
+            if self._escape:
+                if i >= len(buffer):
+                    break
+                i += 1
+                self._escape = False
+
+            match = _TOML_SPECIAL.search(buffer, i)
+            if not match:
+                break
+            i = match.end()
+            c = match.group()
+
+            if self._in_string:
+                if c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in '[{':
+                self._brackets += 1
+            elif c in ']}':
+                self._brackets -= 1
+            elif c == '\n' and self._brackets <= 0:
+                self._brackets = 0
+                self._toml_line(buffer[self._line_start:i - 1], events)
+                self._line_start = i
+
+        self._pos = i
+
+    def _toml_line(self, line: str, events: List):
+        line = line.strip()
+        if not line or line.startswith('```'):
+            return
+
+        if line.startswith('[') and line.endswith(']') and '=' not in line:
+            self._model = line[1:-1].strip().replace('-', '_').replace(' ', '')
+            return
+
+        if self._model is None or '=' not in line:
+            return
+
+        try:
+            parsed = TOML.parse(f"[{self._model}]\n{line}\n")
+            (field, value), = parsed[self._model][0].items()
+        except (ParsingError, KeyError, IndexError, ValueError):
+            return
+        self._emit(events, field.replace('-', '_'), value)
+
+    def _scan_xml(self, events: List):
+        buffer, i = self._buffer, self._pos
+
+        while True:
+            i = buffer.find('<', i)
+            if i == -1 or i + 1 >= len(buffer):
+                break  # Nothing, or a '<' we can't classify yet
+            if not _XML_NAME_START.match(buffer, i + 1):
+                i += 1  # Comparison operator inside a value
+                continue
+
+            end = buffer.find('>', i)
+            if end == -1:
+                break  # Tag is still being generated
+
+            tag = buffer[i + 1:end].strip()
+            closing = tag.startswith('/')
+            self_closing = tag.endswith('/')
+            parts = tag.strip('/ ').split()
+            if not parts:
+                i = end + 1
+                continue
+            name = parts[0].replace('-', '_')
+
+            if closing:
+                if self._stack and self._stack[-1] == name:
+                    if len(self._stack) == 2:
+                        self._xml_field(name, buffer[self._field_start:end + 1], events)
+                    self._stack.pop()
+            elif not self_closing:
+                if not self._stack:
+                    self._model = name
+                elif len(self._stack) == 1:
+                    self._field_start = i
+                self._stack.append(name)
+
+            i = end + 1
+
+        self._pos = len(buffer) if i == -1 else i
+
+    def _xml_field(self, field: str, raw: str, events: List):
+        try:
+            value = XML.parse(raw)[field]
+        except (ParsingError, KeyError, TypeError):
+            return
+        self._emit(events, field, value)
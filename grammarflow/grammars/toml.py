@@ -1,9 +1,25 @@
 from grammarflow.tools.pydantic import ModelParser
 from grammarflow.grammars.error import ParsingError
 
+import re
+import json
+
 from typing import List, Dict
 from pydantic import BaseModel
 
+_WHITESPACE = re.compile(r'(?:\s+|#[^\n]*)*')
+_INLINE_WHITESPACE = re.compile(r'[ \t]*')
+_HEADER = re.compile(r'\[\[?\s*([^\[\]\n=]+?)\s*\]\]?')
+_KEY = re.compile(r'(?:"([^"\n]*)"|([^=\n\[\]{}"]+?))\s*=')
+_INLINE_KEY = re.compile(r'(?:"([^"\n]*)"|([^=:,{}\n]+?))\s*[=:]')
+_STRING = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"', re.S)
+_NUMBER = re.compile(r'[+-]?\d[\d_]*(\.\d[\d_]*)?([eE][+-]?\d+)?')
+_BARE = re.compile(r'[^,\]}#\n]*')
+_BARE_LINE = re.compile(r'[^#\n]*')
+_LITERAL = re.compile(r'true|false|none|null', re.I)
+_LITERALS = {'true': True, 'false': False, 'none': None, 'null': None}
+_NEXT_ENTRY = re.compile(r'[\n\[]')
+
 
 class TOML:
     '''
@@ -118,131 +134,151 @@ class TOML:
     @staticmethod
     def parse_toml(toml_string: str) -> Dict:
         '''
-        TOML character-level parsing.
+        TOML parsing. Repeated sections are collected into lists: {section: [fields, ...]}.
         '''
 
-        def parse_section(toml_string, i):
-            start = i
-            while toml_string[i] != ']':
-                i += 1
-            key = toml_string[start:i].strip().replace('-', '_')
-            i = skip_whitespace(toml_string, i + 1)
-            section = {key: {}}
-            while i < len(toml_string) and toml_string[i] not in '[':
-                subkey, i = parse_key(toml_string, i)
-                i = skip_whitespace(toml_string, i)
-                if toml_string[i] == '=':
-                    i = skip_whitespace(toml_string, i + 1)
-                    value, i = parse_value(toml_string, i)
-                    section[key.replace('\n', '')][subkey.replace(
-                        '\n', '').strip()] = value
-                i = skip_whitespace(toml_string, i)
-            return section, i
-
-        def parse_value(toml_string, i):
-            i = skip_whitespace(toml_string, i)
-            if toml_string[i] == '"':
-                return parse_string(toml_string, i + 1)
-            elif toml_string[i] == '[':
-                return parse_array(toml_string, i)
-            elif toml_string[i] == '{':
-                return parse_dict(toml_string, i)
-            else:
-                return parse_other(toml_string, i)
-
-        def parse_string(toml_string, i):
-            start = i
-            while toml_string[i] != '"':
-                i += 1
-            return toml_string[start:i], i + 1
-
-        def parse_other(toml_string, i):
-            start = i
-            if toml_string[start:start+4].lower() == 'true':
-                return True, i + 4
-            elif toml_string[start:start+5].lower() == 'false':
-                return False, i + 5
-
-            while toml_string[i] in '01234567890.':
-                i += 1
-
-            val = toml_string[start:i]
-            try:
-                return eval(val), i
-            except ValueError:
-                return val, i
-
-        def parse_array(toml_string, i):
-            i = skip_whitespace(toml_string, i + 1)
-            array = []
-            while toml_string[i] != ']':
-                value, i = parse_value(toml_string, i)
-                array += [value]
-                if toml_string[i] == ',':
-                    i += 1
-                i = skip_whitespace(toml_string, i)
-            return array, i + 1
-
-        def parse_key(toml_string, i):
-            start = i
-            while toml_string[i] not in '=':
-                i += 1
-            return toml_string[start:i], i
-
-        def parse_dict(toml_string, i):
-            dictionary = {}
-            i = skip_whitespace(toml_string, i + 1)  # Move past the "{'
-            while toml_string[i] != '}':
-                key, i = parse_key(toml_string, i)
-                i = skip_whitespace(toml_string, i)
-                if toml_string[i] == '=' or toml_string[i] == ':':
-                    i += 1  # Skip the '='
-                    i = skip_whitespace(toml_string, i)
-                    value, i = parse_value(toml_string, i)
-                    dictionary[key] = value
-                    i = skip_whitespace(toml_string, i)
-                    if toml_string[i] == ',':
-                        i += 1  # Skip the comma
-                        i = skip_whitespace(toml_string, i)
-            return dictionary, i + 1
-
-        def skip_whitespace(toml_string, i):
-            while i < len(toml_string) and toml_string[i] in [
-                    ' ', '\n', '\t', '\r']:
-                i += 1
-            return i
-
-        def prune_starting(toml_string):
-            index = toml_string.find('[')
-            if index == 0 or index == -1:
-                return toml_string
-            else:
-                return toml_string[index:]
-
-        i = 0
         storage = {}
 
-        toml_string = prune_starting(toml_string)
-
         try:
-            while i < len(toml_string):
-                i = skip_whitespace(toml_string, i)
-                if i < len(toml_string) and toml_string[i] == '[':
-                    i = skip_whitespace(toml_string, i + 1)
-                    section, i = parse_section(toml_string, i)
-                    key = list(section.keys())[0]
-                    if key in storage:
-                        storage[key.replace(' ', '')].append(section[key])
-                    else:
-                        storage[key.replace(' ', '')] = [section[key]]
+            for section, fields in TOML.iter_sections(toml_string):
+                if section in storage:
+                    storage[section].append(fields)
                 else:
-                    break
+                    storage[section] = [fields]
 
             return storage
         except BaseException as exc:
             raise ParsingError(
                 'ERROR: Unable to parse response into TOML format!') from exc
 
+    @staticmethod
+    def iter_sections(toml_string: str):
+        '''
+        Yields (section, fields) for each `[section]` in the text, in order, so many concatenated sections can be consumed lazily.
+        Single pass over the text; values (numbers, booleans, strings, arrays, inline tables) are decoded without `eval`.
+        Text before the first section and lines that aren't `key = value` are skipped. '-' becomes '_' in all keys.
+        '''
+
+        text = toml_string
+        n = len(text)
+
+        def skip_whitespace(i):
+            return _WHITESPACE.match(text, i).end()
+
+        def parse_value(i, top_level=False):
+            c = text[i] if i < n else '\n'
+
+            if c == '"':
+                return parse_string(i)
+            elif c == "'":
+                end = text.index("'", i + 1)
+                return text[i + 1:end], end + 1
+            elif c == '[':
+                return parse_array(i + 1)
+            elif c == '{':
+                return parse_table(i + 1)
+
+            # Numbers and booleans end where their token ends, since keys may follow without a newline
+            match = _NUMBER.match(text, i)
+            if match:
+                number = match.group().replace('_', '')
+                if match.group(1) or match.group(2):
+                    return float(number), match.end()
+                return int(number), match.end()
+
+            match = _LITERAL.match(text, i)
+            if match:
+                return _LITERALS[match.group().lower()], match.end()
+
+            match = (_BARE_LINE if top_level else _BARE).match(text, i)
+            word = match.group().strip()
+            if not word:
+                if top_level:
+                    return None, match.end()
+                raise ValueError(f"Unexpected character at {i}: {c!r}")
+            return word, match.end()
+
+        def parse_string(i):
+            if text.startswith('"""', i):
+                end = text.index('"""', i + 3)
+                return text[i + 3:end], end + 3
+
+            match = _STRING.match(text, i)
+            if not match:
+                raise ValueError(f"Unterminated string at {i}")
+            value = match.group(1)
+            if '\\' in value:
+                try:
+                    value = json.loads(f'"{value}"', strict=False)
+                except ValueError:
+                    pass
+            return value, match.end()
+
+        def parse_array(i):
+            array = []
+            i = skip_whitespace(i)
+            while text[i] != ']':
+                value, i = parse_value(i)
+                array.append(value)
+                i = skip_whitespace(i)
+                if text[i] == ',':
+                    i = skip_whitespace(i + 1)
+            return array, i + 1
+
+        def parse_table(i):
+            table = {}
+            i = skip_whitespace(i)
+            while text[i] != '}':
+                match = _INLINE_KEY.match(text, i)
+                if not match:
+                    raise ValueError(f"Expected a key at {i}")
+                value, i = parse_value(skip_whitespace(match.end()))
+                table[normalize_key(match)] = value
+                i = skip_whitespace(i)
+                if text[i] == ',':
+                    i = skip_whitespace(i + 1)
+            return table, i + 1
+
+        def normalize_key(match):
+            key = match.group(2) if match.group(2) is not None else match.group(1)
+            return key.strip().replace('-', '_')
+
+        section, fields = None, None
+        i = 0
+
+        while i < n:
+            i = skip_whitespace(i)
+            if i >= n:
+                break
+
+            if text[i] == '[':
+                match = _HEADER.match(text, i)
+                if match:
+                    if section is not None:
+                        yield section, fields
+                    section = match.group(1).replace('-', '_').replace(' ', '')
+                    fields = {}
+                    i = match.end()
+                    continue
+
+            if section is None:
+                # Preamble: jump to the first section header
+                i = text.find('[', i + 1)
+                i = n if i == -1 else i
+                continue
+
+            match = _KEY.match(text, i)
+            if match:
+                value, i = parse_value(_INLINE_WHITESPACE.match(text, match.end()).end(), top_level=True)
+                fields[normalize_key(match)] = value
+            else:
+                # Not `key = value`: drop it up to the next line or section
+                end = _NEXT_ENTRY.search(text, i + 1)
+                i = n if end is None else end.start()
+
+        if section is not None:
+            yield section, fields
+
     @staticmethod
     def parse(text: str):
         return TOML.parse_toml(text)
@@ -2,11 +2,23 @@ from grammarflow.tools.pydantic import ModelParser
 from grammarflow.grammars.error import ParsingError
 
 import re
+import ast
 
-from collections import deque
 from typing import List, Dict
 from pydantic import BaseModel
 
+# The name must follow '<' or '</' directly and anything else inside must be attributes, so comparisons in text ("a < b", "a<b and c > d")
+# aren't taken for tags
+_TAG = re.compile(r'<(/)?([A-Za-z_][\w.:-]*)((?:\s+[\w.:-]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/)?>')
+_ATTR = re.compile(r'\b([\w.:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+
+def _attributes(text: str) -> List:
+    if not text or '=' not in text:
+        return []
+    return [(attr.replace('-', '_'), double if double else single)
+            for attr, double, single in _ATTR.findall(text)]
+
 
 class XML:
     '''
@@ -120,200 +132,118 @@ class XML:
     @staticmethod
     def parse_xml(xml_string: str) -> Dict:
         '''
-        XML character-level parsing.
-        Extracts tags and values, considers complex nesting, builds skeleton structure and populates it.
+        Single-pass XML parsing.
+        Tags are tokenized with one regex scan and the tree is built on a stack, so the cost is linear in the output size.
+        Leaf values are evaluated as Python literals (no `eval`), repeated sibling tags become lists and attributes are kept.
+        Text outside the root (preamble, trailing notes) is ignored, as are closing tags that match nothing open.
         '''
 
-        def build_structure(tags):
-            result = {}
-            stack = []
-            objects = {}
-
-            for tag in tags:
-                if not stack or stack[-1] != tag:
-                    if tag not in objects:
-                        objects[tag] = []
-                    stack.append(tag)
-                    new_obj = {}
-                    objects[tag].append(new_obj)
-                    if len(stack) > 1:
-                        parent_tag = stack[-2]
-                        parent_obj = objects[parent_tag][-1]
-                        if tag in parent_obj:
-                            if not isinstance(parent_obj[tag], list):
-                                parent_obj[tag] = [parent_obj[tag]]
-                            parent_obj[tag].append(new_obj)
-                        else:
-                            parent_obj[tag] = new_obj
-                else:
-                    stack.pop()
-
-            result[tags[-1]] = objects[tags[0]]
-
-            for tag, value in result.items():
-                if isinstance(value, list):
-                    if len(value) == 1:
-                        result[tag] = value[0]
-
-            return result
-
-        def populate_structure(structure, storage):
-            queue = deque([(structure, None)])
-
-            while queue:
-                current, parent_tag = queue.popleft()
-
-                if isinstance(current, dict):
-                    for tag, value in current.items():
-                        if isinstance(value, dict) and not value:
-                            if tag in storage and storage[tag]:
-                                current[tag] = storage[tag].pop(0)['value']
-                            continue
-                        elif isinstance(value, list):
-                            for item in value:
-                                queue.append((item, tag))
-                        else:
-                            queue.append((value, tag))
-                elif isinstance(current, list) and parent_tag not in ['grammars', 'grammars']:
-                    for item in current:
-                        if isinstance(item, dict):
-                            queue.append((item, parent_tag))
-
-        def parse_tags(tags, storage):
-            structure = build_structure(tags)
-            populate_structure(structure, storage)
-            return structure
-
-        def find_attr_value_pairs(tag):
-            pattern = r'\b(\w+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')'
-
-            matches = re.findall(pattern, tag)
-            results = []
-            for attr, value_double, value_single in matches:
-                value = value_double if value_double else value_single
-                results.append((attr, value))
-
-            return results
-
-        def parse_tag(xml_string, i):
-            start = i
-            while xml_string[i] != '>':
-                i += 1
-            tag = xml_string[start:i]
-
-            attr_value_pairs = find_attr_value_pairs(tag)
-
-            if attr_value_pairs:
-                for attr, value in attr_value_pairs:
-                    tag = tag.replace(
-                        '=',
-                        '').replace(
-                        attr,
-                        '').replace(
-                        value,
-                        '')
-
-            return tag.replace(' ', '').replace(
-                '/', '').replace('"', '').replace('-', '_'), i + 1, attr_value_pairs
-
-        def add_val(tag, value):
-            value = evaluate(value)
-            temp = {}
-            if value:
-                if isinstance(value, str) and value.strip() in ['\n', '', ' ']:
-                    pass
+        # Frame: [tag, attrs, children, end of opening tag]
+        root = [None, [], [], 0]
+        stack = [root]
+
+        try:
+            for match in _TAG.finditer(xml_string):
+                closing, tag, attrs, self_closing = match.groups()
+                tag = tag.replace('-', '_')
+
+                if closing:
+                    # Tolerate unclosed children by closing up to the matching tag
+                    for depth in range(len(stack) - 1, 0, -1):
+                        if stack[depth][0] == tag:
+                            while len(stack) > depth:
+                                XML._close(stack, xml_string, match.start())
+                            break
+                elif self_closing:
+                    stack[-1][2].append((tag, XML._element(_attributes(attrs), [], None)))
                 else:
-                    temp.update({"value": value})
+                    stack.append([tag, _attributes(attrs), [], match.end()])
 
-            if tag in storage:
-                if temp:
-                    storage[tag] = [val for val in storage[tag] if val]
-                    storage[tag].append(temp)
-            else:
-                storage[tag] = [temp]
-
-        def parse_value(xml_string: str, i: int) -> Dict:
-            i = skip_whitespace(xml_string, i)
-            start = i
-            # In case, '<' is used in the value
-            temp_xml = xml_string.replace(' < ', 'lsr')
-            # In case, '<' is used in the value
-            temp_xml = temp_xml.replace(' <= ', 'lsre')
-            if temp_xml[i] == '"':
-                i += 1
-                start = i
-                while temp_xml[i] != '"':
-                    i += 1
-            else:
-                while temp_xml[i] != '<':
-                    i += 1
+            while len(stack) > 1:
+                XML._close(stack, xml_string, len(xml_string))
 
-            value = temp_xml[start:i].strip()
+            if not root[2]:
+                raise ValueError("No XML elements found.")
 
-            if value == '':
-                return None, i
-            else:
-                return value.replace('lsre', ' <= ').replace('lsr', ' < '), i
+            return XML._children(root[2])
+        except BaseException as exc:
+            raise ParsingError(
+                'ERROR: Unable to parse response into XML format!') from exc
 
-        def evaluate(value):
-            try:
-                if value.lower().replace('"', '') == 'true':
-                    return True
-                elif value.lower().replace('"', '') == 'false':
-                    return False
-                elif value.lower().replace('"', '') in ['null', 'none']:
-                    return None
-                else:
-                    return eval(value)
-            except BaseException:
-                return value
-
-        def skip_whitespace(xml_string, i):
-            while i < len(xml_string) and xml_string[i] in ' \t\r':
-                i += 1
-            return i
-
-        def prune_starting(xml_string):
-            index = xml_string.find('<')
-            if index == 0 or index == -1:
-                return xml_string
+    @staticmethod
+    def _close(stack: List, xml_string: str, end: int):
+        tag, attrs, children, start = stack.pop()
+        text = None if children else xml_string[start:end]
+        stack[-1][2].append((tag, XML._element(attrs, children, text)))
+
+    @staticmethod
+    def _element(attrs: List, children: List, text: str):
+        '''
+        Value of one element: a dict of its children, the evaluated text of a leaf, or its attribute value(s).
+        '''
+
+        if children:
+            value = XML._children(children)
+            for attr, attr_value in attrs:
+                value.setdefault(attr, attr_value)
+            return value
+
+        value = XML.evaluate(text) if text else None
+
+        if not attrs:
+            return value
+        if value is None:
+            return attrs[0][1] if len(attrs) == 1 else dict(attrs)
+        return {**dict(attrs), 'value': value}
+
+    @staticmethod
+    def _children(children: List) -> Dict:
+        obj, repeated = {}, set()
+        for tag, value in children:
+            if tag not in obj:
+                obj[tag] = value
+            elif tag in repeated:
+                obj[tag].append(value)
             else:
-                return xml_string[index:]
+                obj[tag] = [obj[tag], value]
+                repeated.add(tag)
+        return obj
 
-        i = 0
-        storage = {}
-        tags = []
+    @staticmethod
+    def evaluate(value: str):
+        '''
+        Converts leaf text to a Python value without `eval`. Anything that isn't a literal stays a string.
+        '''
 
-        xml_string = prune_starting(xml_string)
+        value = value.strip()
+        if not value:
+            return None
 
-        try:
-            while i < len(xml_string):
-                i = skip_whitespace(xml_string, i)
-                if i >= len(xml_string):
-                    break
-                if xml_string[i] == '<':
-                    i = skip_whitespace(xml_string, i + 1)
-                    if xml_string[i] == '/':
-                        tag, i, _ = parse_tag(xml_string, i + 1)
-                    else:
-                        tag, i, attr_value_pairs = parse_tag(xml_string, i)
-                        if attr_value_pairs:
-                            for _, value in attr_value_pairs:
-                                add_val(tag, value)
-                            tags += [tag]  # Attrs only need one tag
-                        else:
-                            value, i = parse_value(xml_string, i)
-                            add_val(tag, value)
-
-                    tags += [tag]
-                else:
-                    while i < len(xml_string) and xml_string[i] != '<':
-                        i += 1
+        lowered = value.lower().replace('"', '')
+        if lowered == 'true':
+            return True
+        elif lowered == 'false':
+            return False
+        elif lowered in ['null', 'none']:
+            return None
 
-            return parse_tags(tags, storage)
-        except BaseException as exc:
-            raise ParsingError(
-                'ERROR: Unable to parse response into XML format!') from exc
+        if value[0] in '0123456789-+.':  # Keeps words like "nan" or "infinity" as text
+            try:
+                return int(value)
+            except ValueError:
+                pass
+            try:
+                return float(value)
+            except ValueError:
+                pass
+
+        if value[0] in '[{("\'':
+            try:
+                return ast.literal_eval(value)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                pass
+
+        return value
 
     @staticmethod
     def parse(text: str):
@@ -1 +1 @@
-from .builder import Prompt, PromptBuilder
+from .builder import Prompt, PromptBuilder, TokenBudget
@@ -2,33 +2,95 @@ from grammarflow.grammars.json import JSON
 from grammarflow.grammars.toml import TOML
 from grammarflow.grammars.xml import XML
 from grammarflow.grammars.error import ConfigError
+from grammarflow.tools.tokens import TokenCounter
+from grammarflow.tools.cache import LRUCache
+from grammarflow.tools.pydantic import registry
 
-from typing import Dict, List, Any
+import re
+import json
+
+from typing import Dict, List, Any, Tuple, Union
 
 
 class Prompt:
     """
     Dataclass to store the built prompt.
+    The prompt is compiled once into literal segments and placeholder slots, so `fill` is a single join.
+    `overrides` are placeholder values that win over the ones passed to `fill` (a budgeted build puts trimmed histories there),
+    and `trimmed` is the budget report of a budgeted build.
     """
 
     def __init__(
             self,
             built_prompt: str,
             placeholders: List = None,
-            stop_at: str = ""):
+            stop_at: str = "",
+            overrides: Dict[str, str] = None,
+            trimmed: Dict[str, Any] = None):
         self.placeholders = placeholders
         self.prompt = built_prompt
         self.stop_at = stop_at
+        self.overrides = overrides or {}
+        self.trimmed = trimmed
+        self._compiled_for = None
+        self._segments = None
+
+    def compile(self) -> List[str]:
+        '''
+        Splits the prompt into [literal, name, literal, name, ..., literal]. Recompiled only if the prompt or placeholders change.
+        '''
+
+        key = (self.prompt, tuple(self.placeholders or ()))
+        if self._compiled_for != key:
+            if self.placeholders:
+                names = sorted(set(self.placeholders), key=len, reverse=True)
+                pattern = re.compile(r"\{(" + "|".join(map(re.escape, names)) + r")\}")
+                self._segments = pattern.split(self.prompt)
+            else:
+                self._segments = [self.prompt]
+            self._compiled_for = key
+        return self._segments
 
     def fill(self, **kwargs):
-        filled_prompt = self.prompt
+        segments = self.compile()
+
+        if not (kwargs or self.overrides) or len(segments) == 1:
+            return self.prompt
 
-        if kwargs:
-            for key, value in kwargs.items():
-                if key in self.placeholders:
-                    filled_prompt = filled_prompt.replace(f"{{{key}}}", value)
+        # Odd positions are slots. Values are inserted verbatim, so a value containing `{name}` is never substituted again.
+        filled = segments[:]
+        for i in range(1, len(filled), 2):
+            value = self.overrides.get(filled[i], kwargs.get(filled[i]))
+            filled[i] = f"{{{filled[i]}}}" if value is None else value
 
-        return filled_prompt
+        return "".join(filled)
+
+
+class TokenBudget:
+    """
+    Token limit for `PromptBuilder.build`. While the filled prompt is over `max_tokens`, content is removed from the sections with
+    the lowest `priority` (set in `add_section`, default 0) first. Within a priority: the oldest entries of the `history`
+    placeholders, then few-shot examples (last first), then the sections themselves if they were given a priority.
+    Sections without a priority are only trimmed, never dropped.
+
+    Args:
+        max_tokens (int): Limit for the filled prompt. Leave room for the response, eg. `ctx_size - n_predict` for llama.cpp.
+        history (str | List[str]): Placeholders holding a history. Their value is a list of entries (oldest first),
+            or a string of entries joined by `separator`.
+        separator (str): Joins (and splits) history entries.
+        counter (TokenCounter): Counts tokens. Defaults to `Constrain.token_counter` under `Constrain`, or the default tokenizer.
+    """
+
+    def __init__(
+            self,
+            max_tokens: int,
+            history: Union[str, List[str]] = None,
+            separator: str = "\n",
+            counter: TokenCounter = None):
+        self.max_tokens = max_tokens
+        self.history = [history] if isinstance(history, str) else list(history or [])
+        self.separator = separator
+        self.counter = counter
 
 
 class PromptBuilder:
@@ -53,7 +115,8 @@ class PromptBuilder:
             define_grammar: bool = False,
             remind_grammar: bool = False,
             add_few_shot_examples: List = None,
-            enable_on: Any = None):
+            enable_on: Any = None,
+            priority: int = None):
         assert isinstance(text, str), "`text` needs to be a `str` type"
 
         if placeholders: 
@@ -91,21 +154,150 @@ class PromptBuilder:
                 "define_grammar": define_grammar,
                 "remind_grammar": remind_grammar,
                 "examples": add_few_shot_examples,
-                "enable_on": enable_on
+                "enable_on": enable_on,
+                "priority": priority
             }
         )
 
     def get_text(self):  # pylint: disable=missing-function-docstring
         return " ".join([section["text"] for section in self.sections])
 
-    def build(self, config: Dict) -> Prompt:
+    def build(self, config: Dict, budget: TokenBudget = None, placeholders: Dict = None) -> Prompt:
         '''
         Builds the prompt using the current `config`. Not stateful.
+        With a `budget`, the prompt filled with `placeholders` is trimmed to fit it (see `TokenBudget`). The removals are reported
+        in the returned Prompt's `trimmed`, and a ConfigError is raised if it can't fit.
         '''
 
+        if budget is not None:
+            return self.build_within(config, budget, placeholders or {})
+
         prompt = ""
 
-        for section in self.sections:
+        for _, segments in self.build_segments(config):
+            section_text = "".join(text for _, text in segments)
+            if section_text:
+                prompt += section_text + "\n"
+
+        return Prompt(
+            prompt.strip(),
+            placeholders=self.placeholders,
+            stop_at=self.stop_at)
+
+    def build_within(self, config: Dict, budget: TokenBudget, placeholders: Dict) -> Prompt:  # pylint: disable=missing-function-docstring
+        counter = budget.counter or config.get("token_counter") or TokenCounter()
+        sections = self.build_segments(config)
+        examples = config.get("examples") or []
+        priorities = {index: self.sections[index]["priority"] for index, _ in sections}
+
+        histories = {}
+        for name in budget.history:
+            value = placeholders.get(name)
+            if value is not None:
+                histories[name] = list(value) if isinstance(value, (list, tuple)) else str(value).split(budget.separator)
+
+        values = {name: str(value) for name, value in placeholders.items() if name not in histories}
+        state = {"history": dict.fromkeys(histories, 0), "examples": len(examples), "dropped": set()}
+        example_blocks = {}
+
+        def example_block(count):
+            if count not in example_blocks:
+                _, grammar, _ = self.make_format(examples[:count], config.get("format"), None) if count else (None, None, None)
+                example_blocks[count] = f"\n Here is an example:\n{grammar}\n" if count else ""
+            return example_blocks[count]
+
+        def history_value(name):
+            return budget.separator.join(str(entry) for entry in histories[name][state["history"][name]:])
+
+        def make_prompt(trimmed=None):
+            prompt = ""
+            for index, segments in sections:
+                if index in state["dropped"]:
+                    continue
+                section_text = "".join(example_block(state["examples"]) if kind == "examples" else text for kind, text in segments)
+                if section_text:
+                    prompt += section_text + "\n"
+            return Prompt(
+                prompt.strip(),
+                placeholders=self.placeholders,
+                stop_at=self.stop_at,
+                overrides={name: history_value(name) for name in histories},
+                trimmed=trimmed)
+
+        def render():
+            # The prompt `fill` will return (as `Constrain.format` fills it), so the limit holds for what is actually sent
+            return make_prompt().fill(**values)
+
+        def fits():
+            return counter.count(render()) <= budget.max_tokens
+
+        # Trimmable units as (priority, order, kind, target); a unit takes the lowest priority of the sections it appears in
+        units = {}
+        for index, segments in sections:
+            priority = priorities[index] or 0
+            for kind, text in segments:
+                if kind == "placeholder" and text[1:-1] in histories:
+                    key = ("history", text[1:-1])
+                elif kind == "examples" and examples:
+                    key = ("examples", None)
+                else:
+                    continue
+                units[key] = min(units.get(key, priority), priority)
+            if priorities[index] is not None and not any(kind == "grammar" for kind, _ in segments):
+                units[("section", index)] = priority
+        order = {"history": 0, "examples": 1, "section": 2}
+
+        tokens_before = counter.count(render())
+        removed = []
+        if tokens_before > budget.max_tokens:
+            for (kind, target), _ in sorted(units.items(), key=lambda unit: (unit[1], order[unit[0][0]])):
+                if kind == "history":
+                    # Fewest oldest entries to drop, by bisection (the prompt only shrinks as more are dropped)
+                    low, high = 0, len(histories[target])
+                    while low < high:
+                        state["history"][target] = (low + high) // 2
+                        if fits():
+                            high = state["history"][target]
+                        else:
+                            low = state["history"][target] + 1
+                    state["history"][target] = low
+                    if low:
+                        removed.append({"kind": "history", "placeholder": target, "removed": low, "kept": len(histories[target]) - low})
+                elif kind == "examples":
+                    while state["examples"] and not fits():
+                        state["examples"] -= 1
+                    if state["examples"] < len(examples):
+                        removed.append({"kind": "examples", "removed": len(examples) - state["examples"], "kept": state["examples"]})
+                else:
+                    before = render()
+                    state["dropped"].add(target)
+                    if render() != before:  # Not reported if it was already empty (eg. its examples were all dropped)
+                        removed.append({"kind": "section", "section": target})
+                if fits():
+                    break
+
+        tokens = counter.count(render())
+        if tokens > budget.max_tokens:
+            raise ConfigError(
+                f"The prompt needs {tokens} tokens ({counter.tokenizer.name}) after trimming, over the budget of {budget.max_tokens}.")
+
+        return make_prompt({
+            "tokens_before": tokens_before,
+            "tokens": tokens,
+            "max_tokens": budget.max_tokens,
+            "removed": removed,
+            "tokenizer": counter.tokenizer.name,
+        })
+
+    def build_segments(self, config: Dict) -> List[Tuple[int, List[Tuple[str, str]]]]:
+        '''
+        The enabled sections as (section index, segments), where each segment is a (kind, text) pair and joining a section's texts gives
+        the section as `build` writes it. Kinds are "text", "grammar", "examples" and "placeholder" (text is the `{name}` slot).
+        '''
+
+        built = []
+
+        for index, section in enumerate(self.sections):
             # section["enable_on"] must be a function
             if section["enable_on"] and not config['enable_on']:
                 raise ConfigError(
@@ -117,7 +309,7 @@ class PromptBuilder:
                     self.placeholders.extend(section["placeholders"])
 
             grammar_instruction, grammar, reminders = "", "", []
-            section_text = section["text"]
+            segments = self.split_placeholders(section["text"], section["placeholders"])
 
             # If the section is supposed to define the grammar, we need to
             # extract the grammar from the config
@@ -129,8 +321,7 @@ class PromptBuilder:
             # If it's fixed, we don't do anything, except grammar addition.
             if section["type"] == "fixed":
                 if grammar_instruction:
-                    section_text += "\n" + grammar_instruction + \
-                        "\n\n" + grammar + reminders[-1]
+                    segments.append(("grammar", "\n" + grammar_instruction + "\n\n" + grammar + reminders[-1]))
 
             # If it's editable, there will be placeholders we can play with.
             # grammar addition can happen here too, but will be placed after
@@ -138,33 +329,86 @@ class PromptBuilder:
             elif section["type"] == "editable":
                 if section["placeholders"]:
                     for placeholder in section["placeholders"]:
-                        if grammar: 
-                            section_text = section_text.replace(
-                                f"{{{placeholder}}}", f"{{{placeholder}}}\n" + grammar_instruction + "\n\n" + grammar + reminders[-1]
-                            )
-                        else: 
-                            section_text = section_text.replace(
-                                f"{{{placeholder}}}", f"{{{placeholder}}}\n"
-                            )
-            
+                        if grammar:
+                            addition = ("grammar", "\n" + grammar_instruction + "\n\n" + grammar + reminders[-1])
+                        else:
+                            addition = ("text", "\n")
+                        slot = ("placeholder", f"{{{placeholder}}}")
+                        added = []
+                        for segment in segments:
+                            added.append(segment)
+                            if segment == slot:
+                                added.append(addition)
+                        segments = added
+
             if section["examples"] and config["examples"]:
                 _, grammar, _ = self.make_format(
                     config["examples"], config.get("format"), None)
-                section_text += "\n Here is an example:\n"
-                section_text += f"{grammar}\n"
+                segments.append(("examples", f"\n Here is an example:\n{grammar}\n"))
 
-            if section_text:
-                prompt += section_text + "\n"
+            built.append((index, segments))
 
-        return Prompt(
-            prompt.strip(),
-            placeholders=self.placeholders,
-            stop_at=self.stop_at)
+        return built
+
+    @staticmethod
+    def split_placeholders(text: str, placeholders: List = None) -> List[Tuple[str, str]]:  # pylint: disable=missing-function-docstring
+        if not placeholders:
+            return [("text", text)] if text else []
+
+        names = sorted(set(placeholders), key=len, reverse=True)
+        parts = re.split(r"(\{(?:" + "|".join(map(re.escape, names)) + r")\})", text)
+        return [("placeholder" if i % 2 else "text", part) for i, part in enumerate(parts) if part]
+
+    # Rendered (instruction, format block, reminder) by `format_key`, shared by every builder
+    format_cache = LRUCache(256)
 
     def make_format(self,
                     grammars: Dict,
                     serialization_type: str = 'json',
                     return_sequence: str = 'single_response') -> List[Any]:
+        '''
+        Instruction, format block and reminders for `grammars`. Rendered once per distinct grammars / format / return sequence.
+        '''
+
+        key = self.format_key(grammars, serialization_type, return_sequence)
+        rendered = self.format_cache.get(key) if key is not None else None
+        if rendered is None:
+            rendered = self.render_format(grammars, serialization_type, return_sequence)
+            if key is not None:
+                self.format_cache.put(key, rendered)
+
+        instruction, grammar, reminders = rendered
+        return instruction, grammar, [reminders]
+
+    @staticmethod
+    def format_key(grammars: List[Dict], serialization_type: str, return_sequence: str) -> Tuple:
+        '''
+        Cache key for `make_format`: each model's identity and schema fingerprint (and its values, for instances such as
+        few-shot examples), with the descriptions, queries, format and return sequence. None if a model isn't a pydantic model.
+        '''
+
+        def model_key(model):
+            if isinstance(model, list):
+                return tuple(model_key(item) for item in model)
+            cls = model if isinstance(model, type) else type(model)
+            if not hasattr(cls, "__fields__"):
+                raise TypeError
+            key = (id(cls), registry.get(cls).fingerprint)
+            if cls is not model:
+                key += (json.dumps(model.dict(), sort_keys=True, default=str),)
+            return key
+
+        try:
+            tasks = tuple(
+                (task.get("description"), repr(task.get("query")), model_key(task.get("model"))) for task in grammars)
+        except TypeError:
+            return None
+        return serialization_type, return_sequence, tasks
+
+    def render_format(self,
+                      grammars: Dict,
+                      serialization_type: str = 'json',
+                      return_sequence: str = 'single_response') -> Tuple:  # pylint: disable=missing-function-docstring
 
         # Decide which formatter
         if serialization_type == "json":
@@ -194,4 +438,4 @@ class PromptBuilder:
             instruction = None
             reminders = None
 
-        return instruction, grammar, [reminders]
+        return instruction, grammar, reminders
@@ -1,2 +1,7 @@
-from .pydantic import ModelParser
+from .pydantic import ModelParser, SchemaRegistry, registry
 from .response import Response
+from .cache import GrammarCache, LRUCache
+from .record import Record, record_class, to_records
+from .validate import ModelIndex, model_index
+from .tokens import Tokenizer, TiktokenTokenizer, OfflineTokenizer, FunctionTokenizer, TokenCounter, get_tokenizer
+from .history import History, RingHistory, NullHistory, DiskHistory, make_history
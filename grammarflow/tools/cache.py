@@ -0,0 +1,149 @@
+from grammarflow.tools.pydantic import registry
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+from pydantic import BaseModel
+
+# Bump when the grammar generator changes output for the same schema, so stale on-disk entries are ignored.
+CACHE_VERSION = "5"
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Small ordered-dict LRU with a size limit and hit/miss counters.
+    Thread-safe: the module-level caches are shared by every thread that formats or parses.
+    """
+
+    def __init__(self, maxsize: int = 128):
+        assert maxsize > 0, "`maxsize` must be a positive integer"
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class GrammarCache:
+    """
+    Memoizes GNBF grammars by a fingerprint of the model's schema and the serialization format.
+    Lookups go to the in-process LRU first, then to `cache_dir` (if given), and only then generate.
+    """
+
+    def __init__(self, maxsize: int = 128, cache_dir: str = None):
+        self.memory = LRUCache(maxsize)
+        self.cache_dir = cache_dir
+        self.disk_hits = 0
+        self.misses = 0
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(model: BaseModel, format_: str) -> str:
+        '''
+        Stable key for (schema, format). Independent of the process and dict ordering.
+        '''
+        schema = registry.get(model).fingerprint
+        return hashlib.sha256(f"{CACHE_VERSION}:{format_}:{schema}".encode("utf-8")).hexdigest()
+
+    def get(self, model: BaseModel, format_: str, generate: Callable[[], str]) -> str:
+        '''
+        Returns the cached grammar, calling `generate()` only on a complete miss.
+        '''
+        key = self.fingerprint(model, format_)
+
+        grammar = self.memory.get(key)
+        if grammar is not None:
+            return grammar
+
+        grammar = self._read(key)
+        if grammar is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            grammar = generate()
+            self._write(key, grammar)
+
+        self.memory.put(key, grammar)
+        return grammar
+
+    def stats(self) -> Dict[str, int]:  # pylint: disable=missing-function-docstring
+        return {
+            "hits": self.memory.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self.memory),
+        }
+
+    def clear(self, disk: bool = False):
+        '''
+        Empties the in-process layer (and the on-disk layer if `disk` is set). Resets counters.
+        '''
+        self.memory.clear()
+        self.disk_hits = 0
+        self.misses = 0
+
+        if disk and self.cache_dir:
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith(".gnbf"):
+                    os.remove(os.path.join(self.cache_dir, file_name))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.gnbf")
+
+    def _read(self, key: str) -> str:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, key: str, grammar: str):
+        if not self.cache_dir:
+            return
+        # Write-then-rename so concurrent readers never see a partial grammar.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(grammar)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
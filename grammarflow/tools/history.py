@@ -0,0 +1,241 @@
+from grammarflow.grammars.error import ConfigError
+
+import os
+import json
+import hashlib
+import threading
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Tuple, Union
+
+# Entry fields holding prompt text; they are stored once per distinct text and referenced by hash
+TEXT_FIELDS = ("initial_prompt", "filled_prompt")
+
+
+def digest(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class History(dict):
+    """
+    `Constrain.history`: {idx: {"initial_prompt": ..., "filled_prompt": ..., ...}}, a plain dict: entries can be changed in place and
+    the whole history serialized with `json.dumps`. This base class keeps every entry in memory. Entries stored with `add` share one
+    string object per distinct prompt text, so repeated prompts are held once.
+    """
+
+    keeps = True  # False if `add` discards entries, so callers can skip building them
+
+    def __init__(self):
+        super().__init__()
+        self._texts = {}  # hash -> [text, number of entries using it]
+        self._keys = {}  # idx -> hashes of the texts its entry uses
+
+    def add(self, idx: int, entry: Dict[str, Any]):  # pylint: disable=missing-function-docstring
+        stored = dict(entry)
+        keys = []
+        for field in TEXT_FIELDS:
+            if field in stored:
+                key = digest(stored[field])
+                slot = self._texts.get(key)
+                if slot is None:
+                    slot = self._texts[key] = [stored[field], 0]
+                slot[1] += 1
+                stored[field] = slot[0]
+                keys.append(key)
+        if idx in self:
+            del self[idx]  # A replaced entry moves to the end
+        super().__setitem__(idx, stored)
+        self._keys[idx] = keys
+
+    def _release(self, idx: int):
+        for key in self._keys.pop(idx, ()):
+            slot = self._texts[key]
+            slot[1] -= 1
+            if not slot[1]:
+                del self._texts[key]
+
+    # Entries set or removed through the dict interface release their texts too
+
+    def __setitem__(self, idx: int, entry: Dict[str, Any]):
+        self._release(idx)
+        super().__setitem__(idx, entry)
+
+    def __delitem__(self, idx: int):
+        super().__delitem__(idx)
+        self._release(idx)
+
+    def pop(self, idx: int, *default):  # pylint: disable=missing-function-docstring
+        self._release(idx)
+        return super().pop(idx, *default)
+
+    def popitem(self):  # pylint: disable=missing-function-docstring
+        idx, entry = super().popitem()
+        self._release(idx)
+        return idx, entry
+
+    def stats(self) -> Dict[str, int]:
+        '''
+        Entries kept, distinct texts and their total characters.
+        '''
+        return {"entries": len(self), "texts": len(self._texts), "chars": sum(len(text) for text, _ in self._texts.values())}
+
+    def clear(self):  # pylint: disable=missing-function-docstring
+        super().clear()
+        self._texts.clear()
+        self._keys.clear()
+
+    def close(self):
+        '''
+        Releases what the history holds open (files, for `DiskHistory`). Entries kept in memory stay readable.
+        '''
+
+
+class RingHistory(History):
+    """
+    Keeps the last `maxlen` entries in memory.
+    """
+
+    def __init__(self, maxlen: int):
+        assert maxlen > 0, "`maxlen` must be a positive integer"
+        super().__init__()
+        self.maxlen = maxlen
+
+    def add(self, idx: int, entry: Dict[str, Any]):
+        super().add(idx, entry)
+        while len(self) > self.maxlen:
+            del self[next(iter(self))]
+
+
+class NullHistory(History):
+    """
+    Keeps nothing.
+    """
+
+    keeps = False
+
+    def add(self, idx: int, entry: Dict[str, Any]):
+        pass
+
+
+class DiskHistory(Mapping):
+    """
+    Append-only history under `path`, for long-running processes. Memory holds only the index: offsets of entries and texts.
+    It has the methods of `History`, but is a read-only Mapping: reading an entry returns a new dict, so changing it doesn't change
+    the history (`add` the changed entry under the same idx to replace it). Use `dict(history)` where a plain dict is needed.
+
+    `texts.bin` holds each distinct prompt text once (utf-8, back to back) and `texts.jsonl` its hash, offset and length;
+    `entries.jsonl` has one line per entry, with texts replaced by their hash. A later entry with the same idx replaces the earlier one.
+    Reopening the same `path` reloads the index, so history survives restarts. Lines cut short by a crash are ignored.
+    Entries can't be read once the history is closed.
+    """
+
+    keeps = True
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._offsets = {}  # idx -> (offset, length) in entries.jsonl
+        self._blobs = {}  # hash -> (offset, length) in texts.bin
+
+        self._blob_file = open(os.path.join(path, "texts.bin"), "a+b")  # pylint: disable=consider-using-with
+        self._blob_index = open(os.path.join(path, "texts.jsonl"), "a+b")  # pylint: disable=consider-using-with
+        self._entry_file = open(os.path.join(path, "entries.jsonl"), "a+b")  # pylint: disable=consider-using-with
+
+        for line, _, _ in self._lines(self._blob_index):
+            self._blobs[line["hash"]] = (line["offset"], line["length"])
+        for line, offset, length in self._lines(self._entry_file):
+            self._offsets[line["idx"]] = (offset, length)
+
+    @staticmethod
+    def _lines(file) -> Iterator[Tuple[Dict, int, int]]:
+        file.seek(0)
+        offset = 0
+        for raw in file:
+            if raw.endswith(b"\n"):
+                try:
+                    yield json.loads(raw), offset, len(raw)
+                except ValueError:
+                    pass
+            offset += len(raw)
+
+    @staticmethod
+    def _append(file, data: bytes, lines: bool = True) -> int:
+        file.seek(0, os.SEEK_END)
+        offset = file.tell()
+        if offset and lines:
+            file.seek(offset - 1)
+            if file.read(1) != b"\n":
+                file.write(b"\n")  # Start after a line cut short by a crash
+                offset += 1
+        file.write(data)
+        file.flush()
+        return offset
+
+    def add(self, idx: int, entry: Dict[str, Any]):
+        stored = dict(entry)
+        with self._lock:
+            for field in TEXT_FIELDS:
+                if field in stored:
+                    key = digest(stored[field])
+                    if key not in self._blobs:
+                        data = stored[field].encode("utf-8")
+                        offset = self._append(self._blob_file, data, lines=False)
+                        self._append(self._blob_index, (json.dumps({"hash": key, "offset": offset, "length": len(data)}) + "\n").encode("utf-8"))
+                        self._blobs[key] = (offset, len(data))
+                    stored[field] = key
+
+            line = (json.dumps({"idx": idx, **stored}, default=str) + "\n").encode("utf-8")
+            self._offsets[idx] = (self._append(self._entry_file, line), len(line))
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        with self._lock:
+            offset, length = self._offsets[idx]
+            self._entry_file.seek(offset)
+            entry = json.loads(self._entry_file.read(length))
+            del entry["idx"]
+            for field in TEXT_FIELDS:
+                if field in entry:
+                    offset, length = self._blobs[entry[field]]
+                    self._blob_file.seek(offset)
+                    entry[field] = self._blob_file.read(length).decode("utf-8")
+        return entry
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._offsets))
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self), "texts": len(self._blobs), "bytes": sum(length for _, length in self._blobs.values())}
+
+    def clear(self):
+        with self._lock:
+            for file in (self._blob_file, self._blob_index, self._entry_file):
+                file.truncate(0)
+            self._offsets.clear()
+            self._blobs.clear()
+
+    def close(self):  # pylint: disable=missing-function-docstring
+        with self._lock:
+            for file in (self._blob_file, self._blob_index, self._entry_file):
+                file.close()
+
+
+def make_history(history: Union[None, bool, int, str, History, DiskHistory] = None) -> Union[History, DiskHistory]:
+    """
+    History store for `Constrain(history=...)`: None or True keeps everything in memory, False or 0 keeps nothing,
+    an int N keeps the last N entries, a str is a directory for a `DiskHistory`, and a History or DiskHistory is used as is.
+    """
+
+    if isinstance(history, (History, DiskHistory)):
+        return history
+    if history is None or history is True:
+        return History()
+    if history is False or history == 0:
+        return NullHistory()
+    if isinstance(history, int):
+        return RingHistory(history)
+    if isinstance(history, str):
+        return DiskHistory(history)
+    raise ConfigError("`history` must be None, a bool, an int, a directory path, a History or a DiskHistory.")
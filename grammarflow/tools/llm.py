@@ -1,31 +1,101 @@
-from openai import OpenAI
+import httpx
+import openai
 import os
 import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
 import subprocess
+import http.client
 from stopit import threading_timeoutable as timeoutable
-from typing import Dict
+from typing import Dict, List
+
+from grammarflow.grammars.error import ParsingError, ConfigError
+from grammarflow.grammars.recognizer import GrammarRecognizer, recognizer
 
 
 class OpenAI:  # pylint: disable=missing-function-docstring
-    def __init__(self, model_name: str = 'gpt-3.5-turbo'):
-        self.client = OpenAI(
+    def __init__(self, model_name: str = 'gpt-3.5-turbo', base_url: str = None, retries: int = 2):
+        self.client = openai.OpenAI(
             api_key=os.environ["OPENAI_API_KEY"],
+            base_url=base_url,
         )
         self.model_name = model_name
+        self.retries = retries
+        self.stats = {"completions": 0, "aborted": 0}
 
-    def __call__(self, prompt: str, temperature: float = 0.1) -> str:
+    def __call__(self, prompt: str, temperature: float = 0.1, grammar: str = None, retries: int = None) -> str:
         """
         Args:
             prompt (str): The prompt to be passed to the model.
             temperature (float): Higher the temperature, the more creative the output. Default is 0.1.
+            grammar (str): GNBF grammar the whole completion must match. If given, the completion is streamed and cancelled as soon as it can no longer match, then retried.
+            retries (int): Retries after a cancelled completion. Defaults to `self.retries`.
+        Returns:
+            str: The output from the model.
+        Raises:
+            ParsingError: If `grammar` is given and every attempt diverged from it.
+        """
+
+        if not grammar:
+            response = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+            )
+            self.stats["completions"] += 1
+            return response.choices[0].message.content
+
+        grammar_recognizer = recognizer(grammar)
+        attempts = 1 + (self.retries if retries is None else retries)
+
+        for _ in range(attempts):
+            output, failed_at = self.stream(prompt, temperature, grammar_recognizer)
+            if failed_at is None:
+                return output
+
+        raise ParsingError(
+            f"ERROR: Completion diverged from the grammar at character {failed_at} in all {attempts} attempts! Last output: {output!r}")
+
+    def stream(self, prompt: str, temperature: float, grammar_recognizer: GrammarRecognizer):
         """
+        Streams one completion through `grammar_recognizer`, closing the connection at the first character that can't match.
+        The completion is checked like `Constrain.parse(grammar=)` checks output: each ```-fenced block (or the whole text, if unfenced)
+        must match, and a short preamble before the first fence is allowed (see `FencedMatcher`).
+        Returns the text received and the offset it diverged at (None if it matched).
+        """
+
+        matcher = grammar_recognizer.fenced_matcher()
+        chunks = []
 
-        response = self.client.chat.completions.create(
+        stream = self.client.chat.completions.create(
             model=self.model_name,
             messages=[{"role": "user", "content": prompt}],
             temperature=temperature,
+            stream=True,
         )
-        return response.choices[0].message.content
+        try:
+            for event in stream:
+                if not event.choices:
+                    continue
+                delta = event.choices[0].delta.content
+                if not delta:
+                    continue
+                chunks.append(delta)
+                if not matcher.feed(delta):
+                    self.stats["aborted"] += 1
+                    return "".join(chunks), matcher.failed_at
+        finally:
+            stream.close()  # Stops generation (and billing) server-side
+
+        self.stats["completions"] += 1
+        output = "".join(chunks)
+        if not matcher.close():
+            self.stats["aborted"] += 1
+            return output, len(output) if matcher.failed_at is None else matcher.failed_at  # Ended before the grammar did
+        return output, None
 
 # Taken from
 # https://stackoverflow.com/questions/11130156/suppress-stdout-stderr-print-from-python-functions
@@ -70,13 +140,17 @@ class LocalLlama:
     def __init__(
             self,
             gguf_path: str,
-            llama_cpp_path: str = os.environ['LLAMA']):
+            llama_cpp_path: str = None):
         """
         Initializes a barebones interface between user and llama.cpp
         Why? llama-cpp-python is quite slow. Discussion here: https://www.reddit.com/r/LocalLLaMA/comments/14evg0g/llamacpppython_is_slower_than_llamacpp_by_more/
+        `llama_cpp_path` defaults to the LLAMA environment variable.
         """
 
-        self.llama_cpp_path = llama_cpp_path
+        # Read here rather than as the default, so importing grammarflow doesn't need LLAMA set
+        self.llama_cpp_path = llama_cpp_path or os.environ.get('LLAMA')
+        if not self.llama_cpp_path:
+            raise ConfigError("llama.cpp path is not set! Pass `llama_cpp_path` or set the LLAMA environment variable.")
         self.gguf_path = gguf_path
         self.flags = {
             "repeat_penalty": 1.5,
@@ -103,34 +177,486 @@ class LocalLlama:
             timeout (int): The timeout for the model. Default is 50 seconds.
         Returns:
             str: The output from the model.
-        """
 
-        if flags:
-            self.flags.update(flags)
+        `flags` only apply to this call. Each call writes its prompt and grammar to its own temporary directory,
+        so calls from several threads don't overwrite each other's files.
+        """
 
-        flags = self.flags
+        flags = {**self.flags, **(flags or {})}
 
-        if grammar:
-            with open('./grammar.gnbf', 'w') as f:
-                f.write(grammar)
-            self.flags.update({'grammar-file': './grammar.gnbf'})
+        with tempfile.TemporaryDirectory() as directory:
+            prompt_path = self.write_file(prompt, directory)
 
-        self.write_file(prompt)
+            if grammar:
+                flags['grammar-file'] = os.path.join(directory, 'grammar.gnbf')
+                with open(flags['grammar-file'], 'w') as f:
+                    f.write(grammar)
 
-        with suppress_stdout_stderr():
+            # stderr is dropped per process (not with `suppress_stdout_stderr`, which swaps this process's streams under other threads)
             output = subprocess.check_output(
                 self.format_command(
-                    prompt, flags), shell=True).decode('utf-8')
+                    prompt_path, flags, temperature), shell=True, stderr=subprocess.DEVNULL).decode('utf-8')
 
         if stop_at:
             return output.split(stop_at)[1]
 
         return output
 
-    def write_file(self, prompt):
-        with open('./prompt.txt', 'w') as f:
+    def write_file(self, prompt: str, directory: str) -> str:
+        prompt_path = os.path.join(directory, 'prompt.txt')
+        with open(prompt_path, 'w') as f:
             f.write(prompt)
+        return prompt_path
 
-    def format_command(self, prompt: str, flags, temperature=0.1):
+    def format_command(self, prompt_path: str, flags, temperature=0.1):
         return f"{self.llama_cpp_path}/main  --model {self.gguf_path} {" ".join(
-            [f"--{k} {v}" for k, v in flags.items()])} --file ./prompt.txt --temp {temperature}"
+            [f"--{k} {v}" for k, v in flags.items()])} --file {prompt_path} --temp {temperature}"
+
+
+def completion_payload(defaults: Dict, flags: Dict, prompt: str, grammar: str, temperature: float, stop: List[str]) -> Dict:
+    """
+    Request body for llama.cpp server's /completion endpoint.
+    """
+
+    payload = {key.replace('-', '_'): value for key, value in defaults.items()}
+    if flags:
+        payload.update({key.replace('-', '_'): value for key, value in flags.items()})
+
+    payload.update({
+        "prompt": prompt,
+        "temperature": temperature,
+        "cache_prompt": True,  # Reuse the KV cache for the shared prefix of consecutive prompts
+    })
+    if grammar:
+        payload["grammar"] = grammar
+    if stop:
+        payload["stop"] = stop
+    return payload
+
+
+class LlamaServer:
+    def __init__(
+            self,
+            gguf_path: str = None,
+            llama_cpp_path: str = None,
+            host: str = '127.0.0.1',
+            port: int = 8080,
+            launch: bool = True,
+            server_flags: Dict = None,
+            startup_timeout: int = 300):
+        """
+        Interface to a long-lived llama.cpp server (`llama.cpp/server`) over HTTP.
+        The model is loaded once, and connections are kept alive across calls, so each call only pays for generation.
+        Thread-safe: concurrent calls use separate connections (start the server with `server_flags={'parallel': N}` to decode them in parallel).
+        Set `launch=False` to connect to a server that is already running on `host`:`port`.
+        `llama_cpp_path` defaults to the LLAMA environment variable. Callable in the same way as `LocalLlama`.
+        """
+
+        self.gguf_path = gguf_path
+        # Read here rather than as the default, so LLAMA set after importing grammarflow is used
+        self.llama_cpp_path = llama_cpp_path or os.environ.get('LLAMA')
+        self.host = host
+        self.port = port
+        self.flags = {
+            "repeat_penalty": 1.5,
+            "n_predict": -1,
+        }
+        self.server_flags = {
+            "n-gpu-layers": 15000,
+            "ctx-size": 2048,
+        }
+        if server_flags:
+            self.server_flags.update(server_flags)
+
+        self.process = None
+        self._idle = []  # Keep-alive connections not in use
+        self._lock = threading.Lock()
+
+        if launch:
+            if not (gguf_path and self.llama_cpp_path):
+                raise ConfigError("`gguf_path` and `llama_cpp_path` (or the LLAMA environment variable) are needed to launch the server.")
+            self.start(startup_timeout)
+
+    def start(self, startup_timeout: int = 300):
+        """
+        Launches the server process and blocks until it reports healthy.
+        """
+
+        command = [f"{self.llama_cpp_path}/server", "--model", self.gguf_path,
+                   "--host", self.host, "--port", str(self.port)]
+        for k, v in self.server_flags.items():
+            command += [f"--{k}", str(v)]
+
+        self.process = subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + startup_timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(
+                    f"llama.cpp server exited with code {self.process.returncode} during startup.")
+            try:
+                status, _ = self._request("GET", "/health", timeout=5)
+                if status == 200:
+                    return
+            except (OSError, http.client.HTTPException):
+                pass
+            time.sleep(0.5)
+
+        self.close()
+        raise TimeoutError("llama.cpp server did not become healthy in time.")
+
+    def __call__(
+            self,
+            prompt: str,
+            flags: Dict = None,
+            grammar: str = None,
+            stop_at: str = "",
+            temperature: float = 0.1,
+            timeout: int = 50,
+            stop: List[str] = None) -> str:
+        """
+        Args:
+            prompt (str): The prompt to be passed to the model.
+            flags (Dict): Sampling options for this request only, e.g. {'repeat_penalty': 1.1, 'n_predict': 256}.
+            grammar (str): The grammar to be passed to the model. Needs to be a string in GNBF format.
+            stop_at (str): Kept for parity with `LocalLlama`. The server does not echo the prompt, so this only trims output if present.
+            temperature (float): The temperature to be passed to the model.
+            timeout (int): The timeout for the request. Default is 50 seconds.
+            stop (List[str]): Strings at which the server stops generating.
+        Returns:
+            str: The output from the model.
+        """
+
+        payload = completion_payload(self.flags, flags, prompt, grammar, temperature, stop)
+
+        status, body = self._request(
+            "POST", "/completion", json.dumps(payload), timeout=timeout)
+        if status != 200:
+            raise RuntimeError(f"llama.cpp server returned {status}: {body[:200]}")
+
+        output = json.loads(body)["content"]
+
+        if stop_at and stop_at in output:
+            return output.split(stop_at)[1]
+
+        return output
+
+    def aio(self, max_concurrency: int = 4) -> "AsyncLlamaServer":
+        """
+        Async client for this server, sharing its address and default flags.
+        Start the server with `server_flags={'parallel': max_concurrency}` so requests are decoded in parallel slots.
+        """
+
+        return AsyncLlamaServer(self.host, self.port, max_concurrency, self.flags)
+
+    def _request(self, method: str, path: str, body: str = None, timeout: int = 50):
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+
+        # One retry on a fresh connection, in case the server dropped the idle one.
+        for attempt in range(2):
+            # Each request holds its own connection, so calls from several threads run in parallel server slots
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            reused = connection is not None
+            if not reused:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+            elif connection.sock is not None:
+                connection.sock.settimeout(timeout)
+
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                result = response.status, response.read().decode('utf-8')
+            except (ConnectionError, http.client.HTTPException):
+                connection.close()
+                if attempt or not reused:
+                    raise
+                continue
+            except OSError:
+                connection.close()
+                raise
+
+            with self._lock:
+                self._idle.append(connection)
+            return result
+
+    def close(self):
+        """
+        Closes the connections and stops the server if this object launched it.
+        """
+
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncOpenAI:  # pylint: disable=missing-function-docstring
+    def __init__(self, model_name: str = 'gpt-3.5-turbo', base_url: str = None, retries: int = 2, max_concurrency: int = 8):
+        """
+        Async version of `OpenAI`. At most `max_concurrency` requests are in flight at once; the rest wait their turn.
+        The client and the concurrency limit belong to the event loop they were made in, so a call from a new loop (eg. the next
+        `asyncio.run`) starts fresh ones, as `AsyncLlamaServer` does. `close` (or `async with`) before the loop ends.
+        """
+
+        self.api_key = os.environ["OPENAI_API_KEY"]
+        self.base_url = base_url
+        self.model_name = model_name
+        self.retries = retries
+        self.max_concurrency = max_concurrency
+        self.stats = {"completions": 0, "aborted": 0}
+        self._session = None  # (event loop, client, semaphore)
+
+    async def __call__(self, prompt: str, temperature: float = 0.1, grammar: str = None, retries: int = None) -> str:
+        """
+        Same arguments and behaviour as `OpenAI.__call__`.
+        """
+
+        if not grammar:
+            client, semaphore = self._connect()
+            async with semaphore:
+                response = await client.chat.completions.create(
+                    model=self.model_name,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=temperature,
+                )
+            self.stats["completions"] += 1
+            return response.choices[0].message.content
+
+        grammar_recognizer = recognizer(grammar)
+        attempts = 1 + (self.retries if retries is None else retries)
+
+        for _ in range(attempts):
+            output, failed_at = await self.stream(prompt, temperature, grammar_recognizer)
+            if failed_at is None:
+                return output
+
+        raise ParsingError(
+            f"ERROR: Completion diverged from the grammar at character {failed_at} in all {attempts} attempts! Last output: {output!r}")
+
+    async def stream(self, prompt: str, temperature: float, grammar_recognizer: GrammarRecognizer):
+        """
+        Same as `OpenAI.stream`.
+        """
+
+        matcher = grammar_recognizer.fenced_matcher()
+        chunks = []
+        client, semaphore = self._connect()
+
+        async with semaphore:
+            stream = await client.chat.completions.create(
+                model=self.model_name,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+                stream=True,
+            )
+            try:
+                async for event in stream:
+                    if not event.choices:
+                        continue
+                    delta = event.choices[0].delta.content
+                    if not delta:
+                        continue
+                    chunks.append(delta)
+                    if not matcher.feed(delta):
+                        self.stats["aborted"] += 1
+                        return "".join(chunks), matcher.failed_at
+            finally:
+                await stream.close()
+
+        self.stats["completions"] += 1
+        output = "".join(chunks)
+        if not matcher.close():
+            self.stats["aborted"] += 1
+            return output, len(output) if matcher.failed_at is None else matcher.failed_at
+        return output, None
+
+    def _connect(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session[0] is not loop:
+            client = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+            self._session = (loop, client, asyncio.Semaphore(self.max_concurrency))
+        return self._session[1:]
+
+    async def close(self):
+        """
+        Closes the client of the current event loop and its connections.
+        """
+
+        if self._session is not None and self._session[0] is asyncio.get_running_loop():
+            _, client, _ = self._session
+            self._session = None
+            await client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AsyncLocalLlama(LocalLlama):
+    def __init__(
+            self,
+            gguf_path: str,
+            llama_cpp_path: str = None,
+            max_concurrency: int = 1):
+        """
+        Async version of `LocalLlama`. Every call runs its own llama.cpp process with its own prompt/grammar files, at most `max_concurrency` at once.
+        Each process loads the model, so keep `max_concurrency` within what fits in memory; `LlamaServer.aio()` is the better choice for many requests.
+        """
+
+        super().__init__(gguf_path, llama_cpp_path)
+        self.max_concurrency = max_concurrency
+        self._limit = None  # (event loop, semaphore); a semaphore belongs to the loop it's used in, so each loop gets its own
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._limit is None or self._limit[0] is not loop:
+            self._limit = (loop, asyncio.Semaphore(self.max_concurrency))
+        return self._limit[1]
+
+    async def __call__(
+            self,
+            prompt: str,
+            flags: Dict = None,
+            grammar: str = None,
+            stop_at: str = "",
+            temperature: float = 0.1,
+            timeout: int = 50) -> str:
+        """
+        Same arguments as `LocalLlama.__call__`. `flags` only apply to this call.
+        """
+
+        flags = {**self.flags, **(flags or {})}
+
+        async with self._semaphore():
+            with tempfile.TemporaryDirectory() as directory:
+                prompt_path = os.path.join(directory, 'prompt.txt')
+                with open(prompt_path, 'w') as f:
+                    f.write(prompt)
+
+                if grammar:
+                    flags['grammar-file'] = os.path.join(directory, 'grammar.gnbf')
+                    with open(flags['grammar-file'], 'w') as f:
+                        f.write(grammar)
+
+                command = [f"{self.llama_cpp_path}/main", "--model", self.gguf_path]
+                for k, v in flags.items():
+                    command += [f"--{k}", str(v)]
+                command += ["--file", prompt_path, "--temp", str(temperature)]
+
+                process = await asyncio.create_subprocess_exec(
+                    *command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                try:
+                    stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+                    raise
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, stdout)
+
+        output = stdout.decode('utf-8')
+
+        if stop_at:
+            return output.split(stop_at)[1]
+
+        return output
+
+
+class AsyncLlamaServer:
+    def __init__(
+            self,
+            host: str = '127.0.0.1',
+            port: int = 8080,
+            max_concurrency: int = 4,
+            flags: Dict = None):
+        """
+        Async client for a running llama.cpp server (see `LlamaServer`, or `LlamaServer.aio()`).
+        Up to `max_concurrency` requests are in flight, over an `httpx.AsyncClient` that keeps their connections alive between calls.
+        The client and the concurrency limit belong to the event loop they were made in, so a call from a new loop (eg. the next
+        `asyncio.run`) starts fresh ones. `close` (or `async with`) before the loop ends, so its connections are closed with it.
+        """
+
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.flags = {
+            "repeat_penalty": 1.5,
+            "n_predict": -1,
+        }
+        if flags:
+            self.flags.update(flags)
+
+        self._session = None  # (event loop, client, semaphore)
+
+    async def __call__(
+            self,
+            prompt: str,
+            flags: Dict = None,
+            grammar: str = None,
+            stop_at: str = "",
+            temperature: float = 0.1,
+            timeout: int = 50,
+            stop: List[str] = None) -> str:
+        """
+        Same arguments as `LlamaServer.__call__`.
+        """
+
+        payload = completion_payload(self.flags, flags, prompt, grammar, temperature, stop)
+        client, semaphore = self._connect()
+
+        async with semaphore:
+            response = await asyncio.wait_for(client.post("/completion", json=payload), timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"llama.cpp server returned {response.status_code}: {response.text[:200]}")
+
+        output = response.json()["content"]
+
+        if stop_at and stop_at in output:
+            return output.split(stop_at)[1]
+
+        return output
+
+    def _connect(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session[0] is not loop:
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            client = httpx.AsyncClient(
+                base_url=f"http://{self.host}:{self.port}",
+                timeout=None,  # The whole request is bounded by `timeout` in `__call__`
+                transport=httpx.AsyncHTTPTransport(limits=limits, retries=1))  # Retries a connection the server dropped while idle
+            self._session = (loop, client, asyncio.Semaphore(self.max_concurrency))
+        return self._session[1:]
+
+    async def close(self):
+        """
+        Closes the client and waits for its connections to close.
+        """
+
+        if self._session is not None and self._session[0] is asyncio.get_running_loop():
+            _, client, _ = self._session
+            self._session = None
+            await client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -1,3 +1,8 @@
+import json
+import hashlib
+import weakref
+import threading
+
 from typing import Any, Dict, List, Optional, Type
 from pydantic import BaseModel
 
@@ -58,8 +63,13 @@ class ModelParser:
             temp[field_name] = {}
             if "anyOf" in schema["properties"][field_name]:
                 temp[field_name]["type"] = " OR ".join(
-                    [x["type"]
+                    [x["type"] if "type" in x else x["$ref"].split("/")[-1]
                      for x in schema["properties"][field_name]["anyOf"]])
+            elif "allOf" in schema["properties"][field_name]:
+                # A model or Enum field with a description: {"description": ..., "allOf": [{"$ref": ...}]}
+                temp[field_name]["type"] = " AND ".join(
+                    [x["type"] if "type" in x else x["$ref"].split("/")[-1]
+                     for x in schema["properties"][field_name]["allOf"]])
             elif "items" in schema["properties"][field_name]:
                 if "$ref" in schema["properties"][field_name]["items"]:
                     nested_model_name = schema["properties"][field_name][
@@ -84,11 +94,27 @@ class ModelParser:
 
         return temp
 
+    @staticmethod
+    def merge(d1: Dict, d2: Dict):
+        """
+        Recursively updates `d1` with `d2`.
+        """
+
+        for key, value in d2.items():
+            if key in d1:
+                if isinstance(d1[key], dict):
+                    ModelParser.merge(d1[key], value)
+                else:
+                    d1[key] = value
+            else:
+                d1[key] = value
+
     @staticmethod
     def extract_fields_with_descriptions(
             model_classes: List[Type[BaseModel]]) -> Dict[str, Dict[str, Dict[str, str]]]:
         """
         Extracts fields with descriptions from a list of Pydantic models.
+        Screened schemas come from `registry`, so they are computed once per model class. The inner dictionaries are shared; treat them as read-only.
 
         Args:
             model_classes (List[Type[BaseModel]]): List of Pydantic models.
@@ -96,38 +122,105 @@ class ModelParser:
             A dictionary with model names as keys and field names as keys of the inner dictionary. The inner dictionary contains field descriptions.
         """
 
-        def update_dict(d1, d2):
-            for key, value in d2.items():
-                if key in d1:
-                    if isinstance(d1[key], dict):
-                        update_dict(d1[key], value)
-                    else:
-                        d1[key] = value
-                else:
-                    d1[key] = value
-
         fields = {}
         nested = 0
 
         for _, model in enumerate(model_classes):
-            temp = {}
-            schema = model.schema()
+            entry = registry.get(model)
 
-            if "definitions" in schema:
+            if entry.has_definitions:
                 nested = 1
-                for nested_model_name, nested_model_schema in schema["definitions"].items(
-                ):
-                    fields[nested_model_name] = ModelParser.screen_model_schema(
-                        nested_model_schema)
-
-            # I'm processing the schema and model separately 
-            # Sometimes, the schema doesn't contain all the information I want (issue with pydantic versions and changes)
-            update_dict(temp, ModelParser.screen_model_schema(schema))
-            update_dict(temp, ModelParser.screen_field_info(model))
+                fields.update(entry.definitions)
 
             if hasattr(model, "__name__"):
-                fields[model.__name__] = temp
+                fields[model.__name__] = entry.fields
             else:
+                # Instances (eg. few-shot examples) carry their own values, so they aren't cached
+                temp = {field_name: dict(details) for field_name, details in entry.fields.items()}
+                ModelParser.merge(temp, ModelParser.screen_field_info(model))
                 fields[model.__class__.__name__] = temp
 
         return fields, nested
+
+
+class SchemaEntry:
+    """
+    Everything derived from one model's schema: the schema itself, its screened field table, its screened nested definitions and a fingerprint.
+    """
+
+    __slots__ = ("schema", "fields", "definitions", "has_definitions", "fingerprint")
+
+    def __init__(self, model: Type[BaseModel]):
+        self.schema = model.schema()
+        self.has_definitions = "definitions" in self.schema
+        self.definitions = {
+            nested_model_name: ModelParser.screen_model_schema(nested_model_schema)
+            for nested_model_name, nested_model_schema in self.schema.get("definitions", {}).items()
+            if "properties" in nested_model_schema  # Enums are definitions too, but have no fields
+        }
+
+        # I'm processing the schema and model separately 
+        # Sometimes, the schema doesn't contain all the information I want (issue with pydantic versions and changes)
+        self.fields = {}
+        ModelParser.merge(self.fields, ModelParser.screen_model_schema(self.schema))
+        ModelParser.merge(self.fields, ModelParser.screen_field_info(model))
+
+        self.fingerprint = hashlib.sha256(
+            json.dumps(self.schema, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class SchemaRegistry:
+    """
+    Computes each model's SchemaEntry once and shares it between the formatters and the grammar generator.
+    Entries are dropped when their class is garbage collected, or when a class with the same module and name is registered (ie. the model was redefined).
+    Thread-safe like `LRUCache`: concurrent misses on a model may each build an entry, but all of them get the one registered first.
+    """
+
+    def __init__(self):
+        self._entries = weakref.WeakKeyDictionary()
+        self._names = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model: Type[BaseModel]) -> SchemaEntry:  # pylint: disable=missing-function-docstring
+        cls = model if isinstance(model, type) else type(model)
+
+        with self._lock:
+            entry = self._entries.get(cls)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = SchemaEntry(cls)  # Outside the lock: schema generation is slow and other models shouldn't wait on it
+
+        with self._lock:
+            registered = self._entries.get(cls)
+            if registered is not None:
+                return registered
+
+            name = (cls.__module__, cls.__qualname__)
+            previous = self._names.get(name)
+            previous = previous() if previous is not None else None
+            if previous is not None and previous is not cls:
+                self._entries.pop(previous, None)
+
+            self._entries[cls] = entry
+            self._names[name] = weakref.ref(cls)
+            return entry
+
+    def invalidate(self, model: Type[BaseModel] = None):
+        """
+        Drops the entry for `model`, or every entry if no model is given.
+        """
+
+        with self._lock:
+            if model is None:
+                self._entries.clear()
+                self._names.clear()
+            else:
+                self._entries.pop(model if isinstance(model, type) else type(model), None)
+
+
+registry = SchemaRegistry()
@@ -0,0 +1,148 @@
+from grammarflow.grammars.error import ConfigError
+from grammarflow.tools.response import Response
+
+import sys
+import weakref
+from typing import Any, Dict, List, Type, get_args
+from pydantic import BaseModel
+
+
+class Record:
+    """
+    Base for the `__slots__` classes generated by `record_class`.
+    Values are converted once when the record is built; attribute access is a plain slot read.
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _nested = {}
+
+    def __init__(self, data: Dict = None):
+        if not isinstance(data, dict):
+            data = {}
+        nested = self._nested
+        for field in self._fields:
+            value = data.get(field)
+            if field in nested and value is not None:
+                value = _convert(nested[field], value)
+            setattr(self, field, value)
+
+    def to_dict(self) -> Dict:  # pylint: disable=missing-function-docstring
+        return {field: _unwrap(getattr(self, field)) for field in self._fields}
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self._fields)
+
+    def __repr__(self):
+        values = ", ".join(f"{field}={getattr(self, field)!r}" for field in self._fields)
+        return f"{type(self).__name__}({values})"
+
+
+_RESERVED = frozenset(dir(Record))
+
+
+# Keyed weakly, like `SchemaRegistry`: a redefined model (same module and name) replaces the class generated for the old one
+_classes = weakref.WeakKeyDictionary()
+_names = {}
+
+
+def record_class(model: Type[BaseModel]) -> Type[Record]:
+    """
+    Returns the record class for `model`, generating it (and the classes of nested models) on first use.
+    Raises ConfigError if a field would shadow an attribute of `Record` (eg. a field named `to_dict`).
+    """
+
+    cls = _classes.get(model)
+    if cls is not None:
+        return cls
+
+    clashes = [name for name in model.__fields__ if name in _RESERVED]
+    if clashes:
+        raise ConfigError(f"Fields {clashes} of {model.__name__} clash with Record attributes and can't be record slots.")
+
+    key = (model.__module__, model.__qualname__)
+    previous = _names.get(key)
+    previous = previous() if previous is not None else None
+    if previous is not None and previous is not model:
+        _classes.pop(previous, None)
+
+    fields = tuple(sys.intern(name) for name in model.__fields__)
+    cls = type(model.__name__, (Record,), {
+        "__slots__": fields,
+        "__module__": __name__,
+        "_fields": fields,
+        "_nested": {},
+    })
+    _classes[model] = cls  # Registered before recursing, so self-referencing models terminate
+    _names[key] = weakref.ref(model)
+
+    try:
+        for name, field in model.__fields__.items():
+            nested_model = _nested_model(field)
+            if nested_model is not None:
+                cls._nested[sys.intern(name)] = record_class(nested_model)
+    except ConfigError:
+        _classes.pop(model, None)  # Not left half-built
+        raise
+
+    return cls
+
+
+def to_records(data: Any, models: List[Type[BaseModel]]) -> Any:
+    """
+    Converts parsed output ({ModelName: fields} per object, as returned by the format parsers) into records.
+    Objects whose name matches none of `models` are left as they are. A single object is returned unwrapped.
+    """
+
+    classes = {model.__name__: record_class(model) for model in models}
+
+    records = []
+    for obj in (data if isinstance(data, list) else [data]):
+        if isinstance(obj, Response):  # parse_helper wraps each object of a multi-object output
+            obj = obj._data  # pylint: disable=protected-access
+        if not isinstance(obj, dict):
+            records.append(obj)
+            continue
+        for name, value in obj.items():
+            cls = classes.get(name)
+            if cls is None:
+                records.append({name: value})
+            elif isinstance(value, list):  # TOML keeps every section as a list
+                records.extend(_convert(cls, item) for item in value)
+            else:
+                records.append(_convert(cls, value))
+
+    return records[0] if len(records) == 1 else records
+
+
+def _convert(cls: Type[Record], value: Any) -> Any:
+    if isinstance(value, dict):
+        return cls(value)
+    elif isinstance(value, list):
+        return [_convert(cls, item) for item in value]
+    return value
+
+
+def _unwrap(value: Any) -> Any:
+    if isinstance(value, Record):
+        return value.to_dict()
+    elif isinstance(value, list):
+        return [_unwrap(item) for item in value]
+    return value
+
+
+def _nested_model(field: Any) -> Type[BaseModel]:
+    '''
+    Finds a pydantic model in a field's type, including inside List[...]/Optional[...].
+    '''
+
+    annotation = getattr(field, "outer_type_", None) or getattr(field, "annotation", None)
+    pending = [annotation]
+    while pending:
+        candidate = pending.pop()
+        if isinstance(candidate, type) and issubclass(candidate, BaseModel):
+            return candidate
+        pending.extend(get_args(candidate))
+    return None
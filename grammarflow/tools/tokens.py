@@ -0,0 +1,237 @@
+from grammarflow.grammars.error import ConfigError
+from grammarflow.tools.cache import LRUCache
+from grammarflow.tools.history import digest
+
+import re
+import math
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
+
+
+class Tokenizer(ABC):
+    """
+    Counts tokens of text. Subclasses implement `encode`; `count_batch` can be overridden where the backend batches natively.
+    """
+
+    name = "tokenizer"
+
+    @abstractmethod
+    def encode(self, text: str) -> List:  # pylint: disable=missing-function-docstring
+        pass
+
+    def count(self, text: str) -> int:  # pylint: disable=missing-function-docstring
+        return len(self.encode(text))
+
+    def count_batch(self, texts: List[str]) -> List[int]:  # pylint: disable=missing-function-docstring
+        return [self.count(text) for text in texts]
+
+
+class TiktokenTokenizer(Tokenizer):
+    """
+    OpenAI's BPE encodings through `tiktoken`. `model` is a model name ("gpt-3.5-turbo") or an encoding name ("cl100k_base").
+    The encoding is downloaded on first use if tiktoken hasn't cached it, which needs network access.
+    """
+
+    def __init__(self, model: str = "gpt-3.5-turbo", num_threads: int = 8):
+        import tiktoken  # pylint: disable=import-outside-toplevel
+
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding(model)
+        self.name = f"tiktoken:{model}"
+        self.num_threads = num_threads
+
+    def encode(self, text: str) -> List[int]:
+        # Special tokens (eg. "<|endoftext|>") inside a prompt are counted as text, not rejected
+        return self.encoding.encode_ordinary(text)
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts, num_threads=self.num_threads)]
+
+
+class OfflineTokenizer(Tokenizer):
+    """
+    Estimate of BPE token counts that needs no vocabulary: text is pre-split like GPT tokenizers do (words with their leading space,
+    up to 3 digits, punctuation runs, whitespace runs), then long words and punctuation runs count as several tokens.
+    A rough estimate: good for comparing prompts and sections, not for exact context limits.
+    """
+
+    name = "offline"
+
+    _PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)|[^\r\n\w]?[^\W\d_]+|\d{1,3}| ?[^\s\w]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+", re.IGNORECASE)
+
+    def __init__(self, chars_per_word_token: int = 8, chars_per_symbol_token: int = 2):
+        self.chars_per_word_token = chars_per_word_token
+        self.chars_per_symbol_token = chars_per_symbol_token
+
+    def encode(self, text: str) -> List[str]:
+        return self._PIECES.findall(text)
+
+    def count(self, text: str) -> int:
+        count = 0
+        for piece in self._PIECES.findall(text):
+            stripped = piece.strip()
+            if not stripped or stripped.isdigit():
+                count += 1
+            elif stripped[-1].isalpha():
+                count += math.ceil(len(stripped) / self.chars_per_word_token)
+            else:
+                count += math.ceil(len(stripped) / self.chars_per_symbol_token)
+        return count
+
+
+class FunctionTokenizer(Tokenizer):
+    """
+    Adapts any callable returning token ids (eg. a HuggingFace tokenizer's `encode`, llama.cpp's `Llama.tokenize`) or a count.
+    """
+
+    def __init__(self, function: Callable[[str], Union[List, int]], name: str = "function"):
+        self.function = function
+        self.name = name
+
+    def encode(self, text: str) -> List:
+        return self.function(text)
+
+    def count(self, text: str) -> int:
+        tokens = self.function(text)
+        return tokens if isinstance(tokens, int) else len(tokens)
+
+
+_tokenizers = {}
+
+
+def get_tokenizer(tokenizer: Any = None) -> Tokenizer:
+    """
+    Resolves `tokenizer` to a Tokenizer. Named tokenizers are built once per process and shared.
+
+    Args:
+        tokenizer: None (tiktoken's gpt-3.5-turbo encoding), "offline" (the `OfflineTokenizer` estimate, which needs neither
+            tiktoken nor network), a tiktoken model or encoding name, a Tokenizer, or a callable returning token ids or a count.
+
+    Raises:
+        ConfigError: If the default tokenizer can't be loaded. Nothing is cached, so a later call retries.
+    """
+
+    if isinstance(tokenizer, Tokenizer):
+        return tokenizer
+    if callable(tokenizer):
+        return FunctionTokenizer(tokenizer, getattr(tokenizer, "__qualname__", "function"))
+
+    name = tokenizer or "default"
+    if name not in _tokenizers:
+        if name == "offline":
+            _tokenizers[name] = OfflineTokenizer()
+        elif name == "default":
+            try:
+                _tokenizers[name] = TiktokenTokenizer("gpt-3.5-turbo")
+            except Exception as e:  # pylint: disable=broad-except
+                # Not installed, or no network for the first download of the encoding. Estimates are opt-in: a budget counted
+                # with them can be off by enough to overflow the context.
+                raise ConfigError(
+                    f"tiktoken's gpt-3.5-turbo encoding can't be loaded ({type(e).__name__}: {e}). "
+                    "Use `TokenCounter(\"offline\")` for estimated counts.") from e
+        else:
+            _tokenizers[name] = TiktokenTokenizer(name)
+    return _tokenizers[name]
+
+
+class TokenCounter:
+    """
+    Counts tokens with a memo of recent texts, so a prompt (or a grammar block repeated across prompts) is encoded once.
+    The memo is keyed by a digest of each text, so it doesn't keep the texts themselves alive.
+    The tokenizer is resolved on first use, so creating a counter costs nothing.
+    """
+
+    def __init__(self, tokenizer: Any = None, maxsize: int = 4096):
+        self._tokenizer = tokenizer
+        self._resolved = None
+        self.cache = LRUCache(maxsize)
+
+    @property
+    def tokenizer(self) -> Tokenizer:  # pylint: disable=missing-function-docstring
+        if self._resolved is None:
+            self._resolved = get_tokenizer(self._tokenizer)
+        return self._resolved
+
+    def count(self, text: str) -> int:  # pylint: disable=missing-function-docstring
+        return self.count_many([text])[0]
+
+    def count_many(self, texts: Iterable[str]) -> List[int]:
+        '''
+        Counts for every text, in order. Texts not in the memo are encoded in one batch, each distinct text once.
+        '''
+
+        texts = list(texts)
+        keys = [digest(text) for text in texts]
+        counts = [self.cache.get(key) for key in keys]
+
+        missing = dict((key, text) for key, text, count in zip(keys, texts, counts) if count is None)
+        if missing:
+            computed = dict(zip(missing, self.tokenizer.count_batch(list(missing.values()))))
+            for key, count in computed.items():
+                self.cache.put(key, count)
+            counts = [computed[key] if count is None else count for key, count in zip(keys, counts)]
+
+        return counts
+
+    @staticmethod
+    def inflation(before: int, after: int) -> Dict[str, Any]:  # pylint: disable=missing-function-docstring
+        return {
+            "before": before,
+            "after": after,
+            "factor": f"{((after - before) / before):.1f}x" if before else "n/a",
+        }
+
+    def history(self, history: Dict[int, Dict[str, str]]) -> Dict[int, Dict[str, Any]]:
+        '''
+        Inflation (template vs. final prompt tokens) of every entry of a `Constrain.history`, counted in one batch.
+        '''
+
+        indices = list(history)
+        counts = self.count_many(
+            text for idx in indices for text in (history[idx]['initial_prompt'], history[idx]['filled_prompt']))
+        return {idx: self.inflation(counts[2 * i], counts[2 * i + 1]) for i, idx in enumerate(indices)}
+
+    def breakdown(self, sections: List[Tuple[int, List[Tuple[str, str]]]], placeholders: Dict[str, str] = None) -> Dict[str, Any]:
+        '''
+        Tokens per section and per kind of content, from `PromptBuilder.build_segments`, with `placeholders` filled in.
+
+        Returns:
+            {"total": tokens of the whole prompt,
+             "kinds": {"text", "grammar", "examples", "placeholders"},
+             "placeholders": {name: tokens},
+             "sections": [{"index", "tokens", <kind>: tokens}]}
+            Parts are counted separately, so they can sum to slightly more or less than "total".
+        '''
+
+        placeholders = placeholders or {}
+
+        def fill(kind, text):
+            if kind == "placeholder":
+                value = placeholders.get(text[1:-1])
+                return text if value is None else str(value)
+            return text
+
+        filled = [[(kind, fill(kind, text), text) for kind, text in segments] for _, segments in sections]
+        texts = ["".join(text for _, text, _ in segments) for segments in filled]
+        prompt = "".join(text + "\n" for text in texts if text).strip()  # As `PromptBuilder.build` joins them
+        counts = iter(self.count_many([prompt] + [text for segments in filled for _, text, _ in segments]))
+        total = next(counts)
+
+        kinds = dict.fromkeys(("text", "grammar", "examples", "placeholders"), 0)
+        by_placeholder = {}
+        by_section = []
+        for (index, _), segments in zip(sections, filled):
+            section = {"index": index, "tokens": 0}
+            for kind, _, raw in segments:
+                count = next(counts)
+                section["tokens"] += count
+                if kind == "placeholder":
+                    kind = "placeholders"
+                    by_placeholder[raw[1:-1]] = by_placeholder.get(raw[1:-1], 0) + count
+                section[kind] = section.get(kind, 0) + count
+                kinds[kind] += count
+            by_section.append(section)
+
+        return {"total": total, "kinds": kinds, "placeholders": by_placeholder, "sections": by_section}
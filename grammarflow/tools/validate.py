@@ -0,0 +1,68 @@
+from grammarflow.grammars.error import ParsingError
+from grammarflow.tools.cache import LRUCache
+from grammarflow.tools.response import Response
+
+from typing import Any, Callable, Dict, List, Type
+from pydantic import BaseModel
+
+
+class ModelIndex:
+    """
+    Maps the root key of each parsed object (the model name) to its model, so every object is validated against exactly one model.
+    """
+
+    def __init__(self, models: List[Type[BaseModel]]):
+        self.models = {model.__name__: model for model in models}
+        self.validators = {name: self.validator(model) for name, model in self.models.items()}
+
+    @staticmethod
+    def validator(model: Type[BaseModel]) -> Callable[[Dict], BaseModel]:
+        '''
+        Fastest validation entry point the installed pydantic offers.
+        '''
+
+        core_validator = getattr(model, "__pydantic_validator__", None)  # pydantic v2
+        if core_validator is not None and hasattr(core_validator, "validate_python"):
+            return core_validator.validate_python
+        return model.parse_obj  # pydantic v1
+
+    def validate(self, data: Any) -> Any:
+        '''
+        Validates parsed output ({ModelName: fields} per object). A single object is returned unwrapped.
+        '''
+
+        instances = []
+        for obj in (data if isinstance(data, list) else [data]):
+            if isinstance(obj, Response):  # parse_helper wraps each object of a multi-object output
+                obj = obj._data  # pylint: disable=protected-access
+            if not isinstance(obj, dict):
+                raise ParsingError(f"ERROR: Expected a model object, got {type(obj).__name__}!")
+            for name, value in obj.items():
+                validator = self.validators.get(name)
+                if validator is None:
+                    raise ParsingError(f"ERROR: '{name}' does not match any of {list(self.models)}!")
+                try:
+                    if isinstance(value, list):  # TOML keeps every section as a list
+                        instances.extend(validator(item) for item in value)
+                    else:
+                        instances.append(validator(value))
+                except ValueError as exc:  # pydantic's ValidationError subclasses ValueError in v1 and v2
+                    raise ParsingError(f"ERROR: Response does not validate as {name}!") from exc
+
+        return instances[0] if len(instances) == 1 else instances
+
+
+_indexes = LRUCache(maxsize=64)
+
+
+def model_index(models: List[Type[BaseModel]]) -> ModelIndex:
+    """
+    Cached ModelIndex for a list of models.
+    """
+
+    key = tuple(models)
+    index = _indexes.get(key)
+    if index is None:
+        index = ModelIndex(models)
+        _indexes.put(key, index)
+    return index
@@ -14,6 +14,7 @@ setup(
         'pydantic==1.9.0',
         'tiktoken==0.6.0',
         'openai==1.14.1', 
+        'httpx>=0.23.0,<1',  # Also installed by openai; used directly by AsyncLlamaServer
         'stopit==1.1.2',    
     ],
     classifiers=[
@@ -0,0 +1,27 @@
+'''
+Stand-in HTTP servers for the backend and fetcher tests: `serve(Handler)` runs an `http.server` handler class on a free local port
+for the duration of a test.
+'''
+from http.server import ThreadingHTTPServer
+
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(handler):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,188 @@
+from http.server import BaseHTTPRequestHandler
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks", "hotpotqa"))
+
+requests = pytest.importorskip("requests")
+from fetch import CachedFetcher  # pylint: disable=wrong-import-position
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    '''
+    Canned pages: /page/<name> is "<name> " repeated, /error a 500 and /search a Wikipedia search page (see `search_page`).
+    `status` overrides every response's status. Every GET is counted in `hits`.
+    '''
+
+    protocol_version = "HTTP/1.1"
+    status = None
+    hits = []
+    search_page = ""
+
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path.startswith("/page/"):
+            status, body = 200, (self.path[len("/page/"):].split("?")[0] + " ") * 20
+        elif self.path.startswith("/w/index.php"):
+            status, body = 200, self.search_page
+        else:
+            status, body = 500, "server error"
+        data = body.encode()
+        self.send_response(self.status or status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def url(serve):
+    PageHandler.status = None
+    PageHandler.hits = []
+    PageHandler.search_page = ""
+    return f"http://127.0.0.1:{serve(PageHandler).server_port}"
+
+
+def cache_files(cache_dir):
+    return {name: sorted(os.listdir(os.path.join(cache_dir, name))) for name in ("blobs", "index")}
+
+
+def test_cached_after_first_get(url, tmp_path):
+    fetcher = CachedFetcher(cache_dir=str(tmp_path))
+    assert fetcher.get(f"{url}/page/a") == "a " * 20
+    assert fetcher.get(f"{url}/page/a") == "a " * 20
+    assert len(PageHandler.hits) == 1
+    assert fetcher.stats()["cache_hits"] == 1 and fetcher.stats()["num_fetches"] == 1
+
+    # The disk cache outlives the fetcher
+    assert CachedFetcher(cache_dir=str(tmp_path)).get(f"{url}/page/a") == "a " * 20
+    assert len(PageHandler.hits) == 1
+
+
+def test_same_text_stored_once(url, tmp_path):
+    fetcher = CachedFetcher(cache_dir=str(tmp_path))
+    fetcher.get(f"{url}/page/a")
+    fetcher.get(f"{url}/page/a?again")  # Same text under another URL
+    files = cache_files(str(tmp_path))
+    assert len(files["blobs"]) == 1 and len(files["index"]) == 2
+
+
+def test_expired_entries_are_refetched(url, tmp_path):
+    fetcher = CachedFetcher(cache_dir=str(tmp_path), ttl=3600)
+    fetcher.get(f"{url}/page/a")
+    (index,) = cache_files(str(tmp_path))["index"]
+    path = os.path.join(str(tmp_path), "index", index)
+    with open(path) as f:
+        entry = json.load(f)
+    entry["time"] -= 7200
+    with open(path, "w") as f:
+        json.dump(entry, f)
+
+    fetcher.get(f"{url}/page/a")
+    assert len(PageHandler.hits) == 2
+
+
+def test_least_recently_used_blobs_evicted(url, tmp_path):
+    page_bytes = len("page0 " * 20)
+    fetcher = CachedFetcher(cache_dir=str(tmp_path), max_bytes=3 * page_bytes)
+    for i in range(3):
+        fetcher.get(f"{url}/page/page{i}")
+        with open(fetcher._index_path(f"{url}/page/page{i}")) as f:
+            os.utime(fetcher._blob_path(json.load(f)["blob"]), (i, i))  # page0 least recently used
+
+    fetcher.get(f"{url}/page/page3")  # Over the limit: evicted down to 90% of it
+    assert fetcher.stats()["cache_bytes"] <= 0.9 * 3 * page_bytes
+    assert len(cache_files(str(tmp_path))["blobs"]) == 2
+
+    hits = len(PageHandler.hits)
+    fetcher.get(f"{url}/page/page2")
+    assert len(PageHandler.hits) == hits
+    fetcher.get(f"{url}/page/page0")  # Its index entry points at an evicted blob: a miss
+    assert len(PageHandler.hits) == hits + 1
+
+
+def test_failed_write_leaves_no_partial_file(url, tmp_path, monkeypatch):
+    fetcher = CachedFetcher(cache_dir=str(tmp_path))
+
+    def fail(*_):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    assert fetcher.get(f"{url}/page/a") == "a " * 20  # The page is still returned
+    assert cache_files(str(tmp_path)) == {"blobs": [], "index": []}
+
+
+def test_truncated_index_is_a_miss(url, tmp_path):
+    fetcher = CachedFetcher(cache_dir=str(tmp_path))
+    fetcher.get(f"{url}/page/a")
+    with open(fetcher._index_path(f"{url}/page/a"), "w") as f:
+        f.write('{"key": ')
+    assert fetcher.get(f"{url}/page/a") == "a " * 20
+    assert len(PageHandler.hits) == 2
+
+
+def test_error_status_raises_and_is_not_cached(url, tmp_path):
+    fetcher = CachedFetcher(cache_dir=str(tmp_path))
+    PageHandler.status = 503
+    with pytest.raises(requests.HTTPError):
+        fetcher.get(f"{url}/page/a")
+    assert fetcher.stats()["num_fetch_errors"] == 1
+    assert cache_files(str(tmp_path)) == {"blobs": [], "index": []}
+
+    PageHandler.status = None
+    assert fetcher.get(f"{url}/page/a") == "a " * 20
+
+
+def test_unreachable_host_raises(tmp_path):
+    fetcher = CachedFetcher(cache_dir=str(tmp_path), timeout=(1, 1))
+    with pytest.raises(requests.RequestException):
+        fetcher.get("http://127.0.0.1:9/page/a")
+    assert fetcher.stats()["num_fetch_errors"] == 1
+
+
+def test_cleaned_value_cached(url, tmp_path):
+    fetcher = CachedFetcher(cache_dir=str(tmp_path))
+    calls = []
+
+    def clean(text):
+        calls.append(text)
+        return {"words": len(text.split())}
+
+    for _ in range(2):
+        assert fetcher.get_clean(f"{url}/page/a", clean) == {"words": 20}
+    assert len(calls) == 1
+
+
+@pytest.fixture
+def wiki_env(url, tmp_path):
+    pytest.importorskip("gym")
+    pytest.importorskip("bs4")
+    from wikienv import WikiEnv  # pylint: disable=import-outside-toplevel
+
+    env = WikiEnv(CachedFetcher(cache_dir=str(tmp_path)), base_url=url)
+    env.reset()
+    return env
+
+
+def test_search_failure_is_an_observation(wiki_env):
+    PageHandler.status = 500
+    observation, _, done, _ = wiki_env.step("search[Foo Bar]")
+    assert observation == "Could not find Foo Bar. Similar: []." and not done
+
+    # Not cached: once the server recovers, the same search finds the page
+    PageHandler.status = None
+    PageHandler.search_page = "<p>Foo Bar is a placeholder name used in examples.</p>"
+    observation, _, _, _ = wiki_env.step("search[Foo Bar]")
+    assert observation.startswith("Foo Bar is a placeholder name")
+
+
+def test_search_titles(wiki_env):
+    PageHandler.search_page = '<div class="mw-search-result-heading">Foo</div><div class="mw-search-result-heading">Bar</div>'
+    observation, _, _, _ = wiki_env.step("search[Baz]")
+    assert observation == "Could not find Baz. Similar: ['Foo', 'Bar']."
@@ -0,0 +1,109 @@
+from grammarflow.grammars.error import ConfigError
+from grammarflow.tools.llm import LlamaServer
+
+from http.server import BaseHTTPRequestHandler
+
+import asyncio
+import json
+
+import pytest
+
+
+class LlamaHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in for llama.cpp's server: /health, and /completion echoing the prompt. Every request is recorded.
+    A prompt of "error" gets a 500, and "close" a response after which the server closes the connection.
+    '''
+
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def log_message(self, *_):
+        pass
+
+    def reply(self, status, body, close=False):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if close:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.reply(200 if self.path == "/health" else 404, {"status": "ok"})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append({"path": self.path, "payload": payload, "port": self.client_address[1]})
+        if payload["prompt"] == "error":
+            self.reply(500, {"error": "bad request"})
+        else:
+            self.reply(200, {"content": f"echo: {payload['prompt']}"}, close=payload["prompt"] == "close")
+
+
+@pytest.fixture
+def server(serve):
+    LlamaHandler.requests = []
+    return serve(LlamaHandler)
+
+
+def test_completion_payload(server):
+    with LlamaServer(port=server.server_port, launch=False) as llm:
+        assert llm("hello", grammar="root ::= \"x\"", stop=["\n"], flags={"n-predict": 8}, temperature=0.5) == "echo: hello"
+        assert llm("again") == "echo: again"
+
+    first, second = (request["payload"] for request in LlamaHandler.requests)
+    assert LlamaHandler.requests[0]["path"] == "/completion"
+    assert first["grammar"] == "root ::= \"x\"" and first["stop"] == ["\n"] and first["temperature"] == 0.5
+    assert first["n_predict"] == 8 and first["cache_prompt"] is True
+    # Per-call flags, grammar and stop don't carry over to the next call
+    assert second["n_predict"] == -1 and "grammar" not in second and "stop" not in second
+
+
+def test_connection_reused(server):
+    with LlamaServer(port=server.server_port, launch=False) as llm:
+        for i in range(5):
+            llm(f"prompt {i}")
+    assert len({request["port"] for request in LlamaHandler.requests}) == 1
+
+
+def test_reconnects_after_server_closes(server):
+    with LlamaServer(port=server.server_port, launch=False) as llm:
+        assert llm("close") == "echo: close"
+        assert llm("after") == "echo: after"
+    assert len({request["port"] for request in LlamaHandler.requests}) == 2
+
+
+def test_stop_at(server):
+    with LlamaServer(port=server.server_port, launch=False) as llm:
+        assert llm("answer", stop_at="echo: ") == "answer"
+
+
+def test_error_status(server):
+    with LlamaServer(port=server.server_port, launch=False) as llm:
+        with pytest.raises(RuntimeError, match="500"):
+            llm("error")
+
+
+def test_llama_path_read_when_created(monkeypatch):
+    monkeypatch.setenv("LLAMA", "/opt/llama.cpp")
+    assert LlamaServer(launch=False).llama_cpp_path == "/opt/llama.cpp"
+    monkeypatch.delenv("LLAMA")
+    with pytest.raises(ConfigError):
+        LlamaServer(gguf_path="model.gguf")
+
+
+def test_async_client(server):
+    llm = LlamaServer(port=server.server_port, launch=False).aio(max_concurrency=2)
+
+    async def run():
+        async with llm:
+            return await asyncio.gather(*(llm(f"prompt {i}") for i in range(6)))
+
+    # Each asyncio.run is a new event loop; the client must not be reused across them
+    for _ in range(2):
+        assert asyncio.run(run()) == [f"echo: prompt {i}" for i in range(6)]
+    assert len({request["port"] for request in LlamaHandler.requests}) <= 4
@@ -0,0 +1,148 @@
+from grammarflow.constrain import Constrain
+from grammarflow.grammars.error import ParsingError
+from grammarflow.prompt.builder import PromptBuilder
+from grammarflow.tools.llm import AsyncOpenAI, OpenAI
+
+from http.server import BaseHTTPRequestHandler
+from pydantic import BaseModel, Field
+from typing import List
+
+import asyncio
+import json
+import threading
+
+import pytest
+
+
+class Score(BaseModel):
+    yes: int = Field(..., description="Votes for")
+    no: int
+
+
+class Answer(BaseModel):
+    target_scores: Score
+    reasoning: str = Field(..., description="Why")
+    items: List[str]
+    final: bool
+
+
+ANSWER = {"target_scores": {"yes": 1, "no": 0}, "reasoning": "because", "items": ["a", "b"], "final": True}
+FENCED = "```json\n" + json.dumps({"Answer": ANSWER}, indent=2) + "\n```"
+PROSE = "I am not sure what you mean. " * 40
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in for an OpenAI-compatible chat completions endpoint. Each request streams the next scripted completion in 4-character
+    deltas, and records in `sent` how much of it went out before the client hung up.
+    '''
+
+    protocol_version = "HTTP/1.1"
+    completions = []
+    sent = []
+
+    def log_message(self, *_):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        text = self.completions.pop(0)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        progress = [0]  # A list, since the handler may still be running when the next call starts
+        self.sent.append(progress)
+        try:
+            for i in range(0, len(text), 4):
+                chunk = {"id": "x", "object": "chat.completion.chunk", "created": 0, "model": "stand-in",
+                         "choices": [{"index": 0, "delta": {"content": text[i:i + 4]}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                progress[0] = i + 4
+                threading.Event().wait(0.002)  # Gives the client time to hang up mid-stream
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+@pytest.fixture
+def base_url(serve, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "stand-in")
+    StreamHandler.completions = []
+    StreamHandler.sent = []
+    return f"http://127.0.0.1:{serve(StreamHandler).server_port}/v1"
+
+
+@pytest.fixture(scope="module")
+def grammar():
+    with Constrain("json") as manager:
+        return manager.get_grammar(Answer)
+
+
+def call(llm, grammar, *scripted):
+    '''
+    Output of one grammar-constrained call over the scripted completions (None if it raised), and the number of requests it made.
+    '''
+
+    StreamHandler.completions[:] = scripted
+    StreamHandler.sent.clear()
+    try:
+        return llm("prompt", grammar=grammar), len(StreamHandler.sent)
+    except ParsingError:
+        return None, len(StreamHandler.sent)
+
+
+def test_prompt_and_grammar_spell_keys_alike(grammar):
+    with Constrain("json") as manager:
+        builder = PromptBuilder()
+        builder.add_section(define_grammar=True)
+        prompt = manager.format(builder, [{"description": "Answer", "model": Answer}])
+    assert "target_scores" in prompt
+    assert "target_scores" in grammar and "target-scores" not in grammar
+
+
+@pytest.mark.parametrize("text", [
+    FENCED,
+    "Sure, here it is:\n" + FENCED + "\nAnything else?",
+    json.dumps({"Answer": ANSWER}),
+    "\n  " + json.dumps({"Answer": ANSWER}, indent=4),
+], ids=["fenced", "preamble", "bare", "indented"])
+def test_matching_completion_takes_one_request(base_url, grammar, text):
+    output, requests = call(OpenAI("stand-in", base_url=base_url), grammar, text)
+    assert output == text and requests == 1
+    with Constrain("json") as manager:
+        manager.parse(output, grammar=grammar)
+
+
+def test_divergent_completion_is_cut_short_and_retried(base_url, grammar):
+    llm = OpenAI("stand-in", base_url=base_url)
+    bad = FENCED.replace('"yes": 1', '"yes": "one"')
+    output, requests = call(llm, grammar, bad, FENCED)
+    assert output == FENCED and requests == 2
+    assert StreamHandler.sent[0][0] < len(bad)
+    assert llm.stats == {"completions": 1, "aborted": 1}
+
+
+def test_prose_is_cut_short_on_every_attempt(base_url, grammar):
+    output, requests = call(OpenAI("stand-in", base_url=base_url, retries=2), grammar, PROSE, PROSE, PROSE)
+    assert output is None and requests == 3
+    assert all(sent < len(PROSE) // 2 for sent, in StreamHandler.sent)
+
+
+def test_incomplete_completions_are_retried(base_url, grammar):
+    # A block closed before its object is complete, then a completion that stops early
+    output, requests = call(OpenAI("stand-in", base_url=base_url), grammar, FENCED[:40] + "\n```", FENCED[:-60], FENCED)
+    assert output == FENCED and requests == 3
+
+
+def test_async_client_across_event_loops(base_url, grammar):
+    llm = AsyncOpenAI("stand-in", base_url=base_url, max_concurrency=2)
+
+    async def run():
+        StreamHandler.completions[:] = [FENCED] * 3
+        async with llm:
+            return await asyncio.gather(*(llm("prompt", grammar=grammar) for _ in range(3)))
+
+    for _ in range(2):
+        assert asyncio.run(run()) == [FENCED] * 3
@@ -0,0 +1,37 @@
+from grammarflow.grammars.recognizer import GrammarRecognizer
+
+
+GRAMMAR = r'''
+root ::= "[" item ("," item)* "]"
+item ::= [0-9] [0-9]? [0-9]?
+'''
+
+
+def reachable(state):
+    seen = {id(state): state}
+    pending = [state]
+    while pending:
+        for following in pending.pop().edges.values():
+            if following is not None and id(following) not in seen:
+                seen[id(following)] = following
+                pending.append(following)
+    return len(seen)
+
+
+def test_state_cap_bounds_the_automaton():
+    recognizer = GrammarRecognizer(GRAMMAR, max_states=8)
+    for i in range(200):
+        assert recognizer.match(f"[{i},{i * 7 % 1000},{i * 13 % 1000}]")
+        assert not recognizer.match(f"[{i},]")
+    assert len(recognizer._states) <= 8  # pylint: disable=protected-access
+    assert reachable(recognizer.start) <= 8
+
+
+def test_matcher_survives_restart():
+    recognizer = GrammarRecognizer(GRAMMAR, max_states=4)
+    matcher = recognizer.matcher()
+    assert matcher.feed("[12,")
+    for i in range(50):
+        recognizer.match(f"[{i},{i}]")  # Restarts the automaton under the matcher
+    assert matcher.feed("345]") and matcher.complete
+    assert recognizer.matcher().feed("[1,2]")
@@ -0,0 +1,65 @@
+from grammarflow.grammars.error import ConfigError
+from grammarflow.tools import record
+from grammarflow.tools.record import record_class, to_records
+
+import gc
+from typing import List
+
+import pytest
+from pydantic import BaseModel
+
+
+class Step(BaseModel):
+    thought: str
+    score: int
+
+
+class Plan(BaseModel):
+    steps: List[Step]
+
+
+def test_nested_records():
+    plan = to_records({"Plan": {"steps": [{"thought": "a", "score": 1}]}}, [Plan])
+    assert plan.steps[0].thought == "a" and plan.steps[0].score == 1
+    assert plan.to_dict() == {"steps": [{"thought": "a", "score": 1}]}
+    assert record_class(Plan) is record_class(Plan)
+
+
+def test_clashing_field_rejected():
+    class Export(BaseModel):
+        to_dict: str
+
+    class Wrapper(BaseModel):
+        export: Export
+
+    with pytest.raises(ConfigError, match="to_dict"):
+        record_class(Export)
+    with pytest.raises(ConfigError, match="to_dict"):
+        record_class(Wrapper)
+    with pytest.raises(ConfigError):
+        record_class(Wrapper)  # Not cached half-built
+
+
+def make_model(field):
+    class Redefined(BaseModel):
+        __annotations__ = {field: str}
+
+    return Redefined
+
+
+def test_redefined_model_replaces_its_class():
+    old = make_model("a")
+    old_cls = record_class(old)
+    new = make_model("b")
+    assert record_class(new)._fields == ("b",)  # pylint: disable=protected-access
+    assert old not in record._classes  # pylint: disable=protected-access
+    assert record_class(old) is not old_cls  # Still usable, regenerated on demand
+
+
+def test_classes_dropped_with_their_model():
+    model = make_model("c")
+    record_class(model)
+    size = len(record._classes)  # pylint: disable=protected-access
+    del model
+    gc.collect()
+    assert len(record._classes) == size - 1  # pylint: disable=protected-access
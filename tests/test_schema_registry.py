@@ -0,0 +1,46 @@
+from grammarflow.tools.pydantic import SchemaRegistry
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from pydantic import BaseModel
+
+
+class Answer(BaseModel):
+    text: str
+    confidence: float
+
+
+def test_concurrent_gets_share_one_entry():
+    registry = SchemaRegistry()
+    barrier = threading.Barrier(16)
+
+    def get(_):
+        barrier.wait()
+        return [registry.get(Answer) for _ in range(200)]
+
+    with ThreadPoolExecutor(16) as pool:
+        entries = [entry for batch in pool.map(get, range(16)) for entry in batch]
+
+    assert all(entry is entries[0] for entry in entries)
+    assert registry.hits + registry.misses == 16 * 200
+    assert registry.get(Answer) is entries[0]
+
+
+def test_redefinition_replaces_entry():
+    registry = SchemaRegistry()
+
+    class Model(BaseModel):
+        a: int
+
+    old = registry.get(Model)
+
+    class Model(BaseModel):  # pylint: disable=function-redefined
+        b: int
+
+    new = registry.get(Model)
+    assert new is not old and "b" in new.schema["properties"]
+    assert len(registry._entries) == 1  # pylint: disable=protected-access
+
+    registry.invalidate(Model)
+    assert registry.get(Model) is not new
@@ -0,0 +1,43 @@
+from grammarflow import PromptBuilder, TokenBudget
+from grammarflow.grammars.error import ConfigError
+from grammarflow.tools import tokens
+from grammarflow.tools.tokens import OfflineTokenizer, TokenCounter, get_tokenizer
+
+import pytest
+
+
+@pytest.fixture
+def no_tiktoken(monkeypatch):
+    def fail(*_):
+        raise OSError("no network")
+
+    monkeypatch.setattr(tokens, "_tokenizers", {})
+    monkeypatch.setattr(tokens, "TiktokenTokenizer", fail)
+
+
+def test_default_tokenizer_does_not_fall_back(no_tiktoken, monkeypatch):
+    with pytest.raises(ConfigError, match="offline"):
+        get_tokenizer()
+    with pytest.raises(ConfigError):
+        TokenCounter().count("hello")
+
+    # The failure isn't cached: once tiktoken loads, the default is tiktoken's
+    loaded = OfflineTokenizer()
+    monkeypatch.setattr(tokens, "TiktokenTokenizer", lambda model: loaded)
+    assert get_tokenizer() is loaded
+
+
+def test_offline_is_opt_in(no_tiktoken):
+    assert get_tokenizer("offline").name == "offline"
+    assert TokenCounter("offline").count("hello world") == 2
+
+
+def test_budget_report_names_the_tokenizer():
+    builder = PromptBuilder()
+    builder.add_section(text="Earlier turns:\n{history}", placeholders=["history"])
+    builder.add_section(text="Answer the question.")
+    budget = TokenBudget(max_tokens=12, history="history", counter=TokenCounter("offline"))
+
+    prompt = builder.build({}, budget, {"history": [f"turn {i} said something" for i in range(10)]})
+    assert prompt.trimmed["tokenizer"] == "offline"
+    assert prompt.trimmed["tokens"] <= 12